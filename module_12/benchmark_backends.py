@@ -0,0 +1,144 @@
+import argparse
+import json
+import platform
+import time
+from datetime import datetime, timezone
+from benchmark_whatabook import CountingWhatabook, Workload, measure, operations
+from whatabook_db import SQLDriver, SQLQueryRegistry
+
+"""
+    Title: benchmark_backends.py
+    Description: Runs the Whatabook workload on each database driver backend and compares them.
+        For every backend the book and wishlist tables are streamed whole to measure how many rows
+        the driver decodes per second, then the read operations of benchmark_whatabook.py are timed.
+        The result cache is turned off so every read reaches the driver.
+        The MySQL backends read the same database while sqlite reads SQLITE_PATH,
+        so compare sqlite by rows per second rather than by latency unless both hold the same data.
+        Backends whose driver is not installed are skipped, --writes adds the wishlist writes.
+"""
+
+# tables streamed whole to time row decoding
+DECODE_QUERIES = ["get_books", "get_wishlist_pairs"]
+
+
+def installed(name):
+    try:
+        SQLDriver.create(name).module()
+        return True
+    except ImportError:
+        return False
+
+
+# the best of repeat full reads, the first read also warms the server's buffer pool
+def decode_throughput(whatabook, query_name, repeat):
+    query = SQLQueryRegistry.get(query_name)
+    rows = 0
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = sum(1 for _ in whatabook.iterate(query))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        "rows": rows,
+        "seconds": best,
+        "rows_per_s": rows / best if best else 0.0,
+        "us_per_row": best / rows * 1e6 if rows else 0.0,
+    }
+
+
+def benchmark_backend(name, args, report=print):
+    SQLDriver.use(name)
+    whatabook = CountingWhatabook()
+    whatabook.result_cache = None
+    whatabook.stats = None
+    workload = Workload(whatabook, args.seed)
+
+    results = {"decode": {}, "operations": {}}
+    for query_name in DECODE_QUERIES:
+        results["decode"][query_name] = decode_throughput(whatabook, query_name, args.repeat)
+        decode = results["decode"][query_name]
+        report(
+            f"{name:<22} {query_name:<20} {decode['rows']:>10} "
+            f"{decode['rows_per_s']:>12.0f} {decode['us_per_row']:>9.2f}"
+        )
+
+    for operation_name, operation in operations(workload).items():
+        if args.operations and operation_name not in args.operations:
+            continue
+        if operation_name.startswith("add_") and not args.writes:
+            continue
+        results["operations"][operation_name] = measure(
+            whatabook,
+            lambda operation=operation: operation(whatabook),
+            args.iterations,
+            args.warmup,
+        )
+    return results
+
+
+# one row per operation with the p50 of every backend side by side
+def compare(results, report=print):
+    backends = list(results)
+    report(f"\n{'p50 ms':<24}" + "".join(f"{name:>22}" for name in backends))
+    operation_names = []
+    for backend_results in results.values():
+        for operation_name in backend_results["operations"]:
+            if operation_name not in operation_names:
+                operation_names.append(operation_name)
+
+    for operation_name in operation_names:
+        cells = []
+        for name in backends:
+            result = results[name]["operations"].get(operation_name)
+            cells.append(f"{result['p50_ms']:>22.3f}" if result else f"{'-':>22}")
+        report(f"{operation_name:<24}" + "".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the Whatabook database backends")
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        choices=sorted(SQLDriver.BACKENDS),
+        help="backends to run, every installed one by default",
+    )
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3, help="full table reads per decode test")
+    parser.add_argument("--seed", type=int, default=310)
+    parser.add_argument("--operations", nargs="+", help="only run these operations")
+    parser.add_argument("--writes", action="store_true", help="also time the wishlist writes")
+    parser.add_argument("--output", default="benchmark_backends.json")
+    args = parser.parse_args()
+
+    backends = args.backends or sorted(SQLDriver.BACKENDS)
+    run = {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "iterations": args.iterations,
+            "seed": args.seed,
+        },
+        "results": {},
+    }
+
+    print(f"{'backend':<22} {'table':<20} {'rows':>10} {'rows/s':>12} {'us/row':>9}")
+    for name in backends:
+        if not installed(name):
+            print(f"{name:<22} skipped, driver not installed")
+            continue
+        try:
+            run["results"][name] = benchmark_backend(name, args)
+        except Exception as e:
+            print(f"{name:<22} failed: {type(e).__name__}: {e}")
+
+    compare(run["results"])
+    with open(args.output, "w") as output_file:
+        json.dump(run, output_file, indent=2)
+    print(f"\nresults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
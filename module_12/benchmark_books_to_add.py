@@ -0,0 +1,185 @@
+import argparse
+import json
+import random
+import statistics
+import time
+from whatabook_db import SQLConnection, SQLQueryRegistry
+
+"""
+    Title: benchmark_books_to_add.py
+    Description: Measures the available books query (get_books_to_add) as the wishlist table grows.
+        Compares the original NOT IN query with the NOT EXISTS anti-join,
+        with the indexes the foreign keys create on their own and with the (user_id, book_id) covering index.
+        The data lives in temporary tables that shadow book and wishlist for the benchmark connection only,
+        so the real tables are never read or changed.
+"""
+
+LEGACY_GET_BOOKS_TO_ADD = (
+    "SELECT book_id, book_name, author, details FROM book "
+    "WHERE book_id NOT IN (SELECT book_id FROM wishlist WHERE user_id = %s)"
+)
+
+CREATE_BOOK = """
+    CREATE TEMPORARY TABLE book (
+        book_id     INT             NOT NULL    AUTO_INCREMENT,
+        book_name   VARCHAR(200)    NOT NULL,
+        author      VARCHAR(200)    NOT NULL,
+        details     VARCHAR(500),
+        PRIMARY KEY(book_id)
+    )
+"""
+
+# the baseline schema only has the indexes MySQL adds for the foreign keys
+CREATE_WISHLIST = """
+    CREATE TEMPORARY TABLE wishlist (
+        wishlist_id     INT         NOT NULL    AUTO_INCREMENT,
+        user_id         INT         NOT NULL,
+        book_id         INT         NOT NULL,
+        PRIMARY KEY (wishlist_id),
+        INDEX fk_user (user_id),
+        INDEX fk_book (book_id)
+    )
+"""
+
+FOREIGN_KEY_INDEXES = "foreign key"
+COVERING_INDEX = "covering"
+
+USE_COVERING_INDEX = (
+    "ALTER TABLE wishlist DROP INDEX fk_user, "
+    "ADD INDEX ix_wishlist_user_book (user_id, book_id)"
+)
+USE_FOREIGN_KEY_INDEXES = (
+    "ALTER TABLE wishlist DROP INDEX ix_wishlist_user_book, ADD INDEX fk_user (user_id)"
+)
+
+INSERT_BATCH_SIZE = 10000
+
+
+def create_tables(database_connection, books):
+    sql_cursor = database_connection.cursor()
+    sql_cursor.execute(CREATE_BOOK)
+    sql_cursor.execute(CREATE_WISHLIST)
+    insert_rows(
+        database_connection,
+        "INSERT INTO book(book_name, author, details) VALUES(%s, %s, %s)",
+        ((f"Book {book_id}", f"Author {book_id % 500}", None) for book_id in range(books)),
+    )
+
+
+def insert_rows(database_connection, query, rows):
+    sql_cursor = database_connection.cursor()
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == INSERT_BATCH_SIZE:
+            sql_cursor.executemany(query, batch)
+            batch = []
+    if batch:
+        sql_cursor.executemany(query, batch)
+
+
+# wishlists are filled user by user so user 1 always has a full wishlist to measure
+def grow_wishlist(database_connection, generator, start, stop, books, per_user):
+    insert_rows(
+        database_connection,
+        "INSERT INTO wishlist(user_id, book_id) VALUES(%s, %s)",
+        (
+            (row // per_user + 1, generator.randint(1, books))
+            for row in range(start, stop)
+        ),
+    )
+
+
+def measure(database_connection, query, user_id, repeat):
+    sql_cursor = database_connection.cursor()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sql_cursor.execute(query, (user_id,))
+        sql_cursor.fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        "p50_ms": statistics.median(timings),
+        "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+    }
+
+
+def explain(database_connection, query, user_id):
+    sql_cursor = database_connection.cursor()
+    sql_cursor.execute("EXPLAIN " + query, (user_id,))
+    return sql_cursor.fetchall()
+
+
+def run(sizes, books, per_user, repeat, seed, show_plans):
+    queries = {
+        "not in": LEGACY_GET_BOOKS_TO_ADD,
+        "anti-join": SQLQueryRegistry.get("get_books_to_add").sql,
+    }
+    generator = random.Random(seed)
+    results = []
+
+    with SQLConnection() as database_connection:
+        create_tables(database_connection, books)
+        rows = 0
+        for size in sorted(sizes):
+            grow_wishlist(database_connection, generator, rows, size, books, per_user)
+            rows = size
+
+            for indexes, change_indexes in (
+                (FOREIGN_KEY_INDEXES, USE_COVERING_INDEX),
+                (COVERING_INDEX, USE_FOREIGN_KEY_INDEXES),
+            ):
+                for name, query in queries.items():
+                    result = {"wishlist_rows": size, "query": name, "indexes": indexes}
+                    result.update(measure(database_connection, query, 1, repeat))
+                    results.append(result)
+                    print(
+                        f"{size:>10} {name:>10} {indexes:>12} "
+                        f"{result['p50_ms']:>10.2f} {result['p95_ms']:>10.2f}"
+                    )
+                    if show_plans:
+                        for plan_row in explain(database_connection, query, 1):
+                            print("    ", plan_row)
+                database_connection.cursor().execute(change_indexes)
+
+        sql_cursor = database_connection.cursor()
+        sql_cursor.execute("DROP TEMPORARY TABLE wishlist")
+        sql_cursor.execute("DROP TEMPORARY TABLE book")
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark get_books_to_add as the wishlist table grows"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10**3, 10**4, 10**5, 10**6, 10**7],
+        help="wishlist row counts to measure at",
+    )
+    parser.add_argument("--books", type=int, default=10000, help="rows in book")
+    parser.add_argument(
+        "--per-user", type=int, default=50, help="wishlist rows for every user"
+    )
+    parser.add_argument("--repeat", type=int, default=20, help="runs of each query")
+    parser.add_argument("--seed", type=int, default=310)
+    parser.add_argument("--explain", action="store_true", help="print query plans")
+    parser.add_argument("--output", help="write the results to this json file")
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'query':>10} {'indexes':>12} {'p50 ms':>10} {'p95 ms':>10}")
+    results = run(
+        args.sizes, args.books, args.per_user, args.repeat, args.seed, args.explain
+    )
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from unittest.mock import patch
+from whatabook import TableNotFoundError, Whatabook, WhatabookMenu
+from whatabook_datagen import TITLE_WORDS, BulkLoader, DatasetGenerator
+
+"""
+    Title: benchmark_whatabook.py
+    Description: Benchmarks every Whatabook operation and the main WhatabookMenu flows.
+        Reports p50/p95/p99 latency, throughput, database round trips and peak memory per operation
+        and stores the results as json so two runs can be compared for regressions.
+        With --load each scale factor is generated and loaded with whatabook_datagen.py first,
+        otherwise the data already in the database is measured.
+        The result and catalog caches are off so every call reaches the database,
+        --cached measures a second time with them on and reports it separately.
+        The wishlist operations add books to wishlists, run it against a test database.
+"""
+
+
+# Counts the statements sent to the database, one per execute
+class CountingCursor:
+    def __init__(self, sql_cursor, counter):
+        self._sql_cursor = sql_cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter.round_trips += 1
+        return self._sql_cursor.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._sql_cursor, name)
+
+
+class CountingMixin:
+    round_trips = 0
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(super().cursor(*args, **kwargs), self)
+
+
+class CountingWhatabook(CountingMixin, Whatabook):
+    pass
+
+
+class CountingWhatabookMenu(CountingMixin, WhatabookMenu):
+    pass
+
+
+# Random but repeatable arguments for the operations
+class Workload:
+    def __init__(self, whatabook, seed):
+        self.generator = random.Random(seed)
+        self.users = whatabook.get_total_users()
+        ((self.books,),) = whatabook.fetch("SELECT COALESCE(MAX(book_id), 0) FROM book")
+
+    def user_id(self):
+        return self.generator.randint(1, max(1, self.users))
+
+    def book_id(self):
+        return self.generator.randint(1, max(1, self.books))
+
+    def book_ids(self, count=5):
+        return [self.book_id() for _ in range(count)]
+
+    # generated book names are made of these words
+    def search_terms(self):
+        return " ".join(self.generator.sample(TITLE_WORDS, 2))
+
+
+def operations(workload):
+    return {
+        "get_books": lambda whatabook: whatabook.get_books(),
+        "get_locations": lambda whatabook: whatabook.get_locations(),
+        "get_total_users": lambda whatabook: whatabook.get_total_users(),
+        "user_exists": lambda whatabook: whatabook.user_exists(workload.user_id()),
+        "validate_user_id": lambda whatabook: whatabook.validate_user_id(workload.user_id()),
+        "get_wishlist_books": lambda whatabook: get_wishlist(whatabook, workload),
+        "get_books_to_add": lambda whatabook: whatabook.get_books_to_add(workload.user_id()),
+        "get_books_page": lambda whatabook: whatabook.get_books_page(),
+        "get_wishlist_page": lambda whatabook: whatabook.get_wishlist_page(workload.user_id()),
+        "search_books": lambda whatabook: whatabook.search_books(workload.search_terms()),
+        "load_recommendations": lambda whatabook: whatabook.load_recommendations(
+            workload.user_id()
+        ),
+        "add_book_to_wishlist": lambda whatabook: whatabook.add_book_to_wishlist(
+            workload.user_id(), workload.book_id()
+        ),
+        "add_books_to_wishlist": lambda whatabook: whatabook.add_books_to_wishlist(
+            workload.user_id(), workload.book_ids()
+        ),
+    }
+
+
+# users without a wishlist are expected at scale, they are not a failure of the benchmark
+def get_wishlist(whatabook, workload):
+    try:
+        return whatabook.get_wishlist_books(workload.user_id())
+    except TableNotFoundError:
+        return None
+
+
+# menu input sequences, each one ends back at the exit option of the main menu
+def menu_flows(menu, workload):
+    exit_menu = 4
+    exit_account = 3
+    return {
+        "menu_view_books": lambda: [1, exit_menu],
+        "menu_view_locations": lambda: [2, exit_menu],
+        "menu_browse_books": lambda: [5, "n", "q", exit_menu],
+        "menu_search_books": lambda: [6, workload.search_terms(), "q", exit_menu],
+        "menu_wishlist": lambda: [3, workload.user_id(), 1, exit_account, exit_menu],
+        "menu_add_book": lambda: [
+            3,
+            workload.user_id(),
+            2,
+            ", ".join(str(book_id) for book_id in workload.book_ids(3)),
+            exit_account,
+            exit_menu,
+        ],
+    }
+
+
+def run_menu(menu, inputs):
+    with patch("whatabook.input", side_effect=inputs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            menu.main_menu()
+
+
+def percentile(timings, fraction):
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def measure(counter, call, iterations, warmup):
+    for _ in range(warmup):
+        call()
+
+    counter.round_trips = 0
+    timings = []
+    errors = 0
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call_start = time.perf_counter()
+        try:
+            call()
+        except Exception:
+            errors += 1
+        timings.append((time.perf_counter() - call_start) * 1000)
+    elapsed = time.perf_counter() - start
+    round_trips = counter.round_trips
+
+    # memory is traced in a separate pass so tracing does not slow down the timed calls
+    tracemalloc.start()
+    try:
+        call()
+    except Exception:
+        pass
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    return {
+        "iterations": iterations,
+        "errors": errors,
+        "p50_ms": percentile(timings, 0.50),
+        "p95_ms": percentile(timings, 0.95),
+        "p99_ms": percentile(timings, 0.99),
+        "mean_ms": sum(timings) / len(timings),
+        "throughput_per_s": iterations / elapsed if elapsed else 0.0,
+        "round_trips": round_trips / iterations,
+        "peak_memory_kb": peak_memory / 1024,
+    }
+
+
+def benchmark(iterations, warmup, seed, selected, cached=False, report=print):
+    whatabook = CountingWhatabook()
+    menu = CountingWhatabookMenu()
+    # repeated calls would be answered from the result and catalog caches,
+    # they are turned off unless cached is set so the database work is measured
+    if not cached:
+        for client in (whatabook, menu):
+            client.result_cache = None
+            client.catalog_cache = None
+    workload = Workload(whatabook, seed)
+    results = {}
+
+    calls = {
+        name: (whatabook, lambda operation=operation: operation(whatabook))
+        for name, operation in operations(workload).items()
+    }
+    calls.update(
+        {
+            name: (menu, lambda flow=flow: run_menu(menu, flow()))
+            for name, flow in menu_flows(menu, workload).items()
+        }
+    )
+
+    for name, (counter, call) in calls.items():
+        if selected and name not in selected:
+            continue
+        results[name] = measure(counter, call, iterations, warmup)
+        result = results[name]
+        report(
+            f"{name:<24} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} "
+            f"{result['p99_ms']:>9.2f} {result['throughput_per_s']:>10.1f} "
+            f"{result['round_trips']:>7.1f} {result['peak_memory_kb']:>10.1f}"
+        )
+    return results
+
+
+# prints the change of every latency and returns the operations that got slower than the threshold
+def compare(baseline, current, threshold, report=print):
+    regressions = []
+    report(f"\n{'scale':<8} {'operation':<24} {'baseline p50':>12} {'p50':>9} {'change':>8}")
+    for scale, operations_results in current["results"].items():
+        for name, result in operations_results.items():
+            previous = baseline["results"].get(scale, {}).get(name)
+            if previous is None or not previous["p50_ms"]:
+                continue
+            change = (result["p50_ms"] - previous["p50_ms"]) / previous["p50_ms"]
+            flag = "  REGRESSION" if change > threshold else ""
+            report(
+                f"{scale:<8} {name:<24} {previous['p50_ms']:>12.2f} "
+                f"{result['p50_ms']:>9.2f} {change:>+8.1%}{flag}"
+            )
+            if change > threshold:
+                regressions.append((scale, name))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Whatabook operations")
+    parser.add_argument(
+        "--scales",
+        type=float,
+        nargs="+",
+        help="scale factors to generate and load before measuring, requires --load",
+    )
+    parser.add_argument(
+        "--load", action="store_true", help="load each scale with whatabook_datagen.py"
+    )
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=310)
+    parser.add_argument("--operations", nargs="+", help="only run these operations")
+    parser.add_argument(
+        "--cached",
+        action="store_true",
+        help="also measure with the result and catalog caches on, reported as '<scale> cached'",
+    )
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="results file of an earlier run")
+    parser.add_argument(
+        "--threshold", type=float, default=0.10, help="p50 slowdown counted as a regression"
+    )
+    args = parser.parse_args()
+
+    scales = args.scales if args.load and args.scales else [None]
+    run = {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "iterations": args.iterations,
+            "seed": args.seed,
+        },
+        "results": {},
+    }
+
+    for scale in scales:
+        label = "current" if scale is None else str(scale)
+        if scale is not None:
+            print(f"-- loading scale {scale} --")
+            generator = DatasetGenerator(scale, args.seed)
+            BulkLoader().load(generator.write("data"))
+
+        for cached in (False, True) if args.cached else (False,):
+            cached_label = f"{label} cached" if cached else label
+            print(f"\n-- scale {cached_label} --")
+            print(
+                f"{'operation':<24} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+                f"{'ops/s':>10} {'trips':>7} {'peak kb':>10}"
+            )
+            run["results"][cached_label] = benchmark(
+                args.iterations, args.warmup, args.seed, args.operations, cached
+            )
+
+    with open(args.output, "w") as output_file:
+        json.dump(run, output_file, indent=2)
+    print(f"\nresults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(baseline, run, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+ALTER TABLE wishlist
+    ADD INDEX fk_user (user_id),
+    ADD INDEX fk_book (book_id),
+    ALGORITHM=INPLACE, LOCK=NONE;
+
+ALTER TABLE wishlist
+    DROP INDEX ix_wishlist_user_book,
+    DROP INDEX ix_wishlist_book,
+    ALGORITHM=INPLACE, LOCK=NONE;
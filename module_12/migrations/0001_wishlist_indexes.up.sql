@@ -0,0 +1,11 @@
+-- replace the single column foreign key indexes with ones that cover the wishlist lookups
+-- and the available books anti-join for a user
+ALTER TABLE wishlist
+    ADD INDEX ix_wishlist_user_book (user_id, book_id),
+    ADD INDEX ix_wishlist_book (book_id),
+    ALGORITHM=INPLACE, LOCK=NONE;
+
+ALTER TABLE wishlist
+    DROP INDEX fk_user,
+    DROP INDEX fk_book,
+    ALGORITHM=INPLACE, LOCK=NONE;
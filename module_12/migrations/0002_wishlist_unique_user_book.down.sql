@@ -0,0 +1,4 @@
+ALTER TABLE wishlist
+    ADD INDEX ix_wishlist_user_book (user_id, book_id),
+    DROP INDEX ux_wishlist_user_book,
+    ALGORITHM=INPLACE, LOCK=NONE;
@@ -0,0 +1,14 @@
+-- a book can only be on a user's wishlist once, keep the first entry of any duplicates
+-- the duplicates are deleted a range of wishlist ids at a time so no delete locks the whole table
+-- batch wishlist.wishlist_id 10000
+DELETE duplicate FROM wishlist AS duplicate
+    INNER JOIN wishlist AS original
+        ON duplicate.user_id = original.user_id
+        AND duplicate.book_id = original.book_id
+        AND duplicate.wishlist_id > original.wishlist_id
+    WHERE duplicate.wishlist_id BETWEEN %s AND %s;
+
+ALTER TABLE wishlist
+    ADD UNIQUE INDEX ux_wishlist_user_book (user_id, book_id),
+    DROP INDEX ix_wishlist_user_book,
+    ALGORITHM=INPLACE, LOCK=NONE;
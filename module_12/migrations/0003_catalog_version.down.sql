@@ -0,0 +1,8 @@
+DROP TRIGGER book_insert_version;
+DROP TRIGGER book_update_version;
+DROP TRIGGER book_delete_version;
+DROP TRIGGER store_insert_version;
+DROP TRIGGER store_update_version;
+DROP TRIGGER store_delete_version;
+
+DROP TABLE catalog_version;
@@ -0,0 +1,27 @@
+-- version counters for the catalog tables, checked by the program before re-reading a cached table
+CREATE TABLE catalog_version (
+    table_name      VARCHAR(64) NOT NULL,
+    version         BIGINT      NOT NULL    DEFAULT 0,
+    PRIMARY KEY(table_name)
+);
+
+INSERT INTO catalog_version(table_name)
+    VALUES('book'), ('store');
+
+CREATE TRIGGER book_insert_version AFTER INSERT ON book
+    FOR EACH ROW UPDATE catalog_version SET version = version + 1 WHERE table_name = 'book';
+
+CREATE TRIGGER book_update_version AFTER UPDATE ON book
+    FOR EACH ROW UPDATE catalog_version SET version = version + 1 WHERE table_name = 'book';
+
+CREATE TRIGGER book_delete_version AFTER DELETE ON book
+    FOR EACH ROW UPDATE catalog_version SET version = version + 1 WHERE table_name = 'book';
+
+CREATE TRIGGER store_insert_version AFTER INSERT ON store
+    FOR EACH ROW UPDATE catalog_version SET version = version + 1 WHERE table_name = 'store';
+
+CREATE TRIGGER store_update_version AFTER UPDATE ON store
+    FOR EACH ROW UPDATE catalog_version SET version = version + 1 WHERE table_name = 'store';
+
+CREATE TRIGGER store_delete_version AFTER DELETE ON store
+    FOR EACH ROW UPDATE catalog_version SET version = version + 1 WHERE table_name = 'store';
@@ -0,0 +1,3 @@
+ALTER TABLE book
+    DROP INDEX ft_book_search,
+    ALGORITHM=INPLACE, LOCK=NONE;
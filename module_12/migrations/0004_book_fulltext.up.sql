@@ -0,0 +1,5 @@
+-- full text index for the book search, ranked with MATCH ... AGAINST
+-- InnoDB builds a FULLTEXT index in place but can not allow writes while it does, hence LOCK=SHARED
+ALTER TABLE book
+    ADD FULLTEXT INDEX ft_book_search (book_name, author, details),
+    ALGORITHM=INPLACE, LOCK=SHARED;
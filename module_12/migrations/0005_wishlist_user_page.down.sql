@@ -0,0 +1,3 @@
+ALTER TABLE wishlist
+    DROP INDEX ix_wishlist_user_wishlist,
+    ALGORITHM=INPLACE, LOCK=NONE;
@@ -0,0 +1,6 @@
+-- the wishlist pages read a user's books in wishlist_id order
+-- InnoDB kept that order in fk_user (user_id) through its primary key column until 0001 dropped it,
+-- since then every page sorted all of the user's rows, this index reads them in order again
+ALTER TABLE wishlist
+    ADD INDEX ix_wishlist_user_wishlist (user_id, wishlist_id),
+    ALGORITHM=INPLACE, LOCK=NONE;
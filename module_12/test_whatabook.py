@@ -1,8 +1,38 @@
 # file name should start with => test_ <= or end with => _test <= #
+import io
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
 import unittest
-from whatabook import Whatabook
+from whatabook import (
+    Whatabook,
+    BOOK_LISTING,
+    Book,
+    BookSearchIndex,
+    CatalogCache,
+    ConfigNotSetError,
+    InvalidBookError,
+    OfflineReplica,
+    PoolClosedError,
+    QueryResultCache,
+    QueryStatistics,
+    SQLConnection,
+    SQLConnectionPool,
+    SQLDriver,
+    SQLInterface,
+    SQLiteBackend,
+    SQLMigrator,
+    SQLQueryRegistry,
+    SQLReplicaRouter,
+    Tracer,
+)
 from sys import maxsize
 
+# seconds a fresh interpreter may spend importing whatabook
+IMPORT_TIME_BUDGET = 0.25
+
 class TestCalculator(unittest.TestCase):
 
     @classmethod
@@ -31,6 +61,112 @@ class TestCalculator(unittest.TestCase):
         unexpected = None
         self.assertNotEquals(result, unexpected)
 
+    def test_invalidate_catalog(self):
+        expected = self.whatabook.get_books()
+        self.whatabook.invalidate_catalog("book")
+        result = self.whatabook.get_books()
+        self.assertEqual(result, expected)
+
+    # each book is rendered as soon as its row is read and a catalog above max_rows is not kept
+    def test_stream_books(self):
+        whatabook = Whatabook()
+        whatabook.catalog_cache = CatalogCache(max_rows=2)
+        whatabook.batch_size = 2
+        rows_read = []
+
+        def iterate(query, params=(), session=None, batch_size=None):
+            for row in SQLInterface.iterate(whatabook, query, params, session, batch_size):
+                rows_read.append(row)
+                yield row
+
+        whatabook.iterate = iterate
+        chunks = whatabook.stream_books()
+        self.assertEqual(next(chunks), BOOK_LISTING)
+        next(chunks)
+        self.assertEqual(len(rows_read), 1)
+
+        rest = list(chunks)
+        self.assertEqual(len(rows_read), len(rest) + 1)
+        self.assertNotIn("book", whatabook.catalog_cache.statistics()["tables"])
+
+    def test_get_books_page(self):
+        page_size = 2
+        first_page = self.whatabook.get_books_page(page_size)
+        result = len(first_page.items)
+        expected = page_size
+        self.assertEqual(result, expected)
+        self.assertIsNone(first_page.previous_cursor)
+
+        next_page = self.whatabook.get_books_page(page_size, first_page.next_cursor)
+        previous_page = self.whatabook.get_books_page(page_size, next_page.previous_cursor)
+        result = [book.book_id for book in previous_page.items]
+        expected = [book.book_id for book in first_page.items]
+        self.assertEqual(result, expected)
+
+    def test_search_books(self):
+        page = self.whatabook.search_books("dark elf")
+        result = {book.book_name for book in page.items}
+        expected = {"Homeland", "Exile", "Sojourn"}
+        self.assertTrue(expected <= result)
+
+    def test_book_search_index(self):
+        search_index = BookSearchIndex(
+            [
+                Book("Homeland", "R.A.Salvatore", "The Dark Elf Trilogy", 1),
+                Book("Exile", "R.A.Salvatore", "The Dark Elf Trilogy", 2),
+                Book("The Hunger Games", "Suzanne Collins", None, 5),
+            ]
+        )
+        result = [book.book_id for book in search_index.search("exile elf", 10)]
+        self.assertEqual(result, [2, 1])
+        self.assertEqual(search_index.search("mockingjay", 10), [])
+
+    def test_search_index_cached(self):
+        whatabook = Whatabook()
+        whatabook.catalog_cache = None
+        whatabook.fulltext = False
+        whatabook.search_books("dark elf")
+        search_index = whatabook.search_index()
+        whatabook.search_books("dark elf")
+        if search_index.version is not None:
+            self.assertIs(whatabook.search_index(), search_index)
+
+    def test_get_wishlist_page(self):
+        page = self.whatabook.get_wishlist_page(self.default_user_id)
+        unexpected = []
+        self.assertNotEqual(page.items, unexpected)
+
+    # every book is checked against the user's wishlist with a probe of the covering index
+    def test_books_to_add_index(self):
+        backend = SQLiteBackend()
+        database_connection = backend.connect({"database": ":memory:"})
+        try:
+            sql = SQLQueryRegistry.get("get_books_to_add", backend).sql
+            plan = database_connection.execute("EXPLAIN QUERY PLAN " + sql, (1,)).fetchall()
+            details = [detail for *_, detail in plan]
+            self.assertIn(
+                "SEARCH wishlist USING COVERING INDEX ux_wishlist_user_book (user_id=? AND book_id=?)",
+                details,
+            )
+        finally:
+            database_connection.close()
+
+    # the wishlist pages read a user's rows in wishlist_id order from an index, without sorting them
+    def test_wishlist_page_index(self):
+        backend = SQLiteBackend()
+        database_connection = backend.connect({"database": ":memory:"})
+        try:
+            for name in ("get_wishlist_page", "get_wishlist_page_before"):
+                sql = SQLQueryRegistry.get(name, backend).sql
+                plan = database_connection.execute(
+                    "EXPLAIN QUERY PLAN " + sql, (1,) * sql.count("?")
+                ).fetchall()
+                details = " ".join(detail for *_, detail in plan)
+                self.assertIn("ix_wishlist_user_wishlist", details)
+                self.assertNotIn("TEMP B-TREE", details)
+        finally:
+            database_connection.close()
+
     def test_get_total_users(self):
         result = self.whatabook.get_total_users()
         expected = 3
@@ -51,6 +187,15 @@ class TestCalculator(unittest.TestCase):
         expected = False
         self.assertEqual(result, expected)
 
+    def test_user_exists(self):
+        result = self.whatabook.user_exists(self.default_user_id)
+        expected = True
+        self.assertEqual(result, expected)
+
+        result = self.whatabook.user_exists(maxsize)
+        expected = False
+        self.assertEqual(result, expected)
+
     def test_get_wishlist_books(self):
         result = self.whatabook.get_wishlist_books(self.default_user_id)
         unexpected = None
@@ -61,9 +206,378 @@ class TestCalculator(unittest.TestCase):
         unexpected = None
         self.assertNotEquals(result, unexpected)
 
+    def test_connection_pool(self):
+        self.whatabook.get_books()
+        expected = self.whatabook.pool_statistics()["created"]
+        self.whatabook.get_locations()
+        result = self.whatabook.pool_statistics()["created"]
+        self.assertEqual(result, expected)
+
+    # a named query is prepared once per pooled connection and its values are only ever parameters
+    def test_prepared_statements(self):
+        pool = SQLConnectionPool(SQLConnectionPool.load_config(), max_size=1)
+        interface = SQLInterface(pool=pool)
+        query = SQLQueryRegistry.get("user_exists")
+        try:
+            self.assertEqual(interface.fetch(query, (self.default_user_id,)), [(1,)])
+            self.assertEqual(interface.fetch(query, (f"{maxsize} OR 1 = 1",)), [])
+            self.assertEqual(pool.statistics()["prepared"], 1)
+
+            with SQLConnection(pool) as database_connection:
+                sql_cursor = pool.statement(database_connection, query)
+                self.assertIs(pool.statement(database_connection, query), sql_cursor)
+
+            interface.fetch(SQLQueryRegistry.get("get_total_users"))
+            self.assertEqual(pool.statistics()["prepared"], 2)
+        finally:
+            pool.close()
+
+    def test_result_cache(self):
+        expected = self.whatabook.get_wishlist_books(self.default_user_id)
+        hits = self.whatabook.result_cache.statistics()["hits"]
+        result = self.whatabook.get_wishlist_books(self.default_user_id)
+        self.assertEqual(result, expected)
+        self.assertGreater(self.whatabook.result_cache.statistics()["hits"], hits)
+
+    def test_result_cache_invalidation(self):
+        cache = QueryResultCache(max_entries=2)
+        for user_id in (1, 2, 3):
+            key = ("get_wishlist_books", (user_id,))
+            cache.put(key, {"wishlist"}, [(user_id,)], cache.generations({"wishlist"}))
+        self.assertEqual(cache.statistics()["evictions"], 1)
+        self.assertIsNone(cache.get(("get_wishlist_books", (1,))))
+
+        cache.put(("get_books_page", (0, 11)), {"book"}, [(1,)], cache.generations({"book"}))
+        cache.invalidate("wishlist")
+        self.assertIsNone(cache.get(("get_wishlist_books", (3,))))
+        self.assertEqual(cache.get(("get_books_page", (0, 11))), ((1,),))
+
+    # a user added outside this Whatabook is found without waiting for cached results to expire
+    def test_user_checks_not_cached(self):
+        user_id = 999
+        total_users = self.whatabook.get_total_users()
+        self.assertFalse(self.whatabook.user_exists(user_id))
+        interface = SQLInterface()
+        interface.commit(
+            f"INSERT INTO user(user_id, first_name, last_name) VALUES({user_id}, 'Cache', 'Test')", ()
+        )
+        try:
+            self.assertTrue(self.whatabook.user_exists(user_id))
+            self.assertEqual(self.whatabook.get_total_users(), total_users + 1)
+        finally:
+            interface.commit(f"DELETE FROM user WHERE user_id = {user_id}", ())
+
+    def test_query_statistics(self):
+        stats = QueryStatistics(slow_query_ms=50)
+        stats.record("get_books", {"connect": 0.001, "execute": 0.002, "fetch": 0.001}, 10)
+        stats.record("get_books", {"connect": 0.001, "execute": 0.090, "fetch": 0.001}, 10, ())
+        stats.record_error("get_books", ValueError())
+
+        result = stats.snapshot()["queries"]["get_books"]
+        self.assertEqual((result["calls"], result["rows"], result["errors"]), (2, 20, 1))
+        self.assertEqual(result["phases"]["execute"]["p50_ms"], 2.5)
+        self.assertAlmostEqual(result["phases"]["execute"]["max_ms"], 90)
+        # only the second call took longer than slow_query_ms
+        self.assertEqual(len(stats.slow_queries()), 1)
+
+    def test_query_statistics_recorded(self):
+        self.whatabook.get_books_page()
+        result = self.whatabook.stats.snapshot()["queries"]["get_books_page"]
+        self.assertGreaterEqual(result["calls"] + result["cache_hits"], 1)
+
+    def test_tracer(self):
+        tracer = Tracer("trace.json")
+        with tracer.span("outer", user_id=1):
+            with tracer.span("inner"):
+                self.assertTrue(tracer.sampled())
+        result = [event["name"] for event in tracer.events() if event["ph"] == "X"]
+        # spans are recorded as they finish
+        self.assertEqual(result, ["inner", "outer"])
+
+        tracer = Tracer("trace.json", sample_rate=0)
+        with tracer.span("outer"):
+            with tracer.span("inner"):
+                pass
+        self.assertEqual(tracer.events(), [])
+
+    def test_replica_router(self):
+        router = SQLReplicaRouter(["replica 1", "replica 2"])
+        result = {router.choose(), router.choose()}
+        self.assertEqual(result, {0, 1})
+
+        # a failing replica is skipped until its retry interval has passed
+        router.fail(0)
+        self.assertEqual([router.choose(), router.choose()], [1, 1])
+
+    def test_export(self):
+        output = io.StringIO()
+        result = self.whatabook.export("books", output, batch_size=2)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], "book_id,book_name,author,details")
+        self.assertEqual(result, len(lines) - 1)
+
+    # an export is a single span however many batches it reads
+    def test_export_traced_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            tracer = Tracer.start(os.path.join(directory, "trace.json"))
+            try:
+                self.whatabook.export("books", io.StringIO(), batch_size=2)
+                result = [event["name"] for event in tracer.events() if event["ph"] == "X"]
+            finally:
+                Tracer.close_tracer()
+        self.assertEqual(result.count("Whatabook.export"), 1)
+
+    def test_sqlite_backend(self):
+        connection = SQLiteBackend().connect({"database": ":memory:"})
+        try:
+            ((result,),) = connection.execute("SELECT COUNT(*) FROM book").fetchall()
+            self.assertEqual(result, 9)
+        finally:
+            connection.close()
+
+        result = SQLQueryRegistry.to_placeholders("SELECT 1 FROM user WHERE user_id = {}", "?")
+        self.assertEqual(result, "SELECT 1 FROM user WHERE user_id = ?")
+
+    def test_offline_replica(self):
+        with tempfile.TemporaryDirectory() as directory:
+            replica = OfflineReplica(os.path.join(directory, "offline.sqlite3"))
+            try:
+                self.assertIsNone(replica.staleness())
+                self.assertTrue(replica.sync(self.whatabook))
+                self.assertLess(replica.staleness(), 60)
+
+                # listings are read from the replica while the database is offline
+                whatabook = Whatabook()
+                whatabook.catalog_cache = None
+                expected = whatabook.get_books()
+                whatabook.offline_replica = replica
+                replica.offline = True
+                self.assertEqual(whatabook.get_books(), expected)
+
+                # logging in refreshes the user id cache from the replica
+                if whatabook.user_ids is not None:
+                    whatabook.user_ids.clear()
+                self.assertTrue(whatabook.validate_user_id(self.default_user_id))
+
+                # writes are queued and replayed by the next sync
+                whatabook.add_books_to_wishlist(self.default_user_id, [self.default_book_id])
+                self.assertEqual(replica.pending_writes(), 1)
+                with self.assertRaises(InvalidBookError):
+                    whatabook.add_books_to_wishlist(self.default_user_id, [maxsize])
+                self.assertTrue(replica.sync(self.whatabook))
+                self.assertFalse(replica.offline)
+                self.assertEqual(replica.pending_writes(), 0)
+            finally:
+                replica.close()
+
+    # a connection is checked out twice from a pool of one, so it must be handed back each time
+    def test_backends(self):
+        current = SQLDriver.backend().NAME
+        try:
+            for name in sorted(SQLDriver.BACKENDS):
+                with self.subTest(backend=name):
+                    try:
+                        SQLDriver.create(name).module()
+                    except ImportError:
+                        self.skipTest(f"{name} is not installed")
+
+                    SQLDriver.use(name)
+                    pool = SQLConnectionPool(
+                        SQLConnectionPool.load_config(), max_size=1, checkout_timeout=1
+                    )
+                    try:
+                        for _ in range(2):
+                            with SQLConnection(pool) as connection:
+                                sql_cursor = SQLDriver.cursor(connection)
+                                sql_cursor.execute("SELECT 1")
+                                self.assertEqual([tuple(row) for row in sql_cursor.fetchall()], [(1,)])
+                    except Exception as e:
+                        if isinstance(e, ConfigNotSetError) or SQLDriver.unreachable(e):
+                            self.skipTest(f"{name} can not reach the database")
+                        raise
+                    finally:
+                        pool.close()
+                    self.assertEqual(pool.statistics()["in_use"], 0)
+        finally:
+            SQLDriver.use(current)
+
+    # a connection checked out while the pool closes is closed when it is handed back
+    def test_pool_close(self):
+        pool = SQLConnectionPool(SQLConnectionPool.load_config(), max_size=2)
+        router = SQLReplicaRouter([SQLConnectionPool(SQLConnectionPool.load_config(), max_size=1)])
+        connections = [(pool, pool.acquire()), (router, router.acquire())]
+        pool.close()
+        router.close()
+        for owner, connection in connections:
+            with self.assertRaises(PoolClosedError):
+                owner.acquire()
+            owner.release(connection)
+            with self.assertRaises(SQLDriver.error()):
+                SQLDriver.cursor(connection).execute("SELECT 1")
+        self.assertEqual(pool.statistics()["size"], 0)
+        self.assertEqual(router.replicas[0].statistics()["size"], 0)
+
+    def test_migrations_applied(self):
+        result = [applied for _, applied in SQLMigrator(report=lambda line: None).status()]
+        self.assertTrue(all(result))
+
+    def test_migration_batches(self):
+        migrator = SQLMigrator(report=lambda line: None)
+        migration = next(migration for migration in migrator.migrations() if migration.version == 2)
+        result = [batch for _, batch in migration.statements(migrator.UP)]
+        expected = [("wishlist", "wishlist_id", 10000), None]
+        self.assertEqual(result, expected)
+
+        # every key range is deleted by its own statement
+        database_connection = sqlite3.connect(":memory:")
+        try:
+            sql_cursor = database_connection.cursor()
+            sql_cursor.execute("CREATE TABLE wishlist (wishlist_id INTEGER PRIMARY KEY)")
+            sql_cursor.executemany("INSERT INTO wishlist VALUES(?)", [(key,) for key in range(1, 26)])
+            batches = migrator.run_batched(
+                database_connection,
+                sql_cursor,
+                "DELETE FROM wishlist WHERE wishlist_id BETWEEN ? AND ? AND wishlist_id % 2 = 0",
+                ("wishlist", "wishlist_id", 10),
+            )
+            self.assertEqual(batches, 3)
+            sql_cursor.execute("SELECT COUNT(*) FROM wishlist")
+            self.assertEqual(sql_cursor.fetchone(), (13,))
+        finally:
+            database_connection.close()
+
+    # a migration that fails partway resumes after the statements that finished
+    def test_migration_resume(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "9999_resume.up.sql"), "w") as migration_file:
+                migration_file.write(
+                    "CREATE TABLE migration_resume (id INTEGER);\n"
+                    "INSERT INTO migration_resume VALUES(1);\n"
+                    "INSERT INTO migration_resume_missing VALUES(1);\n"
+                )
+            with open(os.path.join(directory, "9999_resume.down.sql"), "w") as migration_file:
+                migration_file.write(
+                    "DROP TABLE migration_resume_missing;\nDROP TABLE migration_resume;\n"
+                )
+
+            migrator = SQLMigrator(directory, report=lambda line: None)
+            with self.assertRaises(Exception):
+                migrator.upgrade()
+            self.assertEqual(migrator.finished_steps(migrator.migrations()[0], migrator.UP), {0, 1})
+            try:
+                migrator.commit("CREATE TABLE migration_resume_missing (id INTEGER)", ())
+                migrator.upgrade()
+                self.assertEqual(migrator.fetch("SELECT COUNT(*) FROM migration_resume"), [(1,)])
+                self.assertTrue(all(applied for _, applied in migrator.status()))
+                self.assertEqual(migrator.finished_steps(migrator.migrations()[0], migrator.UP), set())
+            finally:
+                migrator.downgrade(0)
+            self.assertFalse(any(applied for _, applied in migrator.status()))
+
+    def test_dataset_generator(self):
+        from whatabook_datagen import TABLES, DatasetGenerator
+
+        # the same seed and scale always produce the same rows
+        generator = DatasetGenerator(0.1, seed=1, avg_wishlist=5)
+        for table in TABLES:
+            result = list(generator.rows(table))
+            expected = list(DatasetGenerator(0.1, seed=1, avg_wishlist=5).rows(table))
+            self.assertEqual(result, expected)
+        self.assertNotEqual(
+            list(generator.rows("book")),
+            list(DatasetGenerator(0.1, seed=2, avg_wishlist=5).rows("book")),
+        )
+
+        # every table grows linearly with the scale factor
+        larger = DatasetGenerator(0.2, seed=1, avg_wishlist=5)
+        counts = {table: sum(1 for _ in generator.rows(table)) for table in TABLES}
+        larger_counts = {table: sum(1 for _ in larger.rows(table)) for table in TABLES}
+        result = [(counts[table], larger_counts[table]) for table in ("store", "book", "user")]
+        expected = [(1, 2), (1000, 2000), (2000, 4000)]
+        self.assertEqual(result, expected)
+        self.assertAlmostEqual(larger_counts["wishlist"] / counts["wishlist"], 2, delta=0.2)
+
+    # only the keys the database has are dropped and added back around a load
+    def test_bulk_loader_keys(self):
+        from whatabook_datagen import BulkLoader
+
+        class RecordingCursor:
+            def __init__(self):
+                self.statements = []
+                self.rows = []
+
+            def execute(self, statement, params=()):
+                self.statements.append(statement)
+                existing = {
+                    ("statistics", "wishlist"): [("PRIMARY",), ("ux_wishlist_user_book",)],
+                    ("table_constraints", "wishlist"): [("fk_user",)],
+                    ("statistics", "book"): [("PRIMARY",)],
+                }
+                table = "statistics" if "statistics" in statement else "table_constraints"
+                self.rows = existing.get((table, params[0]), []) if params else []
+
+            def fetchall(self):
+                return self.rows
+
+        sql_cursor = RecordingCursor()
+        loader = BulkLoader(report=lambda line: None)
+        add_keys = loader.drop_keys(sql_cursor)
+        result = [statement for statement in sql_cursor.statements if "ALTER" in statement]
+        expected = [
+            "ALTER TABLE wishlist DROP FOREIGN KEY fk_user",
+            "ALTER TABLE wishlist DROP INDEX ux_wishlist_user_book",
+        ]
+        self.assertEqual(result, expected)
+        self.assertEqual(
+            add_keys,
+            [
+                "ALTER TABLE wishlist ADD UNIQUE INDEX ux_wishlist_user_book (user_id, book_id)",
+                "ALTER TABLE wishlist "
+                "ADD CONSTRAINT fk_user FOREIGN KEY (user_id) REFERENCES user(user_id)",
+            ],
+        )
+
+        # the loader connects through the configured backend and needs a MySQL one
+        if not SQLDriver.backend().SERVER:
+            with self.assertRaises(ConfigNotSetError):
+                loader.connect()
+
+    def test_load_recommendations(self):
+        result = self.whatabook.load_recommendations(self.default_user_id)
+        self.assertIsInstance(result, list)
+
+    def test_recommendation_engine(self):
+        try:
+            import numpy
+            from whatabook_recommend import RecommendationEngine
+        except ImportError:
+            self.skipTest("numpy and scipy are not installed")
+
+        engine = RecommendationEngine()
+        engine.build(numpy.array([1, 1, 2, 2, 3]), numpy.array([1, 2, 1, 2, 3]))
+        self.assertEqual([book_id for book_id, _ in engine.recommend_for_book(1)], [2])
+
+        # a new wishlist entry is counted before the matrix is rebuilt
+        engine.add(3, 1)
+        self.assertEqual([book_id for book_id, _ in engine.recommend_for_user(3)], [2])
+
+        # books above the highest book id seen so far start with no wishlists
+        engine.add(5, 6)
+        self.assertEqual(engine.statistics()["books"], 4)
+
     def test_add_book_to_wishlist(self):
         self.whatabook.add_book_to_wishlist(self.default_user_id, self.default_book_id)
 
+    def test_add_books_to_wishlist(self):
+        book_ids = [self.default_book_id, 2]
+        # books already on the wishlist are not added again
+        result = self.whatabook.add_books_to_wishlist(self.default_user_id, book_ids)
+        expected = len(book_ids)
+        self.assertLessEqual(result, expected)
+
+        with self.assertRaises(InvalidBookError):
+            self.whatabook.add_books_to_wishlist(self.default_user_id, [1, maxsize])
+
         
 
 
@@ -75,3 +589,31 @@ class TestCalculator(unittest.TestCase):
 
 
     
+
+    def test_book_format(self):
+        book = Book.to_object((self.default_book_id, "Dune", "Frank Herbert", None))
+        expected = "Book Name: Dune\nAuthor: Frank Herbert\nDetails: None\n\n"
+        self.assertEqual(book.format(), expected)
+        self.assertFalse(hasattr(book, "__dict__"))
+
+    def test_import_time(self):
+        # importing whatabook must not load the driver, pydantic or the configuration file
+        script = (
+            "import sys, time\n"
+            "start = time.perf_counter()\n"
+            "import whatabook\n"
+            "print(time.perf_counter() - start)\n"
+            "print(sorted({name.split('.')[0] for name in sys.modules} & {'mysql', 'pydantic'}))\n"
+            "print(whatabook.SQLConfiguration._config is None)\n"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        elapsed, loaded, unparsed = result.stdout.splitlines()
+        self.assertLess(float(elapsed), IMPORT_TIME_BUDGET)
+        self.assertEqual(loaded, "[]")
+        self.assertEqual(unparsed, "True")
@@ -0,0 +1,200 @@
+import asyncio
+import unittest
+from configparser import ConfigParser
+from contextlib import asynccontextmanager
+from unittest.mock import AsyncMock, patch
+from whatabook import (
+    ConfigNotSetError,
+    InvalidBookError,
+    SQLConfiguration,
+    SQLConnectionPool,
+    SQLDriver,
+    SQLEnvironment,
+    SQLiteBackend,
+    Whatabook,
+)
+from whatabook_async import AsyncWhatabook, RaisingCursor, aiomysql
+from sys import maxsize
+
+
+# The parts of the aiomysql pool AsyncWhatabook uses, on top of a blocking SQLConnectionPool
+# so the client runs its queries on whichever backend the configuration selects
+# the blocking calls run in worker threads so the event loop is never blocked
+class BlockingPool:
+    def __init__(self):
+        self.pool = SQLConnectionPool(SQLConnectionPool.load_config(), max_size=2)
+        self.minsize = self.pool.min_size
+        self.maxsize = self.pool.max_size
+        self.closed = False
+
+    @property
+    def size(self):
+        return self.pool.statistics()["size"]
+
+    @property
+    def freesize(self):
+        return self.pool.statistics()["idle"]
+
+    @asynccontextmanager
+    async def acquire(self):
+        database_connection = await asyncio.to_thread(self.pool.acquire)
+        try:
+            yield BlockingConnection(database_connection)
+        finally:
+            await asyncio.to_thread(self.pool.release, database_connection)
+
+    def close(self):
+        self.closed = True
+        self.pool.close()
+
+    async def wait_closed(self):
+        pass
+
+
+class BlockingConnection:
+    def __init__(self, database_connection):
+        self.database_connection = database_connection
+
+    @asynccontextmanager
+    async def cursor(self):
+        yield BlockingCursor(SQLDriver.cursor(self.database_connection))
+
+    async def begin(self):
+        await asyncio.to_thread(SQLDriver.begin, self.database_connection)
+
+    async def commit(self):
+        await asyncio.to_thread(self.database_connection.commit)
+
+    async def rollback(self):
+        await asyncio.to_thread(self.database_connection.rollback)
+
+
+class BlockingCursor:
+    def __init__(self, sql_cursor):
+        self.sql_cursor = sql_cursor
+
+    @property
+    def rowcount(self):
+        return self.sql_cursor.rowcount
+
+    async def execute(self, query, params=()):
+        await asyncio.to_thread(self.sql_cursor.execute, query, params)
+
+    async def fetchall(self):
+        return await asyncio.to_thread(self.sql_cursor.fetchall)
+
+
+class TestCalculator(unittest.IsolatedAsyncioTestCase):
+
+    # run once before all test cases
+    @classmethod
+    def setUpClass(cls):
+        cls.whatabook = Whatabook()
+        cls.default_user_id = 1
+        cls.default_book_id = 1
+
+    # run before each test case
+    async def asyncSetUp(self):
+        self.pool = BlockingPool()
+        # the blocking pool is sent the SQL of the configured backend
+        self.async_whatabook = AsyncWhatabook(self.pool, SQLDriver.backend())
+
+    # run after each test case
+    async def asyncTearDown(self):
+        await self.async_whatabook.close()
+
+    async def test_get_wishlist_books(self):
+        await self.async_whatabook.add_books_to_wishlist(self.default_user_id, [self.default_book_id])
+        result = await self.async_whatabook.get_wishlist_books(self.default_user_id)
+        expected = self.whatabook.get_wishlist_books(self.default_user_id)
+        self.assertEqual(result, expected)
+
+    async def test_add_books_to_wishlist(self):
+        result = await self.async_whatabook.add_books_to_wishlist(
+            self.default_user_id, [self.default_book_id, self.default_book_id]
+        )
+        self.assertIsInstance(result, int)
+
+        with self.assertRaises(InvalidBookError) as context:
+            await self.async_whatabook.add_books_to_wishlist(
+                self.default_user_id, [self.default_book_id, maxsize]
+            )
+        self.assertEqual(context.exception.book_ids, [maxsize])
+
+        with self.assertRaises(InvalidBookError):
+            await self.async_whatabook.add_books_to_wishlist(self.default_user_id, [])
+
+        # the failed transaction handed its connection back
+        self.assertEqual(self.async_whatabook.pool_statistics()["in_use"], 0)
+
+    # the index search pages the same way in both clients
+    async def test_search_books(self):
+        self.async_whatabook.fulltext = False
+        whatabook = Whatabook()
+        whatabook.fulltext = False
+        result = await self.async_whatabook.search_books("dark elf", 2)
+        expected = whatabook.search_books("dark elf", 2)
+        self.assertEqual(
+            [book.book_id for book in result.items], [book.book_id for book in expected.items]
+        )
+        self.assertEqual(result.next_cursor, expected.next_cursor)
+
+    async def test_close(self):
+        pool = BlockingPool()
+        async with AsyncWhatabook(pool, SQLDriver.backend()) as async_whatabook:
+            await async_whatabook.get_books()
+            self.assertFalse(pool.closed)
+        self.assertTrue(pool.closed)
+        self.assertEqual(pool.pool.statistics()["size"], 0)
+
+    # the aiomysql pool gets the MySQL settings and queries whichever backend is configured
+    async def test_create_pool_settings(self):
+        config = ConfigParser()
+        config[SQLConfiguration.CONNECTION_SECTION] = {
+            SQLConfiguration.BACKEND: SQLiteBackend.NAME,
+            SQLConfiguration.HOST: "db.example",
+            SQLConfiguration.PORT: "3307",
+            SQLConfiguration.DATABASE: "whatabook",
+            SQLConfiguration.RAISE_ON_WARNINGS: "true",
+        }
+        environment = {"sql_user": "whatabook_user", "password": "secret"}
+        with patch.object(
+            SQLConfiguration, "load_connection_config", return_value=config["CONNECTION"]
+        ), patch.object(SQLEnvironment, "load", return_value=environment), patch.object(
+            aiomysql, "create_pool", AsyncMock()
+        ) as create_pool:
+            await AsyncWhatabook.create_pool()
+
+        settings = create_pool.call_args.kwargs
+        result = (settings["host"], settings["port"], settings["db"], settings["cursorclass"])
+        self.assertEqual(result, ("db.example", 3307, "whatabook", RaisingCursor))
+
+        async_whatabook = AsyncWhatabook(None)
+        self.assertIn("%s", async_whatabook.query("user_exists").sql)
+        self.assertNotIn("?", async_whatabook.query("user_exists").sql)
+
+    # with RAISE_ON_WARNINGS a statement's warnings are raised instead of only reported
+    async def test_raise_on_warnings(self):
+        class WarningConnection:
+            loop = None
+
+            async def show_warnings(self):
+                return (("Warning", 1265, "Data truncated for column 'details'"),)
+
+        sql_cursor = RaisingCursor(WarningConnection())
+        with self.assertRaises(aiomysql.Warning) as context:
+            await sql_cursor._show_warnings(WarningConnection())
+        self.assertEqual(context.exception.args[0], 1265)
+
+    # the aiomysql pool itself, when the configured database can be reached
+    async def test_create_pool(self):
+        if SQLDriver.backend().NAME == SQLiteBackend.NAME:
+            self.skipTest("aiomysql needs a MySQL database")
+        try:
+            async_whatabook = await asyncio.wait_for(AsyncWhatabook.create(), 10)
+        except (ConfigNotSetError, OSError, aiomysql.Error, asyncio.TimeoutError):
+            self.skipTest("aiomysql can not reach the database")
+
+        async with async_whatabook:
+            self.assertTrue(await async_whatabook.validate_user_id(self.default_user_id))
+        self.assertTrue(async_whatabook.pool.closed)
@@ -0,0 +1,108 @@
+import http.client
+import json
+import threading
+import unittest
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from whatabook import Whatabook
+from whatabook_server import WhatabookHTTPServer, WhatabookRequestHandler
+from sys import maxsize
+
+
+class TestCalculator(unittest.TestCase):
+
+    # run once before all test cases
+    @classmethod
+    def setUpClass(cls):
+        # port 0 lets the operating system pick a free port
+        cls.server = WhatabookHTTPServer(("127.0.0.1", 0), Whatabook(), workers=2)
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}"
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.default_user_id = 1
+        cls.default_book_id = 1
+
+    # run once after all test cases
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.thread.join()
+
+    def request(self, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        request = Request(self.url + path, data, {"Content-Type": "application/json"})
+        try:
+            with urlopen(request, timeout=10) as response:
+                return response.status, json.loads(response.read())
+        except HTTPError as e:
+            with e:
+                return e.code, json.loads(e.read())
+
+    def test_health(self):
+        status, body = self.request("/health")
+        self.assertEqual(status, 200)
+        self.assertEqual(body["status"], "ok")
+
+    def test_books(self):
+        status, body = self.request("/books?page_size=2")
+        self.assertEqual(status, 200)
+        self.assertEqual(len(body["items"]), 2)
+        self.assertIsNotNone(body["next_cursor"])
+
+        status, body = self.request(f"/books?page_size=2&cursor={body['next_cursor']}")
+        self.assertEqual(status, 200)
+        self.assertIsNotNone(body["previous_cursor"])
+
+    def test_books_invalid_page_size(self):
+        status, _ = self.request("/books?page_size=ten")
+        self.assertEqual(status, 400)
+
+    def test_locations(self):
+        status, body = self.request("/locations")
+        self.assertEqual(status, 200)
+        self.assertTrue(body["items"])
+
+    def test_not_found(self):
+        status, _ = self.request("/authors")
+        self.assertEqual(status, 404)
+
+        status, _ = self.request(f"/users/{maxsize}/wishlist")
+        self.assertEqual(status, 404)
+
+    def test_wishlist(self):
+        path = f"/users/{self.default_user_id}/wishlist"
+        status, body = self.request(path, {"book_ids": [self.default_book_id]})
+        self.assertEqual(status, 201)
+
+        status, body = self.request(path + "?page_size=100")
+        self.assertEqual(status, 200)
+        self.assertIsInstance(body["items"], list)
+
+    def test_add_invalid_books(self):
+        path = f"/users/{self.default_user_id}/wishlist"
+        status, _ = self.request(path, {"book_ids": [True]})
+        self.assertEqual(status, 400)
+
+        status, _ = self.request(path, {"book_ids": "1"})
+        self.assertEqual(status, 400)
+
+        status, body = self.request(path, {"book_ids": [maxsize]})
+        self.assertEqual(status, 400)
+        self.assertEqual(body["book_ids"], [maxsize])
+
+    # a negative or oversized Content-Length is refused without reading the body
+    def test_invalid_content_length(self):
+        path = f"/users/{self.default_user_id}/wishlist"
+        for length in ("-1", str(WhatabookRequestHandler.MAX_BODY_BYTES + 1)):
+            connection = http.client.HTTPConnection("127.0.0.1", self.server.server_port, timeout=10)
+            try:
+                connection.putrequest("POST", path)
+                connection.putheader("Content-Type", "application/json")
+                connection.putheader("Content-Length", length)
+                connection.endheaders(b"{}")
+                response = connection.getresponse()
+                self.assertEqual(response.status, 400)
+                self.assertIn("Content-Length", json.loads(response.read())["error"])
+            finally:
+                connection.close()
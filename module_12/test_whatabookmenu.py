@@ -1,5 +1,10 @@
+import io
+import os
+import runpy
+import tempfile
+import time
 import unittest
-from whatabook import WhatabookMenu
+from whatabook import Tracer, WhatabookMenu
 from unittest.mock import patch
 from sys import maxsize
 
@@ -100,6 +105,14 @@ class TestCalculator(unittest.TestCase):
         mock_input.side_effect = test_add_book
         self.whataboookmenu.my_account(self.default_user_id)
 
+    # options added after Main Menu keep the original ones where they were
+    @patch("whatabook.input")
+    def test_my_account_browse_wishlist(self, mock_input):
+        browse_wishlist_option = [4, "q", self.exit_account]
+
+        mock_input.side_effect = browse_wishlist_option
+        self.whataboookmenu.my_account(self.default_user_id)
+
     @patch("whatabook.input")
     def test_main_menu(self, mock_input):
         exit_option = 4
@@ -118,3 +131,79 @@ class TestCalculator(unittest.TestCase):
 
         mock_input.side_effect = add_book_option
         self.whataboookmenu.main_menu()
+
+    # options added after Exit Program keep the original ones where they were
+    @patch("whatabook.input")
+    def test_main_menu_additions(self, mock_input):
+        exit_option = 4
+        browse_books_option = [5, "n", "p", "x", "q", exit_option]
+        search_books_option = [6, "dark elf", "q", exit_option]
+        stats_option = [7, exit_option]
+
+        mock_input.side_effect = browse_books_option
+        self.whataboookmenu.main_menu()
+
+        mock_input.side_effect = search_books_option
+        self.whataboookmenu.main_menu()
+
+        mock_input.side_effect = stats_option
+        self.whataboookmenu.main_menu()
+
+    # the spans of the menu actions start after their input is read
+    @patch("whatabook.input")
+    def test_menu_spans(self, mock_input):
+        prompt_seconds = 0.1
+        exit_option = 4
+        choices = iter([3, self.default_user_id, 1, self.exit_account, 5, "q", exit_option])
+
+        def slow_input(prompt=""):
+            time.sleep(prompt_seconds)
+            return next(choices)
+
+        mock_input.side_effect = slow_input
+        with tempfile.TemporaryDirectory() as directory:
+            tracer = Tracer.start(os.path.join(directory, "trace.json"))
+            try:
+                self.whataboookmenu.main_menu()
+                spans = [event for event in tracer.events() if event["ph"] == "X"]
+            finally:
+                Tracer.close_tracer()
+
+        names = {span["name"] for span in spans}
+        self.assertTrue(
+            {"WhatabookMenu.login", "WhatabookMenu.account_choice", "WhatabookMenu.browse_page"} <= names
+        )
+        self.assertNotIn("WhatabookMenu.my_account", names)
+        self.assertLess(max(span["dur"] for span in spans), prompt_seconds * 1e6)
+
+    # the program started as a script, the way the README runs it
+    def test_run_as_script(self):
+        exit_option = 4
+        choices = [3, self.default_user_id, self.add_book_choice, 1, self.exit_account, exit_option]
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "whatabook.py")
+        with patch("builtins.input", side_effect=choices), patch(
+            "sys.argv", [path]
+        ), patch("sys.stdout", new_callable=io.StringIO) as output:
+            runpy.run_path(path, run_name="__main__")
+        self.assertIn("Successful", output.getvalue())
+        self.assertNotIn("There was an issue logging in", output.getvalue())
+
+    def test_run_batch(self):
+        script = [
+            "# batch test",
+            "view_books",
+            "locations",
+            f"wishlist {self.default_user_id}",
+            '{"command": "add", "args": [1, 1]}',
+            "unknown_command",
+        ]
+        output = io.StringIO()
+        summary = self.whataboookmenu.run_batch(script, output)
+
+        result = (summary["commands"], summary["errors"])
+        expected = (5, 1)
+        self.assertEqual(result, expected)
+
+        result = len(output.getvalue().splitlines())
+        expected = 6
+        self.assertEqual(result, expected)
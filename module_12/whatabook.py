@@ -1,227 +1,201 @@
-import mysql.connector
-import pydantic
+import argparse
+import ast
+import atexit
+import os
+import base64
+import csv
+import heapq
+import json
+import math
+import operator
+import re
+import sys
+import threading
+import time
 from abc import ABC, abstractmethod
-from pydantic import BaseSettings
-from configparser import ConfigParser
-from enum import Enum
+from contextlib import contextmanager
+from whatabook_errors import (
+    ConfigNotSetError,
+    EnviromentNotSetError,
+    IllegalArgumentError,
+    InvalidBookError,
+    InvalidUserError,
+    MigrationError,
+    PoolClosedError,
+    PoolExhaustedError,
+    TableNotFoundError,
+)
+from whatabook_config import (
+    SQLConfiguration,
+    SQLEnvironment,
+)
+from whatabook_db import (
+    MySQLClientBackend,
+    MySQLConnectorBackend,
+    MySQLConnectorCBackend,
+    MySQLConnectorPureBackend,
+    PyMySQLBackend,
+    SQLBackend,
+    SQLConnection,
+    SQLConnectionPool,
+    SQLDriver,
+    SQLQuery,
+    SQLQueryRegistry,
+    SQLReplicaRouter,
+    SQLiteBackend,
+)
+from whatabook_stats import (
+    LatencyHistogram,
+    QueryStatistics,
+    Tracer,
+)
+from whatabook_cache import (
+    CatalogCache,
+    QueryResultCache,
+    UserIdCache,
+)
+from whatabook_interface import (
+    SQLInterface,
+    SQLTransaction,
+)
+from whatabook_migrate import (
+    SQLMigration,
+    SQLMigrator,
+)
 
 """
-    Title: pysports_queries.py
+    Title: whatabook.py
     Author: Patrick Loyd
     Date: Dec 8 2022
-    Description: Whatabook program
+    Description: Whatabook program, the documents, the Whatabook client, its menu and the command line.
+        The database, cache, statistics and migration infrastructure lives in the whatabook_*.py modules
+        and is imported here so `from whatabook import ...` keeps working
 """
 
-# Custom errors for common mistakes in program
-
-
-class EnviromentNotSetError(Exception):
-    def __init__(self, message="Environment variables not set"):
-        super().__init__(message)
-
-
-class ConfigNotSetError(Exception):
-    def __init__(self, message="Configuration not set"):
-        super().__init__(message)
-
-
-class TableNotFoundError(Exception):
-    def __init__(self, table_name):
-        self.table_name = table_name
-        message = f"{self.table_name} table not found"
-        super().__init__(message)
 
+# Whatabook database documents
+# Documents are __slots__ rows built straight from the cursor tuples, nothing is formatted until format()
+# BANNER_FIELDS maps every banner a document can be shown with to the attributes it formats, in order
+class Document(ABC):
+    __slots__ = ("banner",)
 
-class IllegalArgumentError(ValueError):
-    def __init__(self, message="Invalid Choice for Menu"):
-        super().__init__(message)
+    BANNER_FIELDS = {}
 
+    # (document class, banner) -> compiled formatter, filled the first time the pair is formatted
+    _formatters = {}
 
-class InvalidUserError(Exception):
-    def __init__(self, message="Invalid User"):
-        super().__init__(message)
+    def __init__(self, banner=None):
+        self.banner = banner
 
+    @staticmethod
+    @abstractmethod
+    def to_object(query_table):
+        pass
 
-# Manages environment vairavles
-# use pydantic to get username and password environment vairavles.
-# using environment vairables adds an extra layer of security
-# must set environment variables locally either using shell/terminal or a .env file
-# using a .env file is recommended
-class SQLEnvironment(BaseSettings):
-    sql_user: str
-    password: str
+    # compiles a banner once per class into a function of the document
+    @classmethod
+    def formatter(cls, banner):
+        key = (cls, banner)
+        formatter = Document._formatters.get(key)
+        if formatter is None:
+            formatter = cls.compile(banner)
+            Document._formatters[key] = formatter
+        return formatter
 
-    class Config:
-        env_file = ".env"
+    @classmethod
+    def compile(cls, banner):
+        if banner is None:
+            return lambda document: "\n"
 
+        template = WhatabookBanners.get(banner).format
+        fields = cls.BANNER_FIELDS[banner]
+        values = operator.attrgetter(*fields)
+        if len(fields) == 1:
+            return lambda document: template(values(document)) + "\n"
+        return lambda document: template(*values(document)) + "\n"
 
-# Manages the connection and sql query configurations
-# The configuration file will auto-generate if it is not found
-# The default configurations should work for this project as long as the database is set up correctly
-class SQLConfiguration:
+    def format(self):
+        return self.formatter(self.banner)(self)
 
-    CONNECTION_SECTION = "CONNECTION"
-    QUERY_SECTION = "QUERIES"
-    BANNER_SECTION = "BANNERS"
-    FILE = "config.ini"
 
-    HOST = "HOST"
-    DATABASE = "DATABASE"
-    RAISE_ON_WARNINGS = "RAISE_ON_WARNINGS"
+# Listing headings
+BOOK_LISTING = "-- DISPLAYING BOOK LISTING --\n"
+STORE_LISTING = "-- DISPLAYING STORE LOCATIONS --\n"
+WISHLIST_LISTING = "-- DISPLAYING WISHLIST ITEMS --\n"
+AVAILABLE_LISTING = "-- DISPLAYING AVAILABLE BOOKS --\n"
+SEARCH_LISTING = "-- DISPLAYING SEARCH RESULTS --\n"
+RECOMMENDED_LISTING = "-- CUSTOMERS WHO WISHLISTED YOUR BOOKS ALSO WISHLISTED --\n"
 
-    @classmethod
-    def create_config(cls):
-        with open("config.txt") as config_handle:
-            config_content = config_handle.read()
 
-            with open(".config", "w") as config_file:
-                config_file.write(config_content)
+# Loads the banners once from the BANNERS section of the configuration file
+# Banners are looked up by their lowercase name, for example WhatabookBanners.get("get_books")
+class WhatabookBanners:
 
-    @classmethod
-    def load(cls, section):
-        config = ConfigParser()
-        config.read(cls.FILE)
-        return config[section]
+    GET_BOOKS = "get_books"
+    GET_LOCATIONS = "get_locations"
+    GET_WISHLIST_BOOKS = "get_wishlist_books"
+    GET_BOOKS_TO_ADD = "get_books_to_add"
 
-    @classmethod
-    def load_connection_config(cls):
-        return cls.load(cls.CONNECTION_SECTION)
+    _banners = None
+    _lock = threading.Lock()
 
     @classmethod
-    def load_query_config(cls):
-        return cls.load(cls.QUERY_SECTION)
+    def load(cls):
+        with cls._lock:
+            if cls._banners is None:
+                try:
+                    sql_banners = SQLConfiguration.load_banner_config()
+                except KeyError:
+                    raise ConfigNotSetError
+
+                cls._banners = {
+                    name: ast.literal_eval(banner) for name, banner in sql_banners.items()
+                }
+            return cls._banners
 
     @classmethod
-    def load_banner_config(cls):
-        return cls.load(cls.BANNER_SECTION)
-
-
-class SQLQueryCommands(Enum):
-    try:
-        sql_queries = SQLConfiguration.load_query_config()
-    except KeyError:
-        raise ConfigNotSetError
-
-    get_books = eval(sql_queries["GET_BOOKS"])
-    get_locations = eval(sql_queries["GET_LOCATIONS"])
-    get_total_users = eval(sql_queries["GET_TOTAL_USERS"])
-    get_wishlist_books = eval(sql_queries["GET_WISHLIST_BOOKS"])
-    get_books_to_add = eval(sql_queries["GET_BOOKS_TO_ADD"])
-    add_book_to_wishlist = eval(sql_queries["ADD_BOOK_TO_WISHLIST"])
-
-
-# Context manager that will make a connection to the database on entry and close the connection on exit using the configuration file
-class SQLConnection:
-    def __init__(self):
+    def get(cls, name):
         try:
-            self.connection_config = SQLConfiguration.load_connection_config()
+            return cls.load()[name]
         except KeyError:
-            raise ConfigNotSetError
-
-        try:
-            self.env = SQLEnvironment().dict()
-        except pydantic.error_wrappers.ValidationError:
-            raise EnviromentNotSetError
-
-        self.config = {
-            "user": self.env["sql_user"],
-            "password": self.env["password"],
-            "host": self.connection_config[SQLConfiguration.HOST],
-            "database": self.connection_config[SQLConfiguration.DATABASE],
-            "raise_on_warnings": self.connection_config.getboolean(
-                SQLConfiguration.RAISE_ON_WARNINGS
-            ),
-        }
-
-    def __enter__(self):
-        self.db = mysql.connector.connect(**self.config)
-        return self.db
-
-    def __exit__(self, exc_type, exc_value, exc_traceback):
-        self.db.close()
-
-
-# Manage interfacing with the database
-class SQLInterface:
-    def __init__(self):
-        pass
-
-    from abc import ABC, abstractmethod
-
-    def fetch(self, query):
-        with SQLConnection() as database_connection:
-            sql_cursor = database_connection.cursor()
-            sql_cursor.execute(query)
-            return sql_cursor.fetchall()
-
-    def commit(self, query, data):
-        with SQLConnection() as database_connection:
-            sql_cursor = database_connection.cursor()
-            sql_cursor.execute(query, data)
-            database_connection.commit()
-
-    def insert(self, query):
-        with SQLConnection() as database_connection:
-            sql_cursor = database_connection.cursor()
-            sql_cursor.execute(query)
-            database_connection.commit()
-
-
-# Whatabook database documents
-class Document(ABC):
-    def __init__(self, banner, *values):
-        self.format_string = banner.format(*values)
-
-    @staticmethod
-    @abstractmethod
-    def to_object(query_table):
-        pass
-
-    def format(self):
-        return self.format_string + "\n"
-
-
-class WhatabookBanners(Enum):
-    try:
-        sql_banners = SQLConfiguration.load_banner_config()
-    except KeyError:
-        raise ConfigNotSetError
-
-    get_books = eval(sql_banners["GET_BOOKS"])
-    get_locations = eval(sql_banners["GET_LOCATIONS"])
-    get_wishlist_books = eval(sql_banners["GET_WISHLIST_BOOKS"])
-    get_books_to_add = eval(sql_banners["GET_BOOKS_TO_ADD"])
+            raise ConfigNotSetError(f"Banner {name} not set")
 
 
 class User(Document):
-    def __init__(self, first_name, last_name, user_id=None, banner=""):
+    __slots__ = ("first_name", "last_name", "user_id")
+
+    def __init__(self, first_name, last_name, user_id=None, banner=None):
+        super().__init__(banner)
         self.first_name = first_name
         self.last_name = last_name
         self.user_id = user_id
-        super().__init__(banner, self.first_name, self.last_name)
 
     @staticmethod
     def to_object(query_table):
         (user_id, first_name, last_name) = query_table
         return User(first_name, last_name, user_id)
 
-    def format(self):
-        return super().format()
-
 
 class Book(Document):
+    __slots__ = ("book_name", "author", "details", "book_id")
+
+    # banners a book can be formatted with
+    GET_BOOKS = WhatabookBanners.GET_BOOKS
+    GET_WISHLIST_BOOKS = WhatabookBanners.GET_WISHLIST_BOOKS
+    BOOKS_TO_ADD = WhatabookBanners.GET_BOOKS_TO_ADD
 
-    # set raw strings for book to be formatted
-    GET_BOOKS = WhatabookBanners.get_books.value
-    GET_WISHLIST_BOOKS = WhatabookBanners.get_wishlist_books.value
-    BOOKS_TO_ADD = WhatabookBanners.get_books_to_add.value
+    BANNER_FIELDS = {
+        GET_BOOKS: ("book_name", "author", "details"),
+        GET_WISHLIST_BOOKS: ("book_name", "author"),
+        BOOKS_TO_ADD: ("book_id", "book_name", "author", "details"),
+    }
 
     def __init__(self, book_name, author, details, book_id=None, banner=GET_BOOKS):
+        super().__init__(banner)
         self.book_name = book_name
         self.author = author
         self.details = details
         self.book_id = book_id
-        super().__init__(self.book_name, self.author, self.details, banner)
 
     @staticmethod
     def to_object(query_table):
@@ -233,119 +207,1101 @@ class Book(Document):
         (_, _, _, book_id, book_name, author, details) = query_table
         return Book(book_name, author, details, book_id, Book.GET_WISHLIST_BOOKS)
 
+    @staticmethod
+    def wishlist_entry(query_table):
+        (_, book_id, book_name, author, details) = query_table
+        return Book(book_name, author, details, book_id, Book.GET_WISHLIST_BOOKS)
+
     @staticmethod
     def available_books(query_table):
         (book_id, book_name, author, details) = query_table
         return Book(book_name, author, details, book_id, Book.BOOKS_TO_ADD)
 
-    def format(self):
-        return super().format()
+    # search results show the book id so the book can be added to a wishlist
+    @staticmethod
+    def search_result(query_table):
+        (book_id, book_name, author, details, _) = query_table
+        return Book(book_name, author, details, book_id, Book.BOOKS_TO_ADD)
+
+    def to_dict(self):
+        return {
+            "book_id": self.book_id,
+            "book_name": self.book_name,
+            "author": self.author,
+            "details": self.details,
+        }
 
 
 class Wishlist(Document):
-    def __init__(self, user_id, book_id, wishlist_id=None, banner=""):
+    __slots__ = ("user_id", "book_id", "wishlist_id")
+
+    def __init__(self, user_id, book_id, wishlist_id=None, banner=None):
+        super().__init__(banner)
         self.user_id = user_id
         self.book_id = book_id
         self.wishlist_id = wishlist_id
-        super().__init__(banner, self.user_id, self.book_id)
 
     @staticmethod
     def to_object(query_table):
         (user_id, book_id, wishlist_id) = query_table
         return Wishlist(user_id, book_id, wishlist_id)
 
-    def format(self):
-        return super().format()
-
 
 class Store(Document):
-    BANNER = WhatabookBanners.get_locations.value
+    __slots__ = ("locale", "store_id")
+
+    BANNER = WhatabookBanners.GET_LOCATIONS
+
+    BANNER_FIELDS = {BANNER: ("locale",)}
 
     def __init__(self, locale, store_id=None, banner=BANNER):
+        super().__init__(banner)
         self.locale = locale
         self.store_id = store_id
-        super().__init__(banner, self.locale)
 
     @staticmethod
     def to_object(query_table):
         (store_id, locale) = query_table
         return Store(locale, store_id)
 
-    def format(self):
-        return super().format()
+    def to_dict(self):
+        return {"store_id": self.store_id, "locale": self.locale}
+
+
+# Local SQLite copy of the catalog, the users and the wishlists, kept in PATH of the OFFLINE section
+# Whatabook reads from it when the database can not be reached or does not hand out a connection in time,
+# and with LOCAL_READS it also serves the book and store listings while it is at most MAX_STALENESS seconds old
+# A background thread syncs it every SYNC_INTERVAL seconds, book and store are copied again when their
+# catalog_version changed, users and wishlists are copied from the highest key synced so far
+# and rows deleted from those two tables stay in the replica
+# Wishlist writes made while offline are added to the replica and queued in the file,
+# the next sync replays them before it copies anything and then the replica is online again
+class OfflineReplica:
+
+    SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "whatabook_offline.sql")
+    # tables copied whole when their catalog version changes, table -> (query reading it, insert)
+    CATALOG_TABLES = {
+        "book": (
+            "get_books",
+            "INSERT INTO book(book_id, book_name, author, details) VALUES(?, ?, ?, ?)",
+        ),
+        "store": ("get_locations", "INSERT INTO store(store_id, locale) VALUES(?, ?)"),
+    }
+    # tables that are only added to, copied a batch at a time from the highest key synced
+    # a synced row replaces the row added to the replica for the same key or wishlist entry while offline
+    APPENDED_TABLES = {
+        "user": (
+            "get_users_after",
+            "INSERT OR REPLACE INTO user(user_id, first_name, last_name) VALUES(?, ?, ?)",
+        ),
+        "wishlist": (
+            "get_wishlist_after",
+            "INSERT OR REPLACE INTO wishlist(wishlist_id, user_id, book_id) VALUES(?, ?, ?)",
+        ),
+    }
+    # catalog reads served from the replica with LOCAL_READS
+    LOCAL_QUERIES = frozenset(
+        {"get_books", "get_locations", "get_books_page", "get_books_page_before"}
+    )
+    # seconds close() waits for a sync in progress
+    CLOSE_TIMEOUT = 10
+
+    _replica = None
+    _replica_lock = threading.Lock()
+
+    def __init__(
+        self,
+        path,
+        sync_interval=30,
+        max_staleness=300,
+        local_reads=False,
+        batch_size=SQLInterface.BATCH_SIZE,
+    ):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.max_staleness = max_staleness
+        self.local_reads = local_reads
+        self.batch_size = batch_size
+        self.backend = SQLiteBackend(self.SCHEMA)
+        # set when the database can not be reached, cleared by the next complete sync
+        self.offline = False
+        self.last_error = None
+        # one connection per thread, readers are not blocked by a sync in progress
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {
+            "reads": 0,
+            "syncs": 0,
+            "failed_syncs": 0,
+            "copied_rows": 0,
+            "queued": 0,
+            "replayed": 0,
+            "rejected": 0,
+        }
+        # seconds since the epoch of the last complete sync, kept in the file so it outlives restarts
+        self.synced_at = self.read_synced_at()
+
+    @classmethod
+    def from_config(cls):
+        try:
+            offline_config = SQLConfiguration.load_offline_config()
+        except KeyError:
+            return None
+
+        if not offline_config.getboolean(SQLConfiguration.ENABLED, False):
+            return None
+
+        return cls(
+            offline_config.get(SQLConfiguration.PATH, "whatabook_offline.sqlite3"),
+            sync_interval=offline_config.getfloat(SQLConfiguration.SYNC_INTERVAL, 30),
+            max_staleness=offline_config.getfloat(SQLConfiguration.MAX_STALENESS, 300),
+            local_reads=offline_config.getboolean(SQLConfiguration.LOCAL_READS, False),
+        )
+
+    # the process-wide replica, None when it is turned off
+    @classmethod
+    def get_replica(cls):
+        replica = cls._replica
+        if replica is None:
+            with cls._replica_lock:
+                if cls._replica is None:
+                    # False marks the replica as off so the configuration is only read once
+                    cls._replica = cls.from_config() or False
+                replica = cls._replica
+        return replica or None
+
+    @classmethod
+    def close_replica(cls):
+        with cls._replica_lock:
+            replica, cls._replica = cls._replica, None
+        if replica:
+            replica.close()
+
+    def connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self.backend.connect({"database": self.path})
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        connection = self.connection()
+        self.backend.begin(connection)
+        try:
+            yield connection
+        except Exception:
+            connection.rollback()
+            raise
+        connection.commit()
+
+    def read_synced_at(self):
+        rows = self.connection().execute("SELECT synced_at FROM replica_table").fetchall()
+        if not rows or any(synced_at is None for (synced_at,) in rows):
+            return None
+        return min(synced_at for (synced_at,) in rows)
+
+    # seconds since the last complete sync, None before the first one
+    def staleness(self):
+        if self.synced_at is None:
+            return None
+        return max(0.0, time.time() - self.synced_at)
+
+    # whether a read of the query goes to the replica instead of the database
+    def serves(self, query):
+        if self.synced_at is None:
+            return False
+        if self.offline:
+            return True
+        return (
+            self.local_reads
+            and QueryStatistics.name_of(query) in self.LOCAL_QUERIES
+            and self.staleness() <= self.max_staleness
+        )
+
+    # called with the error of a read or write on the database, returns whether the replica takes over
+    # it only does when the database could not be reached and the replica has been synced
+    def fail(self, error):
+        if self.synced_at is None:
+            return False
+        if not isinstance(error, PoolExhaustedError) and not SQLDriver.unreachable(error):
+            return False
+        self.offline = True
+        self.last_error = f"{type(error).__name__}: {error}"
+        return True
+
+    # runs the replica's version of a named query
+    @Tracer.traced
+    def fetch(self, query, params=()):
+        query = SQLQueryRegistry.get(QueryStatistics.name_of(query), self.backend)
+        rows = self.connection().execute(query.sql, params).fetchall()
+        self._count("reads")
+        return rows
+
+    # adds the books to the wishlist in the replica and queues the write for the database
+    # returns the number of books added, nothing is added if any of them is not in the replica's catalog
+    @Tracer.traced
+    def queue_books(self, user_id, book_ids):
+        book_ids_json = json.dumps(book_ids)
+        with self.transaction() as connection:
+            query = SQLQueryRegistry.get("get_existing_book_ids", self.backend)
+            existing = {
+                book_id for (book_id,) in connection.execute(query.sql, (book_ids_json,))
+            }
+            missing = [book_id for book_id in book_ids if book_id not in existing]
+            if missing:
+                raise InvalidBookError(missing)
+
+            query = SQLQueryRegistry.get("add_books_to_wishlist", self.backend)
+            added = connection.execute(query.sql, (user_id, book_ids_json)).rowcount
+            connection.execute(
+                "INSERT INTO pending_write(user_id, book_ids, queued_at) VALUES(?, ?, ?)",
+                (user_id, book_ids_json, time.time()),
+            )
+        self._count("queued")
+        return added
+
+    # copies a write the database accepted so the wishlist reads of the replica see it straight away
+    # a write that can not get the file is left to the next sync
+    def record_books(self, user_id, book_ids):
+        if self.synced_at is None:
+            return
+        query = SQLQueryRegistry.get("add_books_to_wishlist", self.backend)
+        try:
+            with self.transaction() as connection:
+                connection.execute(query.sql, (user_id, json.dumps(book_ids)))
+        except self.backend.error():
+            pass
+
+    def pending_writes(self):
+        ((pending,),) = self.connection().execute(
+            "SELECT COUNT(*) FROM pending_write"
+        ).fetchall()
+        return pending
+
+    # one complete sync, returns whether it succeeded and the replica is online
+    # the queued writes are replayed through whatabook and the tables read with a reader
+    # that does not go through its result cache
+    @Tracer.traced
+    def sync(self, whatabook):
+        with self._sync_lock:
+            started = time.time()
+            reader = SQLInterface(stats=whatabook.stats, batch_size=self.batch_size)
+            try:
+                self.replay(whatabook)
+                copied = 0
+                for table in self.CATALOG_TABLES:
+                    copied += self.sync_catalog(reader, table, started)
+                for table in self.APPENDED_TABLES:
+                    copied += self.sync_appended(reader, table, started)
+            except Exception as e:
+                self._count("failed_syncs")
+                if not self.fail(e):
+                    self.last_error = f"{type(e).__name__}: {e}"
+                return False
+
+            self.synced_at = started
+            self.offline = False
+            self.last_error = None
+            with self._lock:
+                self._stats["syncs"] += 1
+                self._stats["copied_rows"] += copied
+            return True
+
+    # a write the database refuses, for example because a book was removed while offline, is dropped
+    def replay(self, whatabook):
+        connection = self.connection()
+        pending = connection.execute(
+            "SELECT write_id, user_id, book_ids FROM pending_write ORDER BY write_id"
+        ).fetchall()
+        for write_id, user_id, book_ids in pending:
+            book_ids = json.loads(book_ids)
+            try:
+                whatabook.write_books_to_wishlist(user_id, book_ids)
+                whatabook.record_wishlist(user_id, book_ids)
+                self._count("replayed")
+            except InvalidBookError:
+                self._count("rejected")
+            except SQLDriver.error() as e:
+                if SQLDriver.unreachable(e):
+                    raise
+                self._count("rejected")
+            with self.transaction() as connection:
+                connection.execute("DELETE FROM pending_write WHERE write_id = ?", (write_id,))
+
+    # the version is read before the rows so a concurrent change is copied by the next sync
+    # a table without a version is copied every time
+    def sync_catalog(self, reader, table, started):
+        version = CatalogCache.version(reader, table)
+        ((synced_version,),) = self.connection().execute(
+            "SELECT version FROM replica_table WHERE table_name = ?", (table,)
+        ).fetchall()
+        if version is not None and version == synced_version:
+            with self.transaction() as connection:
+                connection.execute(
+                    "UPDATE replica_table SET synced_at = ? WHERE table_name = ?",
+                    (started, table),
+                )
+            return 0
+
+        query_name, insert = self.CATALOG_TABLES[table]
+        rows = reader.iterate(SQLQueryRegistry.get(query_name))
+        with self.transaction() as connection:
+            connection.execute(f"DELETE FROM {table}")
+            copied = connection.executemany(insert, rows).rowcount
+            connection.execute(
+                "UPDATE replica_table SET version = ?, row_count = ?, synced_at = ? "
+                "WHERE table_name = ?",
+                (version, copied, started, table),
+            )
+        return copied
+
+    def sync_appended(self, reader, table, started):
+        query_name, insert = self.APPENDED_TABLES[table]
+        query = SQLQueryRegistry.get(query_name)
+        ((last_key,),) = self.connection().execute(
+            "SELECT last_key FROM replica_table WHERE table_name = ?", (table,)
+        ).fetchall()
+
+        copied = 0
+        while True:
+            rows = reader.fetch(query, (last_key, self.batch_size))
+            if rows:
+                last_key = rows[-1][0]
+            with self.transaction() as connection:
+                connection.executemany(insert, rows)
+                connection.execute(
+                    "UPDATE replica_table SET last_key = ?, row_count = row_count + ?, "
+                    "synced_at = ? WHERE table_name = ?",
+                    (last_key, len(rows), started, table),
+                )
+            copied += len(rows)
+            if len(rows) < self.batch_size:
+                return copied
+
+    # syncs in the background until close(), the first sync starts straight away
+    def start(self, whatabook):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self.run, args=(whatabook,), name="whatabook-offline-sync", daemon=True
+                )
+                self._thread.start()
+
+    def run(self, whatabook):
+        while not self._stop.is_set():
+            self.sync(whatabook)
+            self._stop.wait(self.sync_interval)
+
+    def close(self):
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(self.CLOSE_TIMEOUT)
+            if thread.is_alive():
+                return
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            try:
+                connection.close()
+            except self.backend.error():
+                pass
+
+    # the line shown above the menu while reads are served from the replica
+    def status_line(self):
+        synced_at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.synced_at))
+        return (
+            f"Offline: showing data as of {synced_at} ({self.staleness() / 60:.0f} minutes old), "
+            f"{self.pending_writes()} wishlist changes waiting for the database"
+        )
+
+    def statistics(self):
+        with self._lock:
+            stats = dict(self._stats)
+        rows = self.connection().execute(
+            "SELECT table_name, version, last_key, row_count, synced_at FROM replica_table"
+        ).fetchall()
+        stats["tables"] = {
+            table: {
+                "version": version,
+                "last_key": last_key,
+                "rows": row_count,
+                "synced_at": synced_at,
+            }
+            for table, version, last_key, row_count, synced_at in rows
+        }
+        stats["offline"] = self.offline
+        stats["local_reads"] = self.local_reads
+        stats["synced_at"] = self.synced_at
+        stats["staleness_seconds"] = self.staleness()
+        stats["pending_writes"] = self.pending_writes()
+        stats["last_error"] = self.last_error
+        return stats
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+
+atexit.register(OfflineReplica.close_replica)
+
+
+# In-process inverted index over the book catalog, ranked with BM25
+# Used when the FULLTEXT index is turned off or can not be used,
+# for example on a backend without MySQL full text search or before migration 4 is applied
+class BookSearchIndex:
+
+    TOKEN = re.compile(r"\w+")
+    # BM25 term frequency saturation and document length normalisation
+    K1 = 1.2
+    B = 0.75
+
+    # version is the book table's catalog_version the index was built from, when it is known
+    def __init__(self, books, version=None):
+        self.books = books
+        self.version = version
+        self._documents = {}
+        # token -> {book_id: occurrences of the token in the book}
+        self._postings = {}
+        self._lengths = {}
+        self._total_length = 0
+        for book in books:
+            self.add(book)
+
+    @classmethod
+    def tokenize(cls, text):
+        return cls.TOKEN.findall(text.lower()) if text else []
+
+    def add(self, book):
+        tokens = (
+            self.tokenize(book.book_name)
+            + self.tokenize(book.author)
+            + self.tokenize(book.details)
+        )
+        self._documents[book.book_id] = book
+        self._lengths[book.book_id] = len(tokens)
+        self._total_length += len(tokens)
+        for token in tokens:
+            postings = self._postings.setdefault(token, {})
+            postings[book.book_id] = postings.get(book.book_id, 0) + 1
+
+    # returns the best limit books for the terms, highest score first and then by book id
+    def search(self, terms, limit):
+        if not self._documents:
+            return []
+
+        documents = len(self._documents)
+        average_length = self._total_length / documents or 1
+        scores = {}
+        for token in set(self.tokenize(terms)):
+            postings = self._postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (documents - len(postings) + 0.5) / (len(postings) + 0.5))
+            for book_id, frequency in postings.items():
+                length = self.K1 * (1 - self.B + self.B * self._lengths[book_id] / average_length)
+                score = idf * frequency * (self.K1 + 1) / (frequency + length)
+                scores[book_id] = scores.get(book_id, 0.0) + score
+
+        ranked = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [self._documents[book_id] for book_id, _ in ranked]
+
+
+# One page of a keyset (seek) paginated listing
+# Cursors are opaque strings holding the direction and the last key seen,
+# pass next_cursor or previous_cursor back to read the neighbouring page
+class Page:
+
+    AFTER = "after"
+    BEFORE = "before"
+
+    def __init__(self, items, next_cursor=None, previous_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @staticmethod
+    def encode_cursor(direction, key):
+        return base64.urlsafe_b64encode(f"{direction}:{key}".encode()).decode()
+
+    # no cursor starts at the first page
+    @classmethod
+    def decode_cursor(cls, cursor):
+        if cursor is None:
+            return cls.AFTER, 0
+        try:
+            direction, key = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+            key = int(key)
+        except ValueError:
+            raise IllegalArgumentError("Invalid page cursor")
+        if direction not in (cls.AFTER, cls.BEFORE):
+            raise IllegalArgumentError("Invalid page cursor")
+        return direction, key
+
+    # builds a page from up to page_size + 1 rows read in the cursor's direction
+    # the extra row only tells whether there is another page
+    @classmethod
+    def from_rows(cls, table, direction, cursor, page_size, to_object):
+        has_more = len(table) > page_size
+        table = list(table[:page_size])
+        if direction == cls.BEFORE:
+            table.reverse()
+
+        if not table:
+            return cls([])
+
+        first_key, last_key = table[0][0], table[-1][0]
+        if direction == cls.AFTER:
+            next_cursor = cls.encode_cursor(cls.AFTER, last_key) if has_more else None
+            previous_cursor = (
+                cls.encode_cursor(cls.BEFORE, first_key) if cursor is not None else None
+            )
+        else:
+            next_cursor = cls.encode_cursor(cls.AFTER, last_key)
+            previous_cursor = cls.encode_cursor(cls.BEFORE, first_key) if has_more else None
+        return cls([to_object(row) for row in table], next_cursor, previous_cursor)
+
+    # builds a page of a ranked listing where the cursor key is the offset of the first item
+    # items holds up to page_size + 1 items read from offset
+    @classmethod
+    def from_offset(cls, items, offset, page_size):
+        next_cursor = (
+            cls.encode_cursor(cls.AFTER, offset + page_size) if len(items) > page_size else None
+        )
+        previous_cursor = (
+            cls.encode_cursor(cls.AFTER, max(0, offset - page_size)) if offset else None
+        )
+        return cls(items[:page_size], next_cursor, previous_cursor)
 
 
 class Whatabook(SQLInterface):
-    def __init__(self):
-        super().__init__()
 
+    PAGE_SIZE = 10
+
+    # MySQL error raised by MATCH when there is no FULLTEXT index on the columns
+    FULLTEXT_INDEX_MISSING = 1191
+
+    CSV = "csv"
+    JSON_LINES = "jsonl"
+    # table -> query and column names of the exported rows
+    EXPORTS = {
+        "books": ("get_books", ("book_id", "book_name", "author", "details")),
+        "locations": ("get_locations", ("store_id", "locale")),
+        "wishlists": ("get_wishlist_pairs", ("user_id", "book_id")),
+    }
+
+    # sync_replica=False leaves the offline replica to the caller, such as the sync command
+    def __init__(self, sync_replica=True):
+        super().__init__(
+            result_cache=QueryResultCache.from_config(),
+            stats=QueryStatistics.from_config(),
+            batch_size=self.stream_batch_size(),
+        )
+        self.user_ids = UserIdCache.from_config()
+        self.catalog_cache = CatalogCache.from_config()
+        self.fulltext = self.fulltext_enabled() and SQLDriver.backend().FULLTEXT
+        self._search_index = None
+        self._books_by_id = None
+        self.recommend = self.recommend_enabled()
+        self._recommendations = None
+        self._recommendations_lock = threading.Lock()
+        self.offline_replica = OfflineReplica.get_replica()
+        if self.offline_replica is not None and sync_replica:
+            self.offline_replica.start(self)
+
+    @staticmethod
+    def fulltext_enabled():
+        try:
+            search_config = SQLConfiguration.load_search_config()
+        except KeyError:
+            return True
+        return search_config.getboolean(SQLConfiguration.FULLTEXT, True)
+
+    @staticmethod
+    def stream_batch_size():
+        try:
+            stream_config = SQLConfiguration.load_stream_config()
+        except KeyError:
+            return SQLInterface.BATCH_SIZE
+        return stream_config.getint(SQLConfiguration.BATCH_SIZE, SQLInterface.BATCH_SIZE)
+
+    @staticmethod
+    def recommend_enabled():
+        try:
+            recommend_config = SQLConfiguration.load_recommend_config()
+        except KeyError:
+            return False
+        return recommend_config.getboolean(SQLConfiguration.ENABLED, False)
+
+    # whether reads are being served from the offline replica because the database can not be reached
+    def is_offline(self):
+        return self.offline_replica is not None and self.offline_replica.offline
+
+    # answered by the offline replica when it serves the query or when the database can not be reached
+    def read_rows(self, query, params=(), session=None):
+        replica = self.offline_replica
+        if replica is None:
+            return self.fetch(query, params, session)
+        if replica.serves(query):
+            return replica.fetch(query, params)
+        try:
+            return self.fetch(query, params, session)
+        except Exception as e:
+            if not replica.fail(e):
+                raise
+            return replica.fetch(query, params)
+
+    # iterate() with the same fallback, the replica only takes over before the first row
+    # so a listing is never partly read from both
+    def iterate_rows(self, query, params=(), session=None):
+        replica = self.offline_replica
+        if replica is None:
+            yield from self.iterate(query, params, session)
+            return
+        if replica.serves(query):
+            yield from replica.fetch(query, params)
+            return
+
+        started = False
+        try:
+            for row in self.iterate(query, params, session):
+                started = True
+                yield row
+        except Exception as e:
+            if started or not replica.fail(e):
+                raise
+            yield from replica.fetch(query, params)
+
+    # the catalog cache is skipped while offline, its version checks would only fail
+    @Tracer.traced
+    def read_catalog(self, table, load):
+        if self.catalog_cache is None or self.is_offline():
+            return load()
+        return self.catalog_cache.get(self, table, load)
+
+    # must be called by anything that changes the book or store tables
+    def invalidate_catalog(self, *tables):
+        if self.catalog_cache is not None:
+            self.catalog_cache.invalidate(*tables)
+
+    @Tracer.traced
+    def load_books(self):
+        query = SQLQueryRegistry.get("get_books")
+        return [Book.to_object(book) for book in self.read_rows(query)]
+
+    @Tracer.traced
+    def load_locations(self):
+        query = SQLQueryRegistry.get("get_locations")
+        return [Store.to_object(store) for store in self.read_rows(query)]
+
+    @Tracer.traced
+    def load_books_to_add(self, user_id):
+        query = SQLQueryRegistry.get("get_books_to_add")
+        table = self.read_rows(query, (user_id,), session=user_id)
+        return [Book.available_books(book) for book in table]
+
+    # yields the heading followed by one rendered chunk per row as the rows arrive
+    @staticmethod
+    def render_rows(table_name, heading, rows, render_row):
+        empty = True
+        for row in rows:
+            if empty:
+                yield heading
+                empty = False
+            yield render_row(row)
+        if empty:
+            raise TableNotFoundError(table_name)
+
+    # render_rows with the time spent formatting rows recorded as the render phase of the named query
+    # the time spent reading the rows is left to the query's own fetch phase
+    def render_listing(self, name, table_name, heading, rows, render_row):
+        stats = self.stats
+        if stats is None:
+            yield from self.render_rows(table_name, heading, rows, render_row)
+            return
+
+        rendering = 0.0
+
+        def timed_render_row(row):
+            nonlocal rendering
+            start = time.perf_counter()
+            try:
+                return render_row(row)
+            finally:
+                rendering += time.perf_counter() - start
+
+        yield from self.render_rows(table_name, heading, rows, timed_render_row)
+        stats.record_phase(name, stats.RENDER, rendering)
+
+    # the listings are streamed from the server a batch at a time instead of reading the whole table first
+    def stream_books(self):
+        rows = self.stream_catalog("book", SQLQueryRegistry.get("get_books"), Book.to_object)
+        return self.render_listing("get_books", "book", BOOK_LISTING, rows, Book.format)
+
+    def stream_locations(self):
+        rows = self.stream_catalog("store", SQLQueryRegistry.get("get_locations"), Store.to_object)
+        return self.render_listing("get_locations", "store", STORE_LISTING, rows, Store.format)
+
+    # yields the documents of a catalog table as its rows arrive
+    # a table of at most the catalog cache's max_rows is collected on the way for the next listing,
+    # a larger one is never held in memory and is read again every time
+    def stream_catalog(self, table, query, to_object):
+        cache = self.catalog_cache
+        if cache is None or self.is_offline():
+            for row in self.iterate_rows(query):
+                yield to_object(row)
+            return
+
+        documents, version = cache.lookup(self, table)
+        if documents is not None:
+            yield from documents
+            return
+
+        collected = []
+        for row in self.iterate_rows(query):
+            document = to_object(row)
+            if collected is not None:
+                collected.append(document)
+                if len(collected) > cache.max_rows:
+                    collected = None
+            yield document
+        if collected is not None:
+            cache.store(table, collected, version)
+
+    # the whole listing as one string, the menu writes stream_books() out as it is produced instead
+    @Tracer.traced
     def get_books(self):
-        query = SQLQueryCommands.get_books.value
-        table = self.fetch(query)
-        if not table:
-            raise TableNotFoundError("book")
-        results = "-- DISPLAYING BOOK LISTING --\n"
-        for book in table:
-            results += Book.to_object(book).format()
-        return results
+        return "".join(self.stream_books())
 
+    @Tracer.traced
     def get_locations(self):
-        query = SQLQueryCommands.get_locations.value
-        table = self.fetch(query)
-        if not table:
-            raise TableNotFoundError("store")
-        results = "-- DISPLAYING STORE LOCATIONS --\n"
-        for store in table:
-            results += Store.to_object(store).format()
-        return results
+        return "".join(self.stream_locations())
 
+    @Tracer.traced
     def get_total_users(self):
-        query = SQLQueryCommands.get_total_users.value
-        table = self.fetch(query)
+        query = SQLQueryRegistry.get("get_total_users")
+        table = self.read_rows(query)
         if not table:
             raise TableNotFoundError("user")
-        return len(table)
+        ((total_users,),) = table
+        return total_users
 
+    # primary key lookup, a single row at most is sent back
+    @Tracer.traced
+    def user_exists(self, user_id):
+        query = SQLQueryRegistry.get("user_exists")
+        return bool(self.read_rows(query, (user_id,)))
+
+    @Tracer.traced
     def validate_user_id(self, user_id):
-        total_users = self.get_total_users()
-        return True if 1 <= user_id <= total_users else False
+        # user ids are auto incremented from 1
+        if user_id < 1:
+            return False
+
+        if self.user_ids is None:
+            return self.user_exists(user_id)
 
+        if user_id in self.user_ids:
+            return True
+
+        if self.user_ids.refresh_due():
+            self.user_ids.refresh(self)
+            if user_id in self.user_ids:
+                return True
+
+        if self.user_exists(user_id):
+            self.user_ids.add(user_id)
+            return True
+        return False
+
+    def stream_wishlist_books(self, user_id):
+        query = SQLQueryRegistry.get("get_wishlist_books")
+        rows = self.iterate_rows(query, (user_id,), session=user_id)
+        return self.render_listing(
+            query.name,
+            "wishlist",
+            WISHLIST_LISTING,
+            rows,
+            lambda book: Book.wishlist_book(book).format(),
+        )
+
+    def stream_books_to_add(self, user_id):
+        query = SQLQueryRegistry.get("get_books_to_add")
+        rows = self.iterate_rows(query, (user_id,), session=user_id)
+        return self.render_listing(
+            query.name,
+            "book",
+            AVAILABLE_LISTING,
+            rows,
+            lambda book: Book.available_books(book).format(),
+        )
+
+    @Tracer.traced
     def get_wishlist_books(self, user_id):
-        query = SQLQueryCommands.get_wishlist_books.value.format(user_id)
-        table = self.fetch(query)
-        if not table:
-            raise TableNotFoundError("wishlist")
-        results = "-- DISPLAYING WISHLIST ITEMS --\n"
-        for book in table:
-            results += Book.wishlist_book(book).format()
-        return results
+        return "".join(self.stream_wishlist_books(user_id))
 
+    @Tracer.traced
     def get_books_to_add(self, user_id):
-        query = SQLQueryCommands.get_books_to_add.value.format(user_id)
-        table = self.fetch(query)
-        if not table:
-            raise TableNotFoundError("book")
-        results = "-- DISPLAYING AVAILABLE BOOKS --\n"
-        for book in table:
-            results += Book.available_books(book).format()
-        return results
+        return "".join(self.stream_books_to_add(user_id))
+
+    # rows must start with the key column and be ordered by it,
+    # ascending for after_query and descending for before_query
+    # one extra row is read to find out whether there is another page
+    @Tracer.traced
+    def read_page(
+        self, after_query, before_query, params, page_size, cursor, to_object, session=None
+    ):
+        if page_size < 1:
+            raise IllegalArgumentError("Invalid page size")
+
+        direction, last_key = Page.decode_cursor(cursor)
+        query = after_query if direction == Page.AFTER else before_query
+        table = self.read_rows(query, params + (last_key, page_size + 1), session)
+        return Page.from_rows(table, direction, cursor, page_size, to_object)
+
+    @Tracer.traced
+    def get_books_page(self, page_size=PAGE_SIZE, cursor=None):
+        return self.read_page(
+            SQLQueryRegistry.get("get_books_page"),
+            SQLQueryRegistry.get("get_books_page_before"),
+            (),
+            page_size,
+            cursor,
+            Book.to_object,
+        )
+
+    @Tracer.traced
+    def get_wishlist_page(self, user_id, page_size=PAGE_SIZE, cursor=None):
+        return self.read_page(
+            SQLQueryRegistry.get("get_wishlist_page"),
+            SQLQueryRegistry.get("get_wishlist_page_before"),
+            (user_id,),
+            page_size,
+            cursor,
+            Book.wishlist_entry,
+            session=user_id,
+        )
+
+    # the index is built from the cached catalog and rebuilt whenever the catalog is reloaded
+    # without the catalog cache it is kept until the book table's catalog_version changes
+    @Tracer.traced
+    def search_index(self):
+        search_index = self._search_index
+        if self.catalog_cache is None:
+            version = CatalogCache.version(self, "book")
+            if search_index is None or version is None or search_index.version != version:
+                search_index = self._search_index = BookSearchIndex(self.load_books(), version)
+            return search_index
+
+        books = self.read_catalog("book", self.load_books)
+        if search_index is None or search_index.books is not books:
+            search_index = self._search_index = BookSearchIndex(books)
+        return search_index
+
+    # catalog books by id, rebuilt whenever the catalog is reloaded
+    def books_by_id(self):
+        books = self.read_catalog("book", self.load_books)
+        books_by_id = self._books_by_id
+        if books_by_id is None or books_by_id[0] is not books:
+            books_by_id = self._books_by_id = (books, {book.book_id: book for book in books})
+        return books_by_id[1]
+
+    # the engine needs numpy and scipy, recommendations are turned off when they are not installed
+    # it is built from the wishlist table on first use and then kept up to date by the wishlist writes
+    def recommendation_engine(self):
+        if not self.recommend:
+            return None
+
+        with self._recommendations_lock:
+            if self._recommendations is None:
+                try:
+                    from whatabook_recommend import RecommendationEngine
+                except ImportError:
+                    self.recommend = False
+                    return None
+                self._recommendations = RecommendationEngine.from_config().load(self)
+            return self._recommendations
+
+    # books other customers wishlisted along with the books on the user's wishlist
+    @Tracer.traced
+    def load_recommendations(self, user_id, limit=None):
+        engine = self.recommendation_engine()
+        if engine is None:
+            return []
+
+        books = self.books_by_id()
+        return [
+            Book(book.book_name, book.author, book.details, book.book_id, Book.BOOKS_TO_ADD)
+            for book in (
+                books.get(book_id) for book_id, _ in engine.recommend_for_user(user_id, limit)
+            )
+            if book is not None
+        ]
+
+    # a write only updates an engine that is already built, the first build reads it from the table
+    def record_wishlist(self, user_id, book_ids):
+        engine = self._recommendations
+        if engine is not None:
+            for book_id in book_ids:
+                engine.add(user_id, book_id)
+
+    # ranked search over the book name, author and details
+    # pages are read by offset since a ranked listing has no key to seek to
+    @Tracer.traced
+    def search_books(self, terms, page_size=PAGE_SIZE, cursor=None):
+        offset = self.search_offset(terms, page_size, cursor)
+        if self.fulltext and not self.is_offline():
+            query = SQLQueryRegistry.get("search_books")
+            try:
+                table = self.fetch(query, self.search_params(terms, page_size, offset))
+                return self.search_page(table, offset, page_size)
+            except Exception as e:
+                # without the index every search would fail the same way
+                if isinstance(e, SQLDriver.error()) and SQLDriver.errno(e) == self.FULLTEXT_INDEX_MISSING:
+                    self.fulltext = False
+                # the offline replica has no FULLTEXT index, the in-process one is searched instead
+                elif self.offline_replica is None or not self.offline_replica.fail(e):
+                    raise
+
+        return self.search_index_page(self.search_index(), terms, offset, page_size)
+
+    # the search helpers below are shared with AsyncWhatabook
+
+    # checks the search arguments and returns the offset of the page in the ranked results
+    @staticmethod
+    def search_offset(terms, page_size, cursor):
+        if page_size < 1:
+            raise IllegalArgumentError("Invalid page size")
+        if not BookSearchIndex.tokenize(terms):
+            raise IllegalArgumentError("Invalid search terms")
+        _, offset = Page.decode_cursor(cursor)
+        return offset
+
+    # one row more than the page is read to tell whether there is a next page
+    @staticmethod
+    def search_params(terms, page_size, offset):
+        return (terms, terms, page_size + 1, offset)
+
+    @staticmethod
+    def search_page(table, offset, page_size):
+        books = [Book.search_result(book) for book in table]
+        return Page.from_offset(books, offset, page_size)
 
+    # the same page ranked by the in-process index, for when the FULLTEXT search can not be used
+    @staticmethod
+    def search_index_page(search_index, terms, offset, page_size):
+        books = [
+            Book(book.book_name, book.author, book.details, book.book_id, Book.BOOKS_TO_ADD)
+            for book in search_index.search(terms, offset + page_size + 1)[offset:]
+        ]
+        return Page.from_offset(books, offset, page_size)
+
+    # writes a whole table to output as csv or json lines while it is read from the server,
+    # only one batch of rows is held at a time so any size of table can be exported
+    @Tracer.traced
+    def export(self, table, output, export_format=CSV, batch_size=None):
+        if table not in self.EXPORTS:
+            raise IllegalArgumentError(f"Unable to export {table}")
+        if export_format not in (self.CSV, self.JSON_LINES):
+            raise IllegalArgumentError(f"Unknown export format {export_format}")
+
+        query_name, columns = self.EXPORTS[table]
+        rows = self.iterate(SQLQueryRegistry.get(query_name), batch_size=batch_size)
+        count = 0
+        if export_format == self.CSV:
+            writer = csv.writer(output)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                output.write(json.dumps(dict(zip(columns, row)), default=str) + "\n")
+                count += 1
+        return count
+
+    # runs write on the database, when it can not be reached the books are added to the offline replica
+    # and queued for the replica's next sync instead
+    def write_wishlist(self, user_id, book_ids, write):
+        replica = self.offline_replica
+        if replica is not None and replica.offline:
+            return replica.queue_books(user_id, book_ids)
+        try:
+            added = write()
+        except Exception as e:
+            if replica is None or not replica.fail(e):
+                raise
+            return replica.queue_books(user_id, book_ids)
+
+        if replica is not None:
+            replica.record_books(user_id, book_ids)
+        self.record_wishlist(user_id, book_ids)
+        return added
+
+    @Tracer.traced
     def add_book_to_wishlist(self, user_id, book_id):
-        query = SQLQueryCommands.add_book_to_wishlist.value.format(user_id, book_id)
-        self.insert(query)
+        query = SQLQueryRegistry.get("add_book_to_wishlist")
+        self.write_wishlist(
+            user_id, [book_id], lambda: self.insert(query, (user_id, book_id), session=user_id)
+        )
+
+    @Tracer.traced
+    def add_books_to_wishlist(self, user_id, book_ids):
+        book_ids = list(dict.fromkeys(book_ids))
+        if not book_ids:
+            raise InvalidBookError
+        return self.write_wishlist(
+            user_id, book_ids, lambda: self.write_books_to_wishlist(user_id, book_ids)
+        )
+
+    # the book ids are checked with one query and written with one multi-row insert
+    # in a single transaction, nothing is added if any of them is not a book
+    def write_books_to_wishlist(self, user_id, book_ids):
+        # both statements read the ids from one json array so their sql never changes
+        book_ids_json = json.dumps(book_ids)
+
+        with self.transaction(session=user_id) as transaction:
+            query = SQLQueryRegistry.get("get_existing_book_ids")
+            existing = {book_id for (book_id,) in transaction.fetch(query, (book_ids_json,))}
+            missing = [book_id for book_id in book_ids if book_id not in existing]
+            if missing:
+                raise InvalidBookError(missing)
+
+            query = SQLQueryRegistry.get("add_books_to_wishlist")
+            return transaction.execute(query, (user_id, book_ids_json))
 
 
 class WhatabookMenu(Whatabook):
     def __init__(self):
-        self.max_menu_choices = 4
-        self.max_account_menu_choices = 3
+        self.max_menu_choices = 7
+        self.max_account_menu_choices = 4
         super().__init__()
 
+    # writes the chunks of a listing as they are produced
+    # the trailing blank line matches what print() added to the full listing
+    @staticmethod
+    @Tracer.traced
+    def render(chunks, sink=None):
+        sink = sink if sink is not None else sys.stdout
+        for chunk in chunks:
+            sink.write(chunk)
+        sink.write("\n")
+        sink.flush()
+
     def get_menu_choice(self):
         print("-- Main Menu --\n")
+        if self.is_offline():
+            print(f"{self.offline_replica.status_line()}\n")
 
         print(
             "1. View Books\n2. View Store Locations\n3. My Account\n4. Exit Program\n"
+            "5. Browse Books\n6. Search Books\n7. Query Statistics\n"
         )
 
         try:
@@ -363,7 +1319,7 @@ class WhatabookMenu(Whatabook):
     def get_account_menu_choice(self):
         try:
             print("-- Customer Menu --\n")
-            print("1. Wishlist\n2. Add Book\n3. Main Menu\n")
+            print("1. Wishlist\n2. Add Book\n3. Main Menu\n4. Browse Wishlist\n")
             account_option = int(input("<Example enter: 1 for wishlist>: "))
             if not 1 <= account_option <= self.max_account_menu_choices:
                 raise IllegalArgumentError
@@ -375,24 +1331,106 @@ class WhatabookMenu(Whatabook):
         except ValueError:
             return None
 
+    # shows one page at a time, read_page is called with the cursor of the page to show
+    # every page is its own span, the prompts between pages are not timed
+    def browse_menu(self, heading, read_page):
+        cursor = None
+        while True:
+            with Tracer.trace("WhatabookMenu.browse_page", first=cursor is None):
+                page = read_page(cursor)
+                if page.items:
+                    self.render([heading] + [item.format() for item in page.items])
+            if not page.items:
+                print("Nothing to display\n")
+                return
+
+            options = []
+            if page.next_cursor:
+                options.append("n. Next Page")
+            if page.previous_cursor:
+                options.append("p. Previous Page")
+            options.append("q. Back")
+            print("\n".join(options) + "\n")
+
+            choice = str(input("<Example enter: n for next page>: ")).strip().lower()
+            if choice == "n" and page.next_cursor:
+                cursor = page.next_cursor
+            elif choice == "p" and page.previous_cursor:
+                cursor = page.previous_cursor
+            elif choice == "q":
+                return
+            else:
+                print("Invalid choice, try again...")
+
+    def search_menu(self):
+        terms = str(input("Enter search terms <Example enter: dark elf>: "))
+        try:
+            self.browse_menu(
+                SEARCH_LISTING, lambda cursor: self.search_books(terms, cursor=cursor)
+            )
+        except IllegalArgumentError:
+            print("Invalid search terms, try again...")
+
+    # prints the timings of every query and writes the same numbers as json to the SNAPSHOT file
+    @Tracer.traced
+    def stats_menu(self):
+        if self.stats is None:
+            print("Query statistics are turned off, set ENABLED in the STATS section\n")
+            return
+
+        print("-- Query Statistics --\n")
+        print(self.stats.report())
+        path = self.stats_snapshot_path()
+        if path:
+            try:
+                self.stats.write_snapshot(path)
+                print(f"Snapshot written to {path}\n")
+            except OSError as e:
+                print(f"Unable to write snapshot to {path}: {e}\n")
+
+    @staticmethod
+    def stats_snapshot_path():
+        try:
+            stats_config = SQLConfiguration.load_stats_config()
+        except KeyError:
+            return None
+        return stats_config.get(SQLConfiguration.SNAPSHOT) or None
+
+    # accepts a single book id or a comma separated list of them
+    @staticmethod
+    def parse_book_ids(entry):
+        return [int(book_id) for book_id in str(entry).split(",")]
+
     def add_book_menu(self, user_id):
         try:
-            book_id = int(input("Enter Book ID: "))
-            self.add_book_to_wishlist(user_id, book_id)
+            book_ids = self.parse_book_ids(
+                input("Enter Book ID(s) <Example enter: 1 or 1, 4, 5>: ")
+            )
+            with Tracer.trace("WhatabookMenu.add_book_menu", user_id=user_id, books=len(book_ids)):
+                self.add_books_to_wishlist(user_id, book_ids)
+            if self.is_offline():
+                print("The database is offline, the books will be added once it is back")
             return True
 
         except ValueError:
             print("Invalid Book ID")
             return False
 
+        except InvalidBookError as e:
+            print(e)
+            return False
+
         except Exception:
             print("Unable to add book to wishlist, try again...")
             return False
 
+    # every account action is the root span of its own trace, opened once its input has been read
     def my_account(self, user_id):
         # validate user ID
         try:
-            if not self.validate_user_id(user_id):
+            with Tracer.trace("WhatabookMenu.login", user_id=user_id):
+                valid = self.validate_user_id(user_id)
+            if not valid:
                 raise InvalidUserError
         except InvalidUserError:
             print("Invalid user id, try again...")
@@ -408,15 +1446,34 @@ class WhatabookMenu(Whatabook):
             # finish each match case
             match account_menu_choice:
                 case 1:
-                    print(self.get_wishlist_books(user_id))
+                    with Tracer.trace("WhatabookMenu.account_choice", choice=1, user_id=user_id):
+                        self.render(self.stream_wishlist_books(user_id))
 
                 case 2:
-                    print(self.get_books_to_add(user_id))
+                    with Tracer.trace("WhatabookMenu.account_choice", choice=2, user_id=user_id):
+                        self.render(self.stream_books_to_add(user_id))
+                        recommendations = self.load_recommendations(user_id)
+                        if recommendations:
+                            self.render(
+                                self.render_listing(
+                                    "load_recommendations",
+                                    "book",
+                                    RECOMMENDED_LISTING,
+                                    recommendations,
+                                    Book.format,
+                                )
+                            )
                     print("Successful" if self.add_book_menu(user_id) else "Unable to add book, try again...")
 
                 case 3:
                     account_loop = False
 
+                case 4:
+                    self.browse_menu(
+                        WISHLIST_LISTING,
+                        lambda cursor: self.get_wishlist_page(user_id, cursor=cursor),
+                    )
+
     def main_menu(self):
         main_loop = True
         while main_loop:
@@ -424,12 +1481,16 @@ class WhatabookMenu(Whatabook):
             if not menu_choice:
                 print("Invalid choice, try again...")
 
+            # every action is the root span of its own trace, opened once its input has been read
+            # so the time spent at a prompt is never counted
             match menu_choice:
                 case 1:
-                    print(self.get_books())
+                    with Tracer.trace("WhatabookMenu.menu_choice", choice=menu_choice):
+                        self.render(self.stream_books())
 
                 case 2:
-                    print(self.get_locations())
+                    with Tracer.trace("WhatabookMenu.menu_choice", choice=menu_choice):
+                        self.render(self.stream_locations())
 
                 case 3:
                     try:
@@ -447,13 +1508,265 @@ class WhatabookMenu(Whatabook):
 
                 case 4:
                     main_loop = False
+
+                case 5:
+                    self.browse_menu(
+                        BOOK_LISTING, lambda cursor: self.get_books_page(cursor=cursor)
+                    )
+
+                case 6:
+                    self.search_menu()
+
+                case 7:
+                    with Tracer.trace("WhatabookMenu.menu_choice", choice=menu_choice):
+                        self.stats_menu()
         print("Exiting Program...")
 
+    # Batch mode runs the menu's code paths from a script instead of prompts
+    # Each line is either a command followed by its arguments, for example "add 1 5 6",
+    # or a json object such as {"command": "add", "args": [1, 5, 6]}
+    # Blank lines and lines starting with # are skipped
+    BATCH_COMMANDS = {
+        "view_books": "batch_view_books",
+        "browse_books": "batch_browse_books",
+        "search": "batch_search",
+        "locations": "batch_locations",
+        "login": "batch_login",
+        "wishlist": "batch_wishlist",
+        "browse_wishlist": "batch_browse_wishlist",
+        "books_to_add": "batch_books_to_add",
+        "recommend": "batch_recommend",
+        "add": "batch_add",
+        "stats": "batch_stats",
+        "offline": "batch_offline",
+    }
 
-def main():
+    @staticmethod
+    def parse_batch_line(line):
+        if line.startswith("{"):
+            entry = json.loads(line)
+            return entry["command"], list(entry.get("args", []))
+        command, *args = line.split()
+        return command, args
+
+    def batch_view_books(self):
+        return "".join(self.stream_books())
+
+    @staticmethod
+    def batch_page(page):
+        return {
+            "items": [book.to_dict() for book in page.items],
+            "next_cursor": page.next_cursor,
+            "previous_cursor": page.previous_cursor,
+        }
+
+    def batch_browse_books(self, page_size=Whatabook.PAGE_SIZE, cursor=None):
+        return self.batch_page(self.get_books_page(int(page_size), cursor))
+
+    # every argument is a search term, the first page of results is returned
+    def batch_search(self, *terms):
+        return self.batch_page(self.search_books(" ".join(str(term) for term in terms)))
+
+    def batch_locations(self):
+        return "".join(self.stream_locations())
+
+    def batch_login(self, user_id):
+        return self.validate_user_id(int(user_id))
+
+    # the account commands log in first, the same way my_account does
+    def batch_user(self, user_id):
+        user_id = int(user_id)
+        if not self.validate_user_id(user_id):
+            raise InvalidUserError
+        return user_id
+
+    def batch_wishlist(self, user_id):
+        return "".join(self.stream_wishlist_books(self.batch_user(user_id)))
+
+    def batch_browse_wishlist(self, user_id, page_size=Whatabook.PAGE_SIZE, cursor=None):
+        page = self.get_wishlist_page(self.batch_user(user_id), int(page_size), cursor)
+        return self.batch_page(page)
+
+    def batch_books_to_add(self, user_id):
+        return "".join(self.stream_books_to_add(self.batch_user(user_id)))
+
+    def batch_recommend(self, user_id):
+        books = self.load_recommendations(self.batch_user(user_id))
+        return [book.to_dict() for book in books]
+
+    def batch_add(self, user_id, *book_ids):
+        user_id = self.batch_user(user_id)
+        return self.add_books_to_wishlist(
+            user_id, [int(book_id) for book_id in book_ids]
+        )
+
+    # the statistics of the commands run so far in this batch
+    def batch_stats(self):
+        return self.stats.snapshot() if self.stats is not None else None
+
+    def batch_offline(self):
+        replica = self.offline_replica
+        return replica.statistics() if replica is not None else None
+
+    # writes one json result per command and a summary line at the end
+    # a failing command is reported and the script carries on
+    def run_batch(self, lines, output=None):
+        output = output if output is not None else sys.stdout
+        commands = 0
+        errors = 0
+        batch_start = time.perf_counter()
+
+        for line_number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            commands += 1
+            record = {"line": line_number}
+            start = time.perf_counter()
+            try:
+                command, args = self.parse_batch_line(line)
+                record["command"] = command
+                record["args"] = args
+                if command not in self.BATCH_COMMANDS:
+                    raise IllegalArgumentError(f"Unknown command {command}")
+                with Tracer.trace("WhatabookMenu.run_batch", command=command, line=line_number):
+                    record["result"] = getattr(self, self.BATCH_COMMANDS[command])(*args)
+                record["ok"] = True
+            except Exception as e:
+                errors += 1
+                record["ok"] = False
+                record["error"] = f"{type(e).__name__}: {e}"
+            record["elapsed_ms"] = (time.perf_counter() - start) * 1000
+            output.write(json.dumps(record) + "\n")
+
+        elapsed = time.perf_counter() - batch_start
+        summary = {
+            "commands": commands,
+            "errors": errors,
+            "elapsed_ms": elapsed * 1000,
+            "commands_per_second": commands / elapsed if elapsed else 0.0,
+        }
+        output.write(json.dumps({"summary": summary}) + "\n")
+        output.flush()
+        return summary
+
+
+def run_batch(args):
     whatabookmenu = WhatabookMenu()
-    whatabookmenu.main_menu()
+    if args.script == "-":
+        whatabookmenu.run_batch(sys.stdin)
+        return
+    with open(args.script) as script:
+        whatabookmenu.run_batch(script)
+
+
+def migrate(args):
+    migrator = SQLMigrator()
+    if args.status:
+        for migration, applied in migrator.status():
+            print(f"{migration.version:04d} {migration.name}: {'applied' if applied else 'pending'}")
+        return
+
+    if args.down:
+        if args.target is None:
+            raise MigrationError("A target version is required to migrate down")
+        migrator.downgrade(args.target)
+    else:
+        migrator.upgrade(args.target)
+
+
+def export(args):
+    whatabook = Whatabook()
+    if args.output == "-":
+        count = whatabook.export(args.table, sys.stdout, args.format, args.batch_size)
+    else:
+        with open(args.output, "w", newline="") as output:
+            count = whatabook.export(args.table, output, args.format, args.batch_size)
+    print(f"exported {count} {args.table}", file=sys.stderr)
+
+
+# one sync of the offline replica, the exit status tells whether it succeeded
+def sync(args):
+    replica = OfflineReplica.get_replica()
+    if replica is None:
+        raise ConfigNotSetError("The offline replica is turned off, set ENABLED in the OFFLINE section")
+    synced = args.status or replica.sync(Whatabook(sync_replica=False))
+    print(json.dumps(replica.statistics(), indent=2))
+    if not synced:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Whatabook program")
+    parser.add_argument(
+        "--trace", metavar="FILE", help="write a Chrome trace of the session to FILE on exit"
+    )
+    parser.add_argument(
+        "--trace-sample-rate", type=float, default=1.0, help="fraction of the menu actions traced"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+
+    migrate_parser = subparsers.add_parser("migrate", help="apply schema migrations")
+    migrate_parser.add_argument("--target", type=int, help="version to migrate to")
+    migrate_parser.add_argument(
+        "--down", action="store_true", help="revert migrations newer than --target"
+    )
+    migrate_parser.add_argument(
+        "--status", action="store_true", help="list applied and pending migrations"
+    )
+
+    batch_parser = subparsers.add_parser(
+        "batch", help="run menu commands from a script without prompts"
+    )
+    batch_parser.add_argument(
+        "script", help="command script or json lines file, - reads standard input"
+    )
+
+    export_parser = subparsers.add_parser(
+        "export", help="stream a whole table to a csv or json lines file"
+    )
+    export_parser.add_argument("table", choices=sorted(Whatabook.EXPORTS))
+    export_parser.add_argument("--output", default="-", help="file to write, - writes standard output")
+    export_parser.add_argument(
+        "--format", choices=[Whatabook.CSV, Whatabook.JSON_LINES], default=Whatabook.CSV
+    )
+    export_parser.add_argument(
+        "--batch-size", type=int, help="rows read from the server at a time, BATCH_SIZE by default"
+    )
+
+    sync_parser = subparsers.add_parser(
+        "sync", help="sync the offline replica with the database"
+    )
+    sync_parser.add_argument(
+        "--status", action="store_true", help="only show how stale the replica is"
+    )
+
+    args = parser.parse_args()
+    if args.trace:
+        Tracer.start(args.trace, args.trace_sample_rate)
+
+    match args.command:
+        case "migrate":
+            migrate(args)
+
+        case "batch":
+            run_batch(args)
+
+        case "export":
+            export(args)
+
+        case "sync":
+            sync(args)
+
+        case _:
+            whatabookmenu = WhatabookMenu()
+            whatabookmenu.main_menu()
 
 
 if __name__ == "__main__":
-    main()
+    # run from the imported module, the modules whatabook loads later import it too
+    # and must see the same classes as the running program, not a second copy under __main__
+    import whatabook
+
+    whatabook.main()
@@ -0,0 +1,306 @@
+import aiomysql
+import argparse
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
+from whatabook import (
+    AVAILABLE_LISTING,
+    BOOK_LISTING,
+    STORE_LISTING,
+    WISHLIST_LISTING,
+    Book,
+    BookSearchIndex,
+    IllegalArgumentError,
+    InvalidBookError,
+    Page,
+    PyMySQLBackend,
+    SQLConfiguration,
+    SQLConnectionPool,
+    SQLInterface,
+    SQLQueryRegistry,
+    Store,
+    TableNotFoundError,
+    Whatabook,
+)
+
+"""
+    Title: whatabook_async.py
+    Description: Asyncio counterpart of the Whatabook class.
+        Uses the aiomysql driver and its connection pool so a single process can serve
+        many concurrent sessions, and shares the query registry and document models with whatabook.py.
+        The queries are always the MySQL ones, the BACKEND setting only picks the blocking driver.
+"""
+
+
+# Statements run inside AsyncWhatabook.transaction()
+class AsyncSQLTransaction:
+    def __init__(self, sql_cursor):
+        self.sql_cursor = sql_cursor
+
+    async def fetch(self, query, params=()):
+        await self.sql_cursor.execute(SQLInterface.sql(query), params)
+        return await self.sql_cursor.fetchall()
+
+    async def execute(self, query, params=()):
+        await self.sql_cursor.execute(SQLInterface.sql(query), params)
+        return self.sql_cursor.rowcount
+
+
+# aiomysql hands the warnings of a statement to warnings.warn,
+# with RAISE_ON_WARNINGS this cursor raises the first one instead, as the blocking client does
+class RaisingCursor(aiomysql.Cursor):
+    async def _show_warnings(self, conn):
+        if self._result and self._result.has_next:
+            return
+        warnings = await conn.show_warnings()
+        if warnings:
+            _, code, message = warnings[0]
+            raise aiomysql.Warning(code, message)
+
+
+# Same operations as Whatabook, every database call is awaited on a pooled aiomysql connection
+# Create one with "async with await AsyncWhatabook.create() as whatabook:" so the pool is closed on exit
+class AsyncWhatabook:
+
+    PAGE_SIZE = Whatabook.PAGE_SIZE
+    # aiomysql is built on PyMySQL and takes its queries whichever backend BACKEND selects
+    BACKEND = PyMySQLBackend()
+
+    # backend picks the SQL the pool is sent, a pool of another driver passes its own
+    def __init__(self, pool, backend=BACKEND):
+        self.pool = pool
+        self.backend = backend
+        self.fulltext = Whatabook.fulltext_enabled() and backend.FULLTEXT
+        self._search_index = None
+
+    # the connection and pool settings are the same ones the blocking pool reads
+    @classmethod
+    async def create_pool(cls):
+        config = SQLConnectionPool.load_config(backend=cls.BACKEND)
+        try:
+            pool_config = SQLConfiguration.load_pool_config()
+        except KeyError:
+            pool_config = {}
+
+        return await aiomysql.create_pool(
+            host=config["host"],
+            port=config.get("port", 3306),
+            user=config["user"],
+            password=config["password"],
+            db=config["database"],
+            autocommit=True,
+            cursorclass=RaisingCursor if config["raise_on_warnings"] else aiomysql.Cursor,
+            minsize=int(pool_config.get(SQLConfiguration.MIN_SIZE, 1)),
+            maxsize=int(pool_config.get(SQLConfiguration.MAX_SIZE, 5)),
+            pool_recycle=int(float(pool_config.get(SQLConfiguration.IDLE_TIMEOUT, 300))),
+        )
+
+    @classmethod
+    async def create(cls):
+        return cls(await cls.create_pool())
+
+    async def close(self):
+        self.pool.close()
+        await self.pool.wait_closed()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        await self.close()
+
+    def query(self, name):
+        return SQLQueryRegistry.get(name, self.backend)
+
+    def pool_statistics(self):
+        return {
+            "size": self.pool.size,
+            "idle": self.pool.freesize,
+            "in_use": self.pool.size - self.pool.freesize,
+            "min_size": self.pool.minsize,
+            "max_size": self.pool.maxsize,
+        }
+
+    async def fetch(self, query, params=()):
+        async with self.pool.acquire() as database_connection:
+            async with database_connection.cursor() as sql_cursor:
+                await sql_cursor.execute(SQLInterface.sql(query), params)
+                return list(await sql_cursor.fetchall())
+
+    # runs every statement of the block on one connection in a single transaction
+    @asynccontextmanager
+    async def transaction(self):
+        async with self.pool.acquire() as database_connection:
+            await database_connection.begin()
+            try:
+                async with database_connection.cursor() as sql_cursor:
+                    yield AsyncSQLTransaction(sql_cursor)
+            except BaseException:
+                await database_connection.rollback()
+                raise
+            await database_connection.commit()
+
+    async def commit(self, query, data):
+        async with self.transaction() as transaction:
+            return await transaction.execute(query, data)
+
+    async def get_books(self):
+        table = await self.fetch(self.query("get_books"))
+        books = (Book.to_object(book) for book in table)
+        return "".join(Whatabook.render_rows("book", BOOK_LISTING, books, Book.format))
+
+    async def get_locations(self):
+        table = await self.fetch(self.query("get_locations"))
+        stores = (Store.to_object(store) for store in table)
+        return "".join(Whatabook.render_rows("store", STORE_LISTING, stores, Store.format))
+
+    async def get_total_users(self):
+        table = await self.fetch(self.query("get_total_users"))
+        if not table:
+            raise TableNotFoundError("user")
+        ((total_users,),) = table
+        return total_users
+
+    async def user_exists(self, user_id):
+        query = self.query("user_exists")
+        return bool(await self.fetch(query, (user_id,)))
+
+    async def validate_user_id(self, user_id):
+        # user ids are auto incremented from 1
+        return user_id >= 1 and await self.user_exists(user_id)
+
+    async def get_wishlist_books(self, user_id):
+        query = self.query("get_wishlist_books")
+        table = await self.fetch(query, (user_id,))
+        return "".join(
+            Whatabook.render_rows(
+                "wishlist",
+                WISHLIST_LISTING,
+                table,
+                lambda book: Book.wishlist_book(book).format(),
+            )
+        )
+
+    async def get_books_to_add(self, user_id):
+        query = self.query("get_books_to_add")
+        table = await self.fetch(query, (user_id,))
+        return "".join(
+            Whatabook.render_rows(
+                "book",
+                AVAILABLE_LISTING,
+                table,
+                lambda book: Book.available_books(book).format(),
+            )
+        )
+
+    async def read_page(self, after_query, before_query, params, page_size, cursor, to_object):
+        if page_size < 1:
+            raise IllegalArgumentError("Invalid page size")
+
+        direction, last_key = Page.decode_cursor(cursor)
+        query = after_query if direction == Page.AFTER else before_query
+        table = await self.fetch(query, params + (last_key, page_size + 1))
+        return Page.from_rows(table, direction, cursor, page_size, to_object)
+
+    async def get_books_page(self, page_size=PAGE_SIZE, cursor=None):
+        return await self.read_page(
+            self.query("get_books_page"),
+            self.query("get_books_page_before"),
+            (),
+            page_size,
+            cursor,
+            Book.to_object,
+        )
+
+    async def get_wishlist_page(self, user_id, page_size=PAGE_SIZE, cursor=None):
+        return await self.read_page(
+            self.query("get_wishlist_page"),
+            self.query("get_wishlist_page_before"),
+            (user_id,),
+            page_size,
+            cursor,
+            Book.wishlist_entry,
+        )
+
+    # returns None when the version can not be read
+    async def catalog_version(self, table):
+        try:
+            table = await self.fetch(self.query("get_catalog_version"), (table,))
+        except aiomysql.Error:
+            return None
+        return table[0][0] if table else None
+
+    # the index of the whole catalog is kept until the book table's catalog_version changes
+    async def search_index(self):
+        version = await self.catalog_version("book")
+        search_index = self._search_index
+        if search_index is None or version is None or search_index.version != version:
+            table = await self.fetch(self.query("get_books"))
+            search_index = self._search_index = BookSearchIndex(
+                [Book.to_object(book) for book in table], version
+            )
+        return search_index
+
+    async def search_books(self, terms, page_size=PAGE_SIZE, cursor=None):
+        offset = Whatabook.search_offset(terms, page_size, cursor)
+        if self.fulltext:
+            query = self.query("search_books")
+            try:
+                table = await self.fetch(query, Whatabook.search_params(terms, page_size, offset))
+                return Whatabook.search_page(table, offset, page_size)
+            except aiomysql.Error as e:
+                # aiomysql errors carry the MySQL error number as their first argument
+                if not e.args or e.args[0] != Whatabook.FULLTEXT_INDEX_MISSING:
+                    raise
+                self.fulltext = False
+
+        return Whatabook.search_index_page(await self.search_index(), terms, offset, page_size)
+
+    async def add_book_to_wishlist(self, user_id, book_id):
+        query = self.query("add_book_to_wishlist")
+        await self.commit(query, (user_id, book_id))
+
+    async def add_books_to_wishlist(self, user_id, book_ids):
+        book_ids = list(dict.fromkeys(book_ids))
+        if not book_ids:
+            raise InvalidBookError
+        book_ids_json = json.dumps(book_ids)
+
+        async with self.transaction() as transaction:
+            query = self.query("get_existing_book_ids")
+            table = await transaction.fetch(query, (book_ids_json,))
+            existing = {book_id for (book_id,) in table}
+            missing = [book_id for book_id in book_ids if book_id not in existing]
+            if missing:
+                raise InvalidBookError(missing)
+
+            query = self.query("add_books_to_wishlist")
+            return await transaction.execute(query, (user_id, book_ids_json))
+
+
+# looks up the wishlists of the given users many times at once on a single event loop
+async def wishlist_lookups(user_ids, lookups):
+    async with await AsyncWhatabook.create() as whatabook:
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                whatabook.get_wishlist_books(user_ids[lookup % len(user_ids)])
+                for lookup in range(lookups)
+            )
+        )
+        elapsed = time.perf_counter() - start
+        print(f"{lookups} wishlist lookups in {elapsed:.2f}s ({lookups / elapsed:.0f}/s)")
+        print(whatabook.pool_statistics())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent Whatabook wishlist lookups")
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 2, 3])
+    parser.add_argument("--lookups", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(wishlist_lookups(args.users, args.lookups))
+
+
+if __name__ == "__main__":
+    main()
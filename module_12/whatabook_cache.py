@@ -0,0 +1,326 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from whatabook_errors import PoolExhaustedError
+from whatabook_config import SQLConfiguration
+from whatabook_db import (
+    SQLDriver,
+    SQLQueryRegistry,
+)
+
+"""
+    Title: whatabook_cache.py
+    Description: In-process caches of query results, user ids and catalog listings
+"""
+
+
+# LRU cache of query results keyed by query name and parameters
+# Every entry depends on the tables its query reads, a write to a table drops only the entries
+# that read it, so adding to a wishlist leaves the cached book listings alone
+# Entries also expire after ttl seconds so changes made by other processes are picked up
+# The cache holds at most max_entries results and about max_bytes of rows
+class QueryResultCache:
+
+    # freshness checks and bulk reads that must always reach the database,
+    # the full catalog listings are kept by CatalogCache which checks their version first
+    # and users added by other processes must be found straight away
+    SKIP = frozenset(
+        {
+            "user_exists",
+            "get_total_users",
+            "get_books",
+            "get_locations",
+            "get_catalog_version",
+            "get_new_user_ids",
+            "get_wishlist_pairs",
+            "schema_version_table_exists",
+            "get_schema_versions",
+            "schema_step_table_exists",
+            "get_schema_steps",
+        }
+    )
+    # streamed results longer than this are not collected for the cache
+    MAX_ROWS = 10000
+
+    def __init__(self, ttl=30, max_entries=1024, max_bytes=16 * 1024 * 1024, skip=SKIP):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.skip = skip
+        # (query name, params) -> (rows, tables, size, time stored), least recently used first
+        self._entries = OrderedDict()
+        # table -> keys of the entries that read it
+        self._dependents = {}
+        # table -> number of writes, a result read while its table was written is not stored
+        self._generations = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expired": 0,
+            "invalidations": 0,
+            "skipped": 0,
+        }
+
+    @classmethod
+    def from_config(cls):
+        try:
+            cache_config = SQLConfiguration.load_cache_config()
+        except KeyError:
+            return None
+
+        if not cache_config.getboolean(SQLConfiguration.RESULTS, False):
+            return None
+
+        return cls(
+            ttl=cache_config.getfloat(SQLConfiguration.RESULTS_TTL, 30),
+            max_entries=cache_config.getint(SQLConfiguration.RESULTS_MAX_ENTRIES, 1024),
+            max_bytes=cache_config.getint(SQLConfiguration.RESULTS_MAX_BYTES, 16 * 1024 * 1024),
+        )
+
+    def accepts(self, query):
+        return query.writes is None and query.name not in self.skip
+
+    @staticmethod
+    def key(query, params):
+        return (query.name, tuple(params))
+
+    # approximate memory held by the rows
+    @staticmethod
+    def size_of(rows):
+        size = sys.getsizeof(rows)
+        for row in rows:
+            size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+        return size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            if time.monotonic() - entry[3] >= self.ttl:
+                self._remove(key)
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[0]
+
+    # taken before the query runs and handed to put()
+    def generations(self, tables):
+        with self._lock:
+            return tuple(self._generations.get(table, 0) for table in sorted(tables))
+
+    def put(self, key, tables, rows, generations):
+        rows = tuple(rows)
+        size = self.size_of(rows)
+        with self._lock:
+            current = tuple(self._generations.get(table, 0) for table in sorted(tables))
+            if current != generations or size > self.max_bytes:
+                self._stats["skipped"] += 1
+                return
+
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (rows, tables, size, time.monotonic())
+            self._bytes += size
+            for table in tables:
+                self._dependents.setdefault(table, set()).add(key)
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    # drops every entry that reads one of the tables, all of them when no table is given
+    def invalidate(self, *tables):
+        with self._lock:
+            if not tables:
+                self._stats["invalidations"] += len(self._entries)
+                self._entries.clear()
+                self._dependents.clear()
+                self._bytes = 0
+                return
+
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+                for key in list(self._dependents.get(table, ())):
+                    self._remove(key)
+                    self._stats["invalidations"] += 1
+
+    def statistics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        return stats
+
+    # must be called while holding the lock
+    def _remove(self, key):
+        _, tables, size, _ = self._entries.pop(key)
+        self._bytes -= size
+        for table in tables:
+            dependents = self._dependents.get(table)
+            if dependents is not None:
+                dependents.discard(key)
+                if not dependents:
+                    del self._dependents[table]
+
+
+# In-process bitmap of known user ids, one bit per id
+# Filled by successful existence probes and refreshed incrementally with batches of newer ids
+# so returning users are validated without a round trip to the database
+# Users are never deleted by this program, clear() drops every cached id
+class UserIdCache:
+    def __init__(self, refresh_interval=60, batch_size=10000):
+        self.refresh_interval = refresh_interval
+        self.batch_size = batch_size
+        self.high_water_mark = 0
+        self._bitmap = bytearray()
+        self._last_refresh = None
+        self._lock = threading.Lock()
+
+    # the cache is optional and disabled when the CACHE section does not enable it
+    @classmethod
+    def from_config(cls):
+        try:
+            cache_config = SQLConfiguration.load_cache_config()
+        except KeyError:
+            return None
+
+        if not cache_config.getboolean(SQLConfiguration.USER_IDS, False):
+            return None
+
+        return cls(
+            refresh_interval=cache_config.getfloat(
+                SQLConfiguration.USER_IDS_REFRESH_INTERVAL, 60
+            ),
+            batch_size=cache_config.getint(SQLConfiguration.USER_IDS_BATCH_SIZE, 10000),
+        )
+
+    def __contains__(self, user_id):
+        index, bit = divmod(user_id, 8)
+        return 0 <= index < len(self._bitmap) and bool(self._bitmap[index] & 1 << bit)
+
+    def add(self, user_id):
+        index, bit = divmod(user_id, 8)
+        with self._lock:
+            if index >= len(self._bitmap):
+                self._bitmap.extend(bytes(index + 1 - len(self._bitmap)))
+            self._bitmap[index] |= 1 << bit
+
+    def clear(self):
+        with self._lock:
+            self._bitmap = bytearray()
+            self.high_water_mark = 0
+            self._last_refresh = None
+
+    def refresh_due(self):
+        return (
+            self._last_refresh is None
+            or time.monotonic() - self._last_refresh >= self.refresh_interval
+        )
+
+    # loads at most one batch of user ids newer than the last one seen
+    def refresh(self, interface):
+        query = SQLQueryRegistry.get("get_new_user_ids")
+        table = interface.read_rows(query, (self.high_water_mark, self.batch_size))
+        for (user_id,) in table:
+            self.add(user_id)
+        if table:
+            self.high_water_mark = table[-1][0]
+        self._last_refresh = time.monotonic()
+        return len(table)
+
+
+# Read-through cache of the parsed catalog tables (book and store)
+# Rows are served from memory for TTL seconds, after that the table's catalog_version counter
+# is checked and the table is only read again when its version changed
+# Write paths call invalidate() so changes made by this process are seen straight away
+# Streamed listings only keep tables of at most max_rows, larger ones are read again every time
+class CatalogCache:
+
+    MAX_ROWS = 10000
+
+    def __init__(self, ttl=300, max_rows=MAX_ROWS):
+        self.ttl = ttl
+        self.max_rows = max_rows
+        # table name -> (rows, version, time last validated)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "revalidations": 0, "invalidations": 0}
+
+    @classmethod
+    def from_config(cls):
+        try:
+            cache_config = SQLConfiguration.load_cache_config()
+        except KeyError:
+            return None
+
+        if not cache_config.getboolean(SQLConfiguration.CATALOG, False):
+            return None
+
+        return cls(
+            ttl=cache_config.getfloat(SQLConfiguration.CATALOG_TTL, 300),
+            max_rows=cache_config.getint(SQLConfiguration.CATALOG_MAX_ROWS, cls.MAX_ROWS),
+        )
+
+    # returns None when the version can not be read, the cache then relies on the ttl alone
+    @staticmethod
+    def version(interface, table):
+        query = SQLQueryRegistry.get("get_catalog_version")
+        try:
+            rows = interface.fetch(query, (table,))
+        except (SQLDriver.error(), PoolExhaustedError):
+            return None
+        return rows[0][0] if rows else None
+
+    def get(self, interface, table, load):
+        rows, version = self.lookup(interface, table)
+        if rows is None:
+            rows = load()
+            self.store(table, rows, version)
+        return rows
+
+    # returns the cached rows, or None and the version to store the rows read next with
+    # the version is read before the rows so a concurrent change is picked up next time
+    def lookup(self, interface, table):
+        now = time.monotonic()
+        entry = self._entries.get(table)
+        if entry is not None and now - entry[2] < self.ttl:
+            self._count("hits")
+            return entry[0], entry[1]
+
+        version = self.version(interface, table)
+        if entry is not None and version is not None and version == entry[1]:
+            self._count("revalidations")
+            with self._lock:
+                self._entries[table] = (entry[0], version, now)
+            return entry[0], version
+
+        self._count("misses")
+        return None, version
+
+    def store(self, table, rows, version):
+        with self._lock:
+            self._entries[table] = (rows, version, time.monotonic())
+
+    def invalidate(self, *tables):
+        with self._lock:
+            for table in tables or list(self._entries):
+                if self._entries.pop(table, None) is not None:
+                    self._stats["invalidations"] += 1
+
+    def statistics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["tables"] = sorted(self._entries)
+        return stats
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
@@ -0,0 +1,193 @@
+import threading
+from configparser import ConfigParser
+from whatabook_errors import EnviromentNotSetError
+
+"""
+    Title: whatabook_config.py
+    Description: Reads the Whatabook settings from the environment and config.ini
+"""
+
+
+# Manages environment vairavles
+# use pydantic to get username and password environment vairavles.
+# using environment vairables adds an extra layer of security
+# must set environment variables locally either using shell/terminal or a .env file
+# using a .env file is recommended
+# pydantic is only imported the first time the settings are read
+class SQLEnvironment:
+
+    _settings = None
+
+    @classmethod
+    def settings(cls):
+        if cls._settings is None:
+            from pydantic import BaseSettings
+
+            class Settings(BaseSettings):
+                sql_user: str
+                password: str
+
+                class Config:
+                    env_file = ".env"
+
+            cls._settings = Settings
+        return cls._settings
+
+    @classmethod
+    def load(cls):
+        import pydantic
+
+        try:
+            return cls.settings()().dict()
+        except pydantic.ValidationError:
+            raise EnviromentNotSetError
+
+
+# Manages the connection and sql query configurations
+# The configuration file will auto-generate if it is not found
+# The default configurations should work for this project as long as the database is set up correctly
+# The file is parsed once, on first use, and every section is read from that parse
+class SQLConfiguration:
+
+    CONNECTION_SECTION = "CONNECTION"
+    QUERY_SECTION = "QUERIES"
+    BANNER_SECTION = "BANNERS"
+    POOL_SECTION = "POOL"
+    CACHE_SECTION = "CACHE"
+    SEARCH_SECTION = "SEARCH"
+    RECOMMEND_SECTION = "RECOMMEND"
+    STATS_SECTION = "STATS"
+    TRACE_SECTION = "TRACE"
+    STREAM_SECTION = "STREAM"
+    OFFLINE_SECTION = "OFFLINE"
+    FILE = "config.ini"
+
+    BACKEND = "BACKEND"
+    SQLITE_PATH = "SQLITE_PATH"
+    HOST = "HOST"
+    PORT = "PORT"
+    DATABASE = "DATABASE"
+    RAISE_ON_WARNINGS = "RAISE_ON_WARNINGS"
+    REPLICAS = "REPLICAS"
+    READ_ROUTING = "READ_ROUTING"
+    STICKY_SECONDS = "STICKY_SECONDS"
+    REPLICA_RETRY_INTERVAL = "REPLICA_RETRY_INTERVAL"
+
+    MIN_SIZE = "MIN_SIZE"
+    MAX_SIZE = "MAX_SIZE"
+    IDLE_TIMEOUT = "IDLE_TIMEOUT"
+    CHECKOUT_TIMEOUT = "CHECKOUT_TIMEOUT"
+    HEALTH_CHECK = "HEALTH_CHECK"
+
+    USER_IDS = "USER_IDS"
+    USER_IDS_REFRESH_INTERVAL = "USER_IDS_REFRESH_INTERVAL"
+    USER_IDS_BATCH_SIZE = "USER_IDS_BATCH_SIZE"
+    CATALOG = "CATALOG"
+    CATALOG_TTL = "CATALOG_TTL"
+    CATALOG_MAX_ROWS = "CATALOG_MAX_ROWS"
+    RESULTS = "RESULTS"
+    RESULTS_TTL = "RESULTS_TTL"
+    RESULTS_MAX_ENTRIES = "RESULTS_MAX_ENTRIES"
+    RESULTS_MAX_BYTES = "RESULTS_MAX_BYTES"
+
+    FULLTEXT = "FULLTEXT"
+
+    ENABLED = "ENABLED"
+    TOP_N = "TOP_N"
+    COMPACT_THRESHOLD = "COMPACT_THRESHOLD"
+
+    SLOW_QUERY_MS = "SLOW_QUERY_MS"
+    SLOW_QUERY_LOG = "SLOW_QUERY_LOG"
+    SLOW_QUERY_KEEP = "SLOW_QUERY_KEEP"
+    SNAPSHOT = "SNAPSHOT"
+
+    OUTPUT = "OUTPUT"
+    SAMPLE_RATE = "SAMPLE_RATE"
+    MAX_EVENTS = "MAX_EVENTS"
+
+    BATCH_SIZE = "BATCH_SIZE"
+
+    PATH = "PATH"
+    SYNC_INTERVAL = "SYNC_INTERVAL"
+    MAX_STALENESS = "MAX_STALENESS"
+    LOCAL_READS = "LOCAL_READS"
+
+    @classmethod
+    def create_config(cls):
+        with open("config.txt") as config_handle:
+            config_content = config_handle.read()
+
+            with open(".config", "w") as config_file:
+                config_file.write(config_content)
+
+    _config = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def parse(cls):
+        with cls._lock:
+            if cls._config is None:
+                # interpolation is disabled so the %s query placeholders are read as they are
+                config = ConfigParser(interpolation=None)
+                config.read(cls.FILE)
+                cls._config = config
+            return cls._config
+
+    # forgets the parsed file, the next load reads it again
+    @classmethod
+    def reload(cls):
+        with cls._lock:
+            cls._config = None
+
+    @classmethod
+    def load(cls, section):
+        return cls.parse()[section]
+
+    @classmethod
+    def load_connection_config(cls):
+        return cls.load(cls.CONNECTION_SECTION)
+
+    @classmethod
+    def load_query_config(cls):
+        return cls.load(cls.QUERY_SECTION)
+
+    # queries of one backend that replace the ones in the QUERIES section, for example QUERIES.sqlite
+    @classmethod
+    def load_backend_query_config(cls, backend):
+        return cls.load(f"{cls.QUERY_SECTION}.{backend}")
+
+    @classmethod
+    def load_banner_config(cls):
+        return cls.load(cls.BANNER_SECTION)
+
+    @classmethod
+    def load_pool_config(cls):
+        return cls.load(cls.POOL_SECTION)
+
+    @classmethod
+    def load_cache_config(cls):
+        return cls.load(cls.CACHE_SECTION)
+
+    @classmethod
+    def load_search_config(cls):
+        return cls.load(cls.SEARCH_SECTION)
+
+    @classmethod
+    def load_recommend_config(cls):
+        return cls.load(cls.RECOMMEND_SECTION)
+
+    @classmethod
+    def load_stats_config(cls):
+        return cls.load(cls.STATS_SECTION)
+
+    @classmethod
+    def load_trace_config(cls):
+        return cls.load(cls.TRACE_SECTION)
+
+    @classmethod
+    def load_stream_config(cls):
+        return cls.load(cls.STREAM_SECTION)
+
+    @classmethod
+    def load_offline_config(cls):
+        return cls.load(cls.OFFLINE_SECTION)
@@ -0,0 +1,355 @@
+import argparse
+import bisect
+import itertools
+import os
+import random
+import time
+from whatabook_errors import ConfigNotSetError
+from whatabook_db import SQLConnectionPool, SQLDriver
+
+"""
+    Title: whatabook_datagen.py
+    Description: Generates deterministic whatabook datasets at a chosen scale factor and bulk loads them.
+        Scale factor 1 is 10,000 books, 20,000 users, 10 stores and about 500,000 wishlist rows,
+        every table grows linearly with the scale factor.
+        Authors are skewed so a few write most of the books and wishlists follow a Zipf distribution
+        over book popularity, the same seed and scale always produce the same files.
+        Loading replaces the existing data through the configured MySQL backend, the wishlist indexes
+        and foreign keys and the book search index the database has are dropped for the load
+        and rebuilt once afterwards, as are the catalog version triggers,
+        the catalog versions are bumped once at the end.
+"""
+
+BOOKS_PER_SCALE = 10000
+USERS_PER_SCALE = 20000
+STORES_PER_SCALE = 10
+BOOKS_PER_AUTHOR = 20
+
+FIRST_NAMES = [
+    "Rick", "Morty", "Summer", "Beth", "Jerry", "Ava", "Liam", "Noah", "Emma", "Olivia",
+    "Mia", "Lucas", "Amelia", "Ethan", "Harper", "Mason", "Ella", "Logan", "Aria", "James",
+]
+LAST_NAMES = [
+    "Sanchez", "Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis",
+    "Rodriguez", "Martinez", "Hernandez", "Lopez", "Gonzalez", "Wilson", "Anderson", "Thomas",
+    "Taylor", "Moore", "Jackson",
+]
+TITLE_WORDS = [
+    "Shadow", "Stone", "Fire", "Tears", "Rule", "Star", "Night", "River", "Crown", "Storm",
+    "Glass", "Iron", "Silver", "Winter", "Empire", "Garden", "Ghost", "Dragon", "Ocean", "Dust",
+]
+CITIES = [
+    ("Bellevue", "NE"), ("Omaha", "NE"), ("Lincoln", "NE"), ("Denver", "CO"), ("Austin", "TX"),
+    ("Portland", "OR"), ("Madison", "WI"), ("Boise", "ID"), ("Tulsa", "OK"), ("Fargo", "ND"),
+]
+
+TABLES = ["store", "book", "user", "wishlist"]
+COLUMNS = {
+    "store": ["store_id", "locale"],
+    "book": ["book_id", "book_name", "author", "details"],
+    "user": ["user_id", "first_name", "last_name"],
+    "wishlist": ["wishlist_id", "user_id", "book_id"],
+}
+
+# whatabook_init.sql and the migrations build these, which ones exist depends on the migrations applied
+# so only the ones the database has are dropped while the tables are loaded and added back afterwards
+# the book search index is rebuilt once from the loaded rows instead of row by row
+INDEXES = {
+    "wishlist": {
+        "ux_wishlist_user_book": "ADD UNIQUE INDEX ux_wishlist_user_book (user_id, book_id)",
+        "ix_wishlist_book": "ADD INDEX ix_wishlist_book (book_id)",
+        "ix_wishlist_user_wishlist": "ADD INDEX ix_wishlist_user_wishlist (user_id, wishlist_id)",
+    },
+    "book": {
+        "ft_book_search": "ADD FULLTEXT INDEX ft_book_search (book_name, author, details)",
+    },
+}
+# foreign_key_checks is off so the constraints are added without re-reading every row
+FOREIGN_KEYS = {
+    "wishlist": {
+        "fk_book": "ADD CONSTRAINT fk_book FOREIGN KEY (book_id) REFERENCES book(book_id)",
+        "fk_user": "ADD CONSTRAINT fk_user FOREIGN KEY (user_id) REFERENCES user(user_id)",
+    },
+}
+EXISTING_INDEXES = (
+    "SELECT DISTINCT index_name FROM information_schema.statistics "
+    "WHERE table_schema = DATABASE() AND table_name = %s"
+)
+EXISTING_FOREIGN_KEYS = (
+    "SELECT constraint_name FROM information_schema.table_constraints "
+    "WHERE table_schema = DATABASE() AND table_name = %s AND constraint_type = 'FOREIGN KEY'"
+)
+
+# the catalog triggers bump a version for every row, they are dropped for the load
+# and the versions are bumped once afterwards
+VERSION_TRIGGERS = [
+    (f"{table}_{event}_version", table, event.upper())
+    for table in ("book", "store")
+    for event in ("insert", "update", "delete")
+]
+DROP_VERSION_TRIGGERS = [f"DROP TRIGGER IF EXISTS {name}" for name, _, _ in VERSION_TRIGGERS]
+ADD_VERSION_TRIGGERS = [
+    f"CREATE TRIGGER {name} AFTER {event} ON {table} FOR EACH ROW "
+    f"UPDATE catalog_version SET version = version + 1 WHERE table_name = '{table}'"
+    for name, table, event in VERSION_TRIGGERS
+]
+
+NULL = "\\N"
+INSERT_BATCH_SIZE = 5000
+
+
+# Draws ranks 0..size-1 with probability proportional to 1 / (rank + 1) ** exponent
+class ZipfSampler:
+    def __init__(self, size, exponent, generator):
+        self.generator = generator
+        self.cumulative_weights = list(
+            itertools.accumulate(1 / (rank + 1) ** exponent for rank in range(size))
+        )
+        self.total = self.cumulative_weights[-1]
+
+    def sample(self):
+        return bisect.bisect_left(
+            self.cumulative_weights, self.generator.random() * self.total
+        )
+
+
+class DatasetGenerator:
+    def __init__(self, scale, seed=310, avg_wishlist=25, zipf_exponent=1.1):
+        if scale <= 0:
+            raise ValueError("The scale factor must be greater than 0")
+        self.scale = scale
+        self.seed = seed
+        self.avg_wishlist = avg_wishlist
+        self.zipf_exponent = zipf_exponent
+        self.books = max(1, int(BOOKS_PER_SCALE * scale))
+        self.users = max(1, int(USERS_PER_SCALE * scale))
+        self.stores = max(1, int(STORES_PER_SCALE * scale))
+        self.authors = max(1, self.books // BOOKS_PER_AUTHOR)
+
+    # each table gets its own generator so changing one table never changes another
+    def generator(self, table):
+        return random.Random(f"{self.seed}:{table}")
+
+    def store_rows(self):
+        generator = self.generator("store")
+        for store_id in range(1, self.stores + 1):
+            city, state = generator.choice(CITIES)
+            street = f"{generator.randint(100, 9999)} {generator.choice(TITLE_WORDS)} Rd"
+            yield (store_id, f"{street}, {city}, {state} {generator.randint(10000, 99999)}")
+
+    def book_rows(self):
+        generator = self.generator("book")
+        authors = ZipfSampler(self.authors, 1.0, generator)
+        for book_id in range(1, self.books + 1):
+            title = " ".join(generator.sample(TITLE_WORDS, generator.randint(1, 3)))
+            author = authors.sample() + 1
+            details = (
+                f"Book {generator.randint(1, 12)} of the {generator.choice(TITLE_WORDS)} series"
+                if generator.random() < 0.3
+                else NULL
+            )
+            yield (book_id, f"The {title} {book_id}", f"Author {author}", details)
+
+    def user_rows(self):
+        generator = self.generator("user")
+        for user_id in range(1, self.users + 1):
+            yield (user_id, generator.choice(FIRST_NAMES), generator.choice(LAST_NAMES))
+
+    # wishlist sizes are exponentially distributed around avg_wishlist
+    # and the books on them follow the zipf popularity, shuffled so popular books are spread over the ids
+    def wishlist_rows(self):
+        generator = self.generator("wishlist")
+        popularity = list(range(1, self.books + 1))
+        generator.shuffle(popularity)
+        books = ZipfSampler(self.books, self.zipf_exponent, generator)
+
+        wishlist_id = 0
+        for user_id in range(1, self.users + 1):
+            size = min(self.books, int(generator.expovariate(1 / self.avg_wishlist)))
+            chosen = set()
+            attempts = 0
+            while len(chosen) < size and attempts < size * 4:
+                chosen.add(popularity[books.sample()])
+                attempts += 1
+            for book_id in sorted(chosen):
+                wishlist_id += 1
+                yield (wishlist_id, user_id, book_id)
+
+    def rows(self, table):
+        return {
+            "store": self.store_rows,
+            "book": self.book_rows,
+            "user": self.user_rows,
+            "wishlist": self.wishlist_rows,
+        }[table]()
+
+    # writes one tab separated file per table without holding the rows in memory
+    def write(self, directory, report=print):
+        os.makedirs(directory, exist_ok=True)
+        paths = {}
+        for table in TABLES:
+            start = time.perf_counter()
+            path = os.path.join(directory, f"{table}.tsv")
+            count = 0
+            with open(path, "w", encoding="utf-8", newline="\n") as table_file:
+                for row in self.rows(table):
+                    table_file.write("\t".join(str(value) for value in row) + "\n")
+                    count += 1
+            paths[table] = path
+            report(f"generated {count:>10} {table} rows in {time.perf_counter() - start:8.2f}s")
+        return paths
+
+
+# Replaces the whatabook data with the generated files
+class BulkLoader:
+
+    INFILE = "infile"
+    INSERT = "insert"
+
+    def __init__(self, method=INFILE, report=print):
+        self.method = method
+        self.report = report
+
+    # LOAD DATA, the session settings and the ALTER TABLEs are MySQL only
+    def connect(self):
+        backend = SQLDriver.backend()
+        if not backend.SERVER:
+            raise ConfigNotSetError(f"Bulk loading needs a MySQL backend, not {backend.NAME}")
+        config = SQLConnectionPool.load_config()
+        # LOAD DATA and the bulk session settings raise notes that are expected here
+        config["raise_on_warnings"] = False
+        config[backend.LOCAL_INFILE] = self.method == self.INFILE
+        return SQLDriver.connect(**config)
+
+    def step(self, sql_cursor, description, statement, params=()):
+        start = time.perf_counter()
+        sql_cursor.execute(statement, params)
+        self.report(f"{time.perf_counter() - start:8.2f}s  {description}")
+
+    # the indexes and foreign keys of table that are in the database, in the order they are added
+    @staticmethod
+    def existing_keys(sql_cursor, table):
+        sql_cursor.execute(EXISTING_INDEXES, (table,))
+        indexes = {name for name, in sql_cursor.fetchall()}
+        sql_cursor.execute(EXISTING_FOREIGN_KEYS, (table,))
+        foreign_keys = {name for name, in sql_cursor.fetchall()}
+        return (
+            [name for name in INDEXES.get(table, {}) if name in indexes],
+            [name for name in FOREIGN_KEYS.get(table, {}) if name in foreign_keys],
+        )
+
+    # drops the keys that exist and returns the statements that add them back
+    def drop_keys(self, sql_cursor):
+        add_statements = []
+        for table in ("wishlist", "book"):
+            indexes, foreign_keys = self.existing_keys(sql_cursor, table)
+            # the foreign keys go first, an index can not be dropped while a constraint needs it
+            for drop, names in (("DROP FOREIGN KEY", foreign_keys), ("DROP INDEX", indexes)):
+                if names:
+                    clauses = ", ".join(f"{drop} {name}" for name in names)
+                    statement = f"ALTER TABLE {table} {clauses}"
+                    self.step(sql_cursor, statement, statement)
+            for add_clauses, names in ((INDEXES, indexes), (FOREIGN_KEYS, foreign_keys)):
+                if names:
+                    clauses = ", ".join(add_clauses[table][name] for name in names)
+                    add_statements.append(f"ALTER TABLE {table} {clauses}")
+        return add_statements
+
+    def load(self, paths):
+        total_start = time.perf_counter()
+        database_connection = self.connect()
+        try:
+            sql_cursor = SQLDriver.cursor(database_connection)
+            sql_cursor.execute("SET SESSION foreign_key_checks = 0")
+            sql_cursor.execute("SET SESSION unique_checks = 0")
+
+            for statement in DROP_VERSION_TRIGGERS:
+                self.step(sql_cursor, statement, statement)
+            try:
+                add_keys = self.drop_keys(sql_cursor)
+                for table in TABLES:
+                    self.step(sql_cursor, f"truncate {table}", f"TRUNCATE TABLE {table}")
+
+                for table in TABLES:
+                    start = time.perf_counter()
+                    if self.method == self.INFILE:
+                        self.load_infile(sql_cursor, table, paths[table])
+                    else:
+                        self.load_inserts(database_connection, table, paths[table])
+                    database_connection.commit()
+                    self.report(f"{time.perf_counter() - start:8.2f}s  load {table}")
+
+                for statement in add_keys:
+                    self.step(sql_cursor, statement, statement)
+            finally:
+                # the triggers come back even when the load fails so cached catalogs keep being told
+                for statement in ADD_VERSION_TRIGGERS:
+                    self.step(sql_cursor, statement, statement)
+
+            # the triggers were off for the load so cached catalogs must be told explicitly
+            self.step(
+                sql_cursor,
+                "bump catalog versions",
+                "UPDATE catalog_version SET version = version + 1",
+            )
+            self.step(sql_cursor, "analyze tables", "ANALYZE TABLE " + ", ".join(TABLES))
+            sql_cursor.fetchall()
+            database_connection.commit()
+        finally:
+            database_connection.close()
+        self.report(f"{time.perf_counter() - total_start:8.2f}s  total")
+
+    @staticmethod
+    def load_infile(sql_cursor, table, path):
+        columns = ", ".join(COLUMNS[table])
+        sql_cursor.execute(
+            f"LOAD DATA LOCAL INFILE %s INTO TABLE {table} "
+            "CHARACTER SET utf8mb4 FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' "
+            f"({columns})",
+            (os.path.abspath(path),),
+        )
+
+    # multi-row inserts for servers that do not allow local infile
+    @staticmethod
+    def load_inserts(database_connection, table, path):
+        columns = ", ".join(COLUMNS[table])
+        placeholders = ", ".join([SQLDriver.backend().PLACEHOLDER] * len(COLUMNS[table]))
+        query = f"INSERT INTO {table}({columns}) VALUES({placeholders})"
+        sql_cursor = SQLDriver.cursor(database_connection)
+        with open(path, encoding="utf-8") as table_file:
+            rows = (
+                [None if value == NULL else value for value in line.rstrip("\n").split("\t")]
+                for line in table_file
+            )
+            while batch := list(itertools.islice(rows, INSERT_BATCH_SIZE)):
+                sql_cursor.executemany(query, batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate and load whatabook datasets")
+    parser.add_argument("--scale", type=float, default=1.0, help="scale factor")
+    parser.add_argument("--seed", type=int, default=310)
+    parser.add_argument(
+        "--avg-wishlist", type=float, default=25, help="average books on a user's wishlist"
+    )
+    parser.add_argument("--zipf", type=float, default=1.1, help="wishlist zipf exponent")
+    parser.add_argument("--output", default="data", help="directory for the generated files")
+    parser.add_argument(
+        "--method",
+        choices=[BulkLoader.INFILE, BulkLoader.INSERT],
+        default=BulkLoader.INFILE,
+        help="LOAD DATA LOCAL INFILE or multi-row inserts",
+    )
+    parser.add_argument(
+        "--no-load", action="store_true", help="only write the files, do not load them"
+    )
+    args = parser.parse_args()
+
+    generator = DatasetGenerator(args.scale, args.seed, args.avg_wishlist, args.zipf)
+    paths = generator.write(args.output)
+    if not args.no_load:
+        BulkLoader(args.method).load(paths)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,922 @@
+import ast
+import atexit
+import os
+import re
+import threading
+import time
+import weakref
+from abc import ABC, abstractmethod
+from collections import deque
+from whatabook_errors import (
+    ConfigNotSetError,
+    IllegalArgumentError,
+    PoolClosedError,
+    PoolExhaustedError,
+)
+from whatabook_config import (
+    SQLConfiguration,
+    SQLEnvironment,
+)
+
+"""
+    Title: whatabook_db.py
+    Description: Database driver backends, the named query registry,
+        the connection pool and the read replica router
+"""
+
+
+# Database driver backends
+# Every backend imports its driver on first use
+# so importing whatabook stays fast and works for --help or the unit tests without a database
+# Backends differ in how they open connections, prepare cursors, start transactions and report errors,
+# everything above them only talks to the SQLDriver
+class SQLBackend(ABC):
+
+    NAME = None
+    # placeholder the driver expects in place of the %s of the configured queries
+    PLACEHOLDER = "%s"
+    # the MySQL FULLTEXT search query can be used
+    FULLTEXT = True
+    # connections log in with the user and password from the environment
+    SERVER = True
+    # connect() option that lets LOAD DATA LOCAL INFILE read files on the client
+    LOCAL_INFILE = None
+
+    def __init__(self):
+        self._module = None
+
+    @abstractmethod
+    def import_module(self):
+        pass
+
+    def module(self):
+        if self._module is None:
+            self._module = self.import_module()
+        return self._module
+
+    def connect(self, config):
+        return self.module().connect(**config)
+
+    def error(self):
+        return self.module().Error
+
+    # errors after which a connection can not be used again
+    def connection_errors(self):
+        module = self.module()
+        return (module.InterfaceError, module.OperationalError)
+
+    # the server's error number, such as 1191 for a missing FULLTEXT index
+    @staticmethod
+    def errno(error):
+        if error.args and isinstance(error.args[0], int):
+            return error.args[0]
+        return None
+
+    # the server could not be reached or dropped the connection,
+    # the MySQL client reports those with error numbers from 2000 to 2999
+    def unreachable(self, error):
+        if isinstance(error, self.connection_errors()):
+            return True
+        errno = self.errno(error)
+        return errno is not None and 2000 <= errno < 3000
+
+    def cursor(self, connection, prepared=False):
+        return connection.cursor()
+
+    def begin(self, connection):
+        connection.begin()
+
+    def ping(self, connection):
+        connection.ping(reconnect=False)
+
+    # ends a transaction left open so the next checkout of a pooled connection starts clean
+    def reset(self, connection):
+        if connection.in_transaction:
+            connection.rollback()
+
+
+# mysql-connector-python, with its C extension when it is installed
+class MySQLConnectorBackend(SQLBackend):
+
+    NAME = "mysql_connector"
+    LOCAL_INFILE = "allow_local_infile"
+    # None leaves the choice between the C extension and pure Python to the driver
+    USE_PURE = None
+
+    def import_module(self):
+        import mysql.connector
+
+        return mysql.connector
+
+    def connect(self, config):
+        module = self.module()
+        if self.USE_PURE is not None:
+            if not self.USE_PURE and not module.HAVE_CEXT:
+                raise ConfigNotSetError("The mysql-connector C extension is not installed")
+            config = dict(config, use_pure=self.USE_PURE)
+        return module.connect(**config)
+
+    def connection_errors(self):
+        errors = self.module().errors
+        return (errors.InterfaceError, errors.OperationalError)
+
+    @staticmethod
+    def errno(error):
+        return getattr(error, "errno", None)
+
+    # named queries are server side prepared statements
+    def cursor(self, connection, prepared=False):
+        return connection.cursor(prepared=prepared)
+
+    def begin(self, connection):
+        connection.start_transaction()
+
+
+class MySQLConnectorPureBackend(MySQLConnectorBackend):
+
+    NAME = "mysql_connector_pure"
+    USE_PURE = True
+
+
+class MySQLConnectorCBackend(MySQLConnectorBackend):
+
+    NAME = "mysql_connector_c"
+    USE_PURE = False
+
+
+# PyMySQL, pure Python
+# cursors are unbuffered so rows are only read from the server as they are fetched
+class PyMySQLBackend(SQLBackend):
+
+    NAME = "pymysql"
+    LOCAL_INFILE = "local_infile"
+
+    def import_module(self):
+        import pymysql
+
+        return pymysql
+
+    def connect(self, config):
+        config = dict(config)
+        config.pop("raise_on_warnings", None)
+        return self.module().connect(**config)
+
+    def cursor(self, connection, prepared=False):
+        return connection.cursor(self.module().cursors.SSCursor)
+
+    # PyMySQL and MySQLdb connections do not track whether a transaction is open
+    def reset(self, connection):
+        connection.rollback()
+
+
+# mysqlclient (MySQLdb), a C extension over libmysqlclient
+class MySQLClientBackend(PyMySQLBackend):
+
+    NAME = "mysqlclient"
+
+    def import_module(self):
+        import MySQLdb
+
+        return MySQLdb
+
+    def begin(self, connection):
+        connection.cursor().execute("START TRANSACTION")
+
+    def ping(self, connection):
+        connection.ping()
+
+
+# Embedded SQLite file for local runs without a MySQL server
+# A new file is created with whatabook_sqlite.sql, the same tables and sample rows as whatabook_init.sql
+# Queries that use MySQL only syntax are replaced by the QUERIES.sqlite section of the configuration file
+# and book search uses the in-process index
+class SQLiteBackend(SQLBackend):
+
+    NAME = "sqlite"
+    PLACEHOLDER = "?"
+    FULLTEXT = False
+    SERVER = False
+    SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "whatabook_sqlite.sql")
+
+    # schema is the script run on a new file
+    def __init__(self, schema=SCHEMA):
+        super().__init__()
+        self.schema = schema
+        self._connection_class = None
+        self._schema_lock = threading.Lock()
+
+    def import_module(self):
+        import sqlite3
+
+        return sqlite3
+
+    # the pool keeps per connection state in a WeakKeyDictionary
+    # and sqlite3.Connection can not be weakly referenced, a subclass can
+    def connection_class(self):
+        if self._connection_class is None:
+
+            class SQLiteConnection(self.module().Connection):
+                pass
+
+            self._connection_class = SQLiteConnection
+        return self._connection_class
+
+    # connections are handed between threads by the pool, one thread at a time
+    def connect(self, config):
+        connection = self.module().connect(
+            config["database"],
+            isolation_level=None,
+            check_same_thread=False,
+            factory=self.connection_class(),
+        )
+        connection.execute("PRAGMA foreign_keys = ON")
+        if config["database"] != ":memory:":
+            # readers are not blocked while a wishlist is written
+            connection.execute("PRAGMA journal_mode = WAL")
+        self.create_schema(connection)
+        return connection
+
+    def create_schema(self, connection):
+        with self._schema_lock:
+            exists = connection.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'book'"
+            ).fetchone()[0]
+            if not exists:
+                with open(self.schema) as schema_file:
+                    connection.executescript(schema_file.read())
+
+    def connection_errors(self):
+        module = self.module()
+        return (module.InterfaceError, module.ProgrammingError)
+
+    @staticmethod
+    def errno(error):
+        return getattr(error, "sqlite_errorcode", None)
+
+    # the file is always there
+    def unreachable(self, error):
+        return False
+
+    def begin(self, connection):
+        connection.execute("BEGIN")
+
+    def ping(self, connection):
+        connection.execute("SELECT 1")
+
+
+# The backend every connection is opened with, picked by BACKEND in the CONNECTION section
+class SQLDriver:
+
+    BACKENDS = {
+        backend.NAME: backend
+        for backend in (
+            MySQLConnectorBackend,
+            MySQLConnectorPureBackend,
+            MySQLConnectorCBackend,
+            PyMySQLBackend,
+            MySQLClientBackend,
+            SQLiteBackend,
+        )
+    }
+    DEFAULT = MySQLConnectorBackend.NAME
+
+    _backend = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def backend(cls):
+        if cls._backend is None:
+            with cls._lock:
+                if cls._backend is None:
+                    cls._backend = cls.create(cls.configured_name())
+        return cls._backend
+
+    @classmethod
+    def configured_name(cls):
+        try:
+            connection_config = SQLConfiguration.load_connection_config()
+        except KeyError:
+            return cls.DEFAULT
+        return connection_config.get(SQLConfiguration.BACKEND, cls.DEFAULT) or cls.DEFAULT
+
+    @classmethod
+    def create(cls, name):
+        try:
+            return cls.BACKENDS[name]()
+        except KeyError:
+            raise ConfigNotSetError(f"Unknown database backend {name}")
+
+    # switches to another backend, the shared pools are closed and the queries reloaded for it
+    @classmethod
+    def use(cls, name):
+        backend = cls.create(name)
+        SQLReplicaRouter.close_router()
+        SQLConnectionPool.close_pool()
+        with cls._lock:
+            cls._backend = backend
+        SQLQueryRegistry.reload()
+        return backend
+
+    @classmethod
+    def module(cls):
+        return cls.backend().module()
+
+    @classmethod
+    def connect(cls, **config):
+        return cls.backend().connect(config)
+
+    @classmethod
+    def error(cls):
+        return cls.backend().error()
+
+    @classmethod
+    def connection_errors(cls):
+        return cls.backend().connection_errors()
+
+    @classmethod
+    def errno(cls, error):
+        return cls.backend().errno(error)
+
+    @classmethod
+    def unreachable(cls, error):
+        return isinstance(error, cls.error()) and cls.backend().unreachable(error)
+
+    @classmethod
+    def cursor(cls, connection, prepared=False):
+        return cls.backend().cursor(connection, prepared)
+
+    @classmethod
+    def begin(cls, connection):
+        cls.backend().begin(connection)
+
+    @classmethod
+    def ping(cls, connection):
+        cls.backend().ping(connection)
+
+    @classmethod
+    def reset(cls, connection):
+        cls.backend().reset(connection)
+
+
+# A named query from the QUERIES section of the configuration file
+# The sql is kept in placeholder form so values are always sent separately from the statement
+# tables holds every table the query reads or writes and writes the table it changes, if any
+class SQLQuery:
+
+    # ON DUPLICATE KEY UPDATE is followed by a column, not a table
+    TABLE = re.compile(r"\b(?:FROM|JOIN|INTO|(?<!KEY )UPDATE|TABLE)\s+`?(\w+)", re.IGNORECASE)
+    WRITE = re.compile(
+        r"^\s*(?:INSERT\s+(?:IGNORE\s+)?INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM"
+        r"|ALTER\s+TABLE|TRUNCATE\s+(?:TABLE\s+)?|DROP\s+TABLE|CREATE\s+TABLE)\s+`?(\w+)",
+        re.IGNORECASE,
+    )
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.tables = self.parse_tables(sql)
+        self.writes = self.parse_write(sql)
+
+    @classmethod
+    def parse_tables(cls, sql):
+        return frozenset(table.lower() for table in cls.TABLE.findall(sql))
+
+    @classmethod
+    def parse_write(cls, sql):
+        match = cls.WRITE.match(sql)
+        return match.group(1).lower() if match else None
+
+    def __repr__(self):
+        return f"SQLQuery({self.name!r}, {self.sql!r})"
+
+
+# Loads the named queries once and converts them to placeholder form
+# Queries are looked up by their lowercase name, for example SQLQueryRegistry.get("get_books")
+# and are executed as server side prepared statements cached per pooled connection
+# The backend's own versions of a query replace the shared ones and %s becomes the backend's placeholder
+# Queries are loaded for the configured backend unless another backend is given,
+# such as the SQLite file of the offline replica
+class SQLQueryRegistry:
+
+    PLACEHOLDER = "%s"
+    # placeholder used by older configuration files
+    FORMAT_PLACEHOLDER = "{}"
+
+    # backend name -> query name -> SQLQuery
+    _queries = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def load(cls, backend=None):
+        backend = backend if backend is not None else SQLDriver.backend()
+        with cls._lock:
+            queries = cls._queries.get(backend.NAME)
+            if queries is None:
+                try:
+                    sql_queries = dict(SQLConfiguration.load_query_config())
+                except KeyError:
+                    raise ConfigNotSetError
+
+                try:
+                    sql_queries.update(SQLConfiguration.load_backend_query_config(backend.NAME))
+                except KeyError:
+                    pass
+
+                queries = cls._queries[backend.NAME] = {
+                    name: SQLQuery(
+                        name, cls.to_placeholders(ast.literal_eval(sql), backend.PLACEHOLDER)
+                    )
+                    for name, sql in sql_queries.items()
+                }
+            return queries
+
+    # forgets the loaded queries, the next lookup loads them for the current backend
+    @classmethod
+    def reload(cls):
+        with cls._lock:
+            cls._queries = {}
+
+    @classmethod
+    def to_placeholders(cls, sql, placeholder=PLACEHOLDER):
+        sql = sql.replace(cls.FORMAT_PLACEHOLDER, cls.PLACEHOLDER)
+        if placeholder != cls.PLACEHOLDER:
+            sql = sql.replace(cls.PLACEHOLDER, placeholder)
+        return sql
+
+    @classmethod
+    def get(cls, name, backend=None):
+        try:
+            return cls.load(backend)[name]
+        except KeyError:
+            raise ConfigNotSetError(f"Query {name} not set")
+
+
+# Process-wide, bounded pool of database connections
+# Connections are opened lazily up to MAX_SIZE and handed back to the pool on exit
+# so the configuration, environment and MySQL handshake are only paid once per connection
+# Idle connections above MIN_SIZE are closed after IDLE_TIMEOUT seconds
+# and every checked out connection is pinged first when HEALTH_CHECK is enabled
+class SQLConnectionPool:
+
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    def __init__(
+        self,
+        config,
+        min_size=1,
+        max_size=5,
+        idle_timeout=300,
+        checkout_timeout=10,
+        health_check=True,
+    ):
+        if max_size < 1 or not 0 <= min_size <= max_size:
+            raise IllegalArgumentError("Invalid connection pool size")
+
+        self.config = config
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check = health_check
+
+        # idle connections are stored as (connection, time returned) pairs
+        self._idle = deque()
+        # prepared statement cursors by query name for every open connection
+        self._statements = weakref.WeakKeyDictionary()
+        self._size = 0
+        # set by close(), connections handed back after that are closed instead of kept
+        self._closed = False
+        self._condition = threading.Condition()
+        self._stats = {
+            "created": 0,
+            "reused": 0,
+            "prepared": 0,
+            "checkouts": 0,
+            "discarded": 0,
+            "expired": 0,
+            "failed_health_checks": 0,
+            "waits": 0,
+            "timeouts": 0,
+        }
+
+    # backend is the one the settings are for, the configured one when it is None
+    @staticmethod
+    def load_config(host=None, port=None, backend=None):
+        try:
+            connection_config = SQLConfiguration.load_connection_config()
+        except KeyError:
+            raise ConfigNotSetError
+
+        backend = backend if backend is not None else SQLDriver.backend()
+        # an embedded database is a file, there is no server to log in to
+        if not backend.SERVER:
+            return {
+                "database": connection_config.get(
+                    SQLConfiguration.SQLITE_PATH, "whatabook.sqlite3"
+                )
+            }
+
+        env = SQLEnvironment.load()
+
+        config = {
+            "user": env["sql_user"],
+            "password": env["password"],
+            "host": host if host is not None else connection_config[SQLConfiguration.HOST],
+            "database": connection_config[SQLConfiguration.DATABASE],
+            "raise_on_warnings": connection_config.getboolean(
+                SQLConfiguration.RAISE_ON_WARNINGS
+            ),
+            # transactions are started explicitly when writing
+            # so a pooled connection never holds on to a stale read snapshot
+            "autocommit": True,
+        }
+        if port is None:
+            port = connection_config.getint(SQLConfiguration.PORT, None)
+        if port is not None:
+            config["port"] = port
+        return config
+
+    # the pool section is optional, the defaults are used when it is missing
+    # host and port replace the ones in the CONNECTION section, the replicas use the same settings
+    @classmethod
+    def from_config(cls, host=None, port=None):
+        try:
+            pool_config = SQLConfiguration.load_pool_config()
+        except KeyError:
+            return cls(cls.load_config(host, port))
+
+        return cls(
+            cls.load_config(host, port),
+            min_size=pool_config.getint(SQLConfiguration.MIN_SIZE, 1),
+            max_size=pool_config.getint(SQLConfiguration.MAX_SIZE, 5),
+            idle_timeout=pool_config.getfloat(SQLConfiguration.IDLE_TIMEOUT, 300),
+            checkout_timeout=pool_config.getfloat(
+                SQLConfiguration.CHECKOUT_TIMEOUT, 10
+            ),
+            health_check=pool_config.getboolean(SQLConfiguration.HEALTH_CHECK, True),
+        )
+
+    # shared pool used by every SQLConnection that is not given one explicitly
+    @classmethod
+    def get_pool(cls):
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = cls.from_config()
+            return cls._pool
+
+    @classmethod
+    def close_pool(cls):
+        with cls._pool_lock:
+            if cls._pool is not None:
+                cls._pool.close()
+                cls._pool = None
+
+    def connect(self):
+        return SQLDriver.connect(**self.config)
+
+    def is_healthy(self, connection):
+        try:
+            SQLDriver.ping(connection)
+            return True
+        except SQLDriver.error():
+            return False
+
+    # a connection is only ever used by one thread at a time
+    # so its prepared statements can be reused without locking
+    def statement(self, connection, query):
+        with self._condition:
+            statements = self._statements.setdefault(connection, {})
+
+        sql_cursor = statements.get(query.name)
+        if sql_cursor is None:
+            sql_cursor = SQLDriver.cursor(connection, prepared=True)
+            statements[query.name] = sql_cursor
+            self._count("prepared")
+        return sql_cursor
+
+    def acquire(self):
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._condition:
+            expired = self._expire_idle()
+            while True:
+                if self._closed:
+                    raise PoolClosedError
+                if self._idle:
+                    # most recently used first, keeps the warmest connections busy
+                    connection, _ = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    connection = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolExhaustedError
+                self._stats["waits"] += 1
+                self._condition.wait(remaining)
+            self._stats["checkouts"] += 1
+
+        for idle_connection in expired:
+            self._close(idle_connection)
+
+        if connection is not None:
+            if not self.health_check or self.is_healthy(connection):
+                self._count("reused")
+                return connection
+            # keep the slot and replace the broken connection
+            self._count("failed_health_checks")
+            self._close(connection)
+
+        try:
+            connection = self.connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+        self._count("created")
+        return connection
+
+    def release(self, connection, discard=False):
+        if not discard:
+            try:
+                SQLDriver.reset(connection)
+            except SQLDriver.error():
+                discard = True
+
+        with self._condition:
+            if discard:
+                self._stats["discarded"] += 1
+            # the pool was closed while the connection was checked out
+            discard = discard or self._closed
+            if discard:
+                self._size -= 1
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+        if discard:
+            self._close(connection)
+
+    # closes the idle connections now and the checked out ones as they are released,
+    # threads waiting for a connection and later checkouts get PoolClosedError
+    def close(self):
+        with self._condition:
+            self._closed = True
+            idle = [connection for connection, _ in self._idle]
+            self._size -= len(idle)
+            self._idle.clear()
+            self._condition.notify_all()
+        for connection in idle:
+            self._close(connection)
+
+    def statistics(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._size - len(self._idle)
+            stats["min_size"] = self.min_size
+            stats["max_size"] = self.max_size
+        return stats
+
+    # must be called while holding the condition
+    # returns the connections that should be closed once the lock is released
+    def _expire_idle(self):
+        expired = []
+        now = time.monotonic()
+        # the oldest idle connections are at the left of the deque
+        while (
+            self._idle
+            and self._size > self.min_size
+            and now - self._idle[0][1] > self.idle_timeout
+        ):
+            connection, _ = self._idle.popleft()
+            self._size -= 1
+            self._stats["expired"] += 1
+            expired.append(connection)
+        return expired
+
+    def _count(self, stat):
+        with self._condition:
+            self._stats[stat] += 1
+
+    def _close(self, connection):
+        with self._condition:
+            self._statements.pop(connection, None)
+        try:
+            connection.close()
+        except SQLDriver.error():
+            pass
+
+
+atexit.register(SQLConnectionPool.close_pool)
+
+
+# Spreads reads over read replicas of the primary database
+# REPLICAS in the CONNECTION section lists them as host or host:port, comma separated
+# READ_ROUTING picks the replica for every checkout, round_robin takes them in turn
+# and least_latency takes the one with the lowest running average checkout time
+# A replica that can not hand out a connection is skipped for REPLICA_RETRY_INTERVAL seconds
+# and its reads go to the primary, the router is used like a connection pool
+class SQLReplicaRouter:
+
+    ROUND_ROBIN = "round_robin"
+    LEAST_LATENCY = "least_latency"
+    # least_latency sends one checkout in PROBE_INTERVAL round robin so slower replicas are measured again
+    PROBE_INTERVAL = 16
+    # weight of the newest checkout time in the running average
+    LATENCY_WEIGHT = 0.2
+
+    _router = None
+    _router_lock = threading.Lock()
+
+    def __init__(self, replicas, primary=None, routing=ROUND_ROBIN, sticky_seconds=5, retry_interval=30):
+        if not replicas:
+            raise IllegalArgumentError("No read replicas")
+        if routing not in (self.ROUND_ROBIN, self.LEAST_LATENCY):
+            raise IllegalArgumentError(f"Invalid read routing {routing}")
+
+        self.replicas = list(replicas)
+        self.primary = primary
+        self.routing = routing
+        self.sticky_seconds = sticky_seconds
+        self.retry_interval = retry_interval
+
+        self._lock = threading.Lock()
+        self._checkouts = 0
+        # connection -> (replica index or None for the primary, checkout time)
+        self._owners = {}
+        self._latency = [None] * len(self.replicas)
+        self._failed_until = [0.0] * len(self.replicas)
+        self._stats = [{"reads": 0, "failures": 0} for _ in self.replicas]
+        self._primary_reads = 0
+        self._closed = False
+
+    # returns None when no replicas are configured
+    @classmethod
+    def from_config(cls):
+        try:
+            connection_config = SQLConfiguration.load_connection_config()
+        except KeyError:
+            raise ConfigNotSetError
+
+        replicas = [
+            replica.strip()
+            for replica in connection_config.get(SQLConfiguration.REPLICAS, "").split(",")
+            if replica.strip()
+        ]
+        if not replicas:
+            return None
+
+        return cls(
+            [SQLConnectionPool.from_config(*cls.parse_address(replica)) for replica in replicas],
+            routing=connection_config.get(SQLConfiguration.READ_ROUTING, cls.ROUND_ROBIN)
+            .strip()
+            .lower(),
+            sticky_seconds=connection_config.getfloat(SQLConfiguration.STICKY_SECONDS, 5),
+            retry_interval=connection_config.getfloat(
+                SQLConfiguration.REPLICA_RETRY_INTERVAL, 30
+            ),
+        )
+
+    @staticmethod
+    def parse_address(address):
+        host, _, port = address.partition(":")
+        return host, int(port) if port else None
+
+    # shared router used by every SQLInterface that is not given a pool explicitly
+    @classmethod
+    def get_router(cls):
+        with cls._router_lock:
+            if cls._router is None:
+                # False remembers that there are no replicas
+                cls._router = cls.from_config() or False
+            return cls._router or None
+
+    @classmethod
+    def close_router(cls):
+        with cls._router_lock:
+            if cls._router:
+                cls._router.close()
+            cls._router = None
+
+    def get_primary(self):
+        return self.primary if self.primary is not None else SQLConnectionPool.get_pool()
+
+    # index of the replica for the next checkout, None when every replica is failing
+    def choose(self):
+        now = time.monotonic()
+        with self._lock:
+            available = [
+                replica
+                for replica, failed_until in enumerate(self._failed_until)
+                if failed_until <= now
+            ]
+            if not available:
+                return None
+
+            self._checkouts += 1
+            if self.routing == self.ROUND_ROBIN or self._checkouts % self.PROBE_INTERVAL == 0:
+                return available[self._checkouts % len(available)]
+            # replicas without a measurement yet are tried first
+            return min(available, key=lambda replica: self._latency[replica] or 0.0)
+
+    def acquire(self):
+        if self._closed:
+            raise PoolClosedError
+        replica = self.choose()
+        if replica is not None:
+            try:
+                connection = self.replicas[replica].acquire()
+            except (PoolExhaustedError, SQLDriver.error()):
+                self.fail(replica)
+            else:
+                with self._lock:
+                    self._owners[connection] = (replica, time.perf_counter())
+                return connection
+
+        connection = self.get_primary().acquire()
+        with self._lock:
+            self._owners[connection] = (None, time.perf_counter())
+            self._primary_reads += 1
+        return connection
+
+    def release(self, connection, discard=False):
+        with self._lock:
+            replica, checked_out = self._owners.pop(connection)
+            if replica is not None:
+                elapsed = time.perf_counter() - checked_out
+                latency = self._latency[replica]
+                self._latency[replica] = (
+                    elapsed if latency is None else latency + self.LATENCY_WEIGHT * (elapsed - latency)
+                )
+                self._stats[replica]["reads"] += 1
+        self.pool_of(replica).release(connection, discard)
+
+    def statement(self, connection, query):
+        with self._lock:
+            replica, _ = self._owners[connection]
+        return self.pool_of(replica).statement(connection, query)
+
+    def pool_of(self, replica):
+        return self.get_primary() if replica is None else self.replicas[replica]
+
+    def fail(self, replica):
+        with self._lock:
+            self._failed_until[replica] = time.monotonic() + self.retry_interval
+            self._latency[replica] = None
+            self._stats[replica]["failures"] += 1
+
+    # connections checked out of the replicas are closed by their pools as they are released
+    def close(self):
+        self._closed = True
+        for pool in self.replicas:
+            pool.close()
+
+    def statistics(self):
+        now = time.monotonic()
+        with self._lock:
+            replicas = [
+                {
+                    "host": pool.config["host"],
+                    "port": pool.config.get("port"),
+                    "available": self._failed_until[replica] <= now,
+                    "latency_ms": (
+                        self._latency[replica] * 1000
+                        if self._latency[replica] is not None
+                        else None
+                    ),
+                    **self._stats[replica],
+                }
+                for replica, pool in enumerate(self.replicas)
+            ]
+            primary_reads = self._primary_reads
+        for replica, pool in zip(replicas, self.replicas):
+            replica["pool"] = pool.statistics()
+        return {"routing": self.routing, "primary_reads": primary_reads, "replicas": replicas}
+
+
+atexit.register(SQLReplicaRouter.close_router)
+
+
+# Context manager that will check a connection out of the pool on entry and return it to the pool on exit
+# Connections that failed at the network level are discarded instead of being reused
+class SQLConnection:
+    def __init__(self, pool=None):
+        self.pool = pool if pool is not None else SQLConnectionPool.get_pool()
+        # set when the connection is left in a state that can not be reused
+        self.discard = False
+
+    def __enter__(self):
+        self.db = self.pool.acquire()
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        discard = self.discard or (
+            exc_value is not None and isinstance(exc_value, SQLDriver.connection_errors())
+        )
+        self.pool.release(self.db, discard)
@@ -0,0 +1,58 @@
+
+"""
+    Title: whatabook_errors.py
+    Description: Custom errors shared by the Whatabook modules
+"""
+
+# Custom errors for common mistakes in program
+
+
+class EnviromentNotSetError(Exception):
+    def __init__(self, message="Environment variables not set"):
+        super().__init__(message)
+
+
+class ConfigNotSetError(Exception):
+    def __init__(self, message="Configuration not set"):
+        super().__init__(message)
+
+
+class TableNotFoundError(Exception):
+    def __init__(self, table_name):
+        self.table_name = table_name
+        message = f"{self.table_name} table not found"
+        super().__init__(message)
+
+
+class IllegalArgumentError(ValueError):
+    def __init__(self, message="Invalid Choice for Menu"):
+        super().__init__(message)
+
+
+class InvalidUserError(Exception):
+    def __init__(self, message="Invalid User"):
+        super().__init__(message)
+
+
+class InvalidBookError(Exception):
+    def __init__(self, book_ids=()):
+        self.book_ids = list(book_ids)
+        message = "Invalid Book ID"
+        if self.book_ids:
+            message += ": " + ", ".join(str(book_id) for book_id in self.book_ids)
+        super().__init__(message)
+
+
+class MigrationError(Exception):
+    def __init__(self, message="Invalid migration"):
+        super().__init__(message)
+
+
+class PoolExhaustedError(Exception):
+    def __init__(self, message="No database connections available, try again..."):
+        super().__init__(message)
+
+
+class PoolClosedError(Exception):
+    def __init__(self, message="The database connections are closed"):
+        super().__init__(message)
@@ -23,6 +23,9 @@ DROP TABLE IF EXISTS store;
 DROP TABLE IF EXISTS book;
 DROP TABLE IF EXISTS wishlist;
 DROP TABLE IF EXISTS user;
+DROP TABLE IF EXISTS catalog_version;
+DROP TABLE IF EXISTS schema_version;
+DROP TABLE IF EXISTS schema_migration_step;
 
 /*
     Create table(s)
@@ -38,7 +41,9 @@ CREATE TABLE book (
     book_name   VARCHAR(200)    NOT NULL,
     author      VARCHAR(200)    NOT NULL,
     details     VARCHAR(500),
-    PRIMARY KEY(book_id)
+    PRIMARY KEY(book_id),
+    -- ranked book search
+    FULLTEXT INDEX ft_book_search (book_name, author, details)
 );
 
 CREATE TABLE user (
@@ -53,6 +58,11 @@ CREATE TABLE wishlist (
     user_id         INT         NOT NULL,
     book_id         INT         NOT NULL,
     PRIMARY KEY (wishlist_id),
+    -- covers the wishlist lookups and the available books anti-join for a user
+    UNIQUE INDEX ux_wishlist_user_book (user_id, book_id),
+    INDEX ix_wishlist_book (book_id),
+    -- the wishlist pages of a user in wishlist_id order
+    INDEX ix_wishlist_user_wishlist (user_id, wishlist_id),
     CONSTRAINT fk_book
     FOREIGN KEY (book_id)
         REFERENCES book(book_id),
@@ -61,6 +71,64 @@ CREATE TABLE wishlist (
         REFERENCES user(user_Id)
 );
 
+-- migrations applied to the schema, see the migrations directory
+CREATE TABLE schema_version (
+    version         INT             NOT NULL,
+    name            VARCHAR(200)    NOT NULL,
+    applied_at      DATETIME        NOT NULL    DEFAULT CURRENT_TIMESTAMP,
+    duration_ms     DOUBLE          NOT NULL    DEFAULT 0,
+    PRIMARY KEY(version)
+);
+
+-- this script already creates everything the migrations below add
+INSERT INTO schema_version(version, name)
+    VALUES
+        (1, 'wishlist_indexes'),
+        (2, 'wishlist_unique_user_book'),
+        (3, 'catalog_version'),
+        (4, 'book_fulltext'),
+        (5, 'wishlist_user_page');
+
+-- statements finished by a migration that failed partway, it resumes after them
+CREATE TABLE schema_migration_step (
+    version         INT             NOT NULL,
+    direction       VARCHAR(4)      NOT NULL,
+    step            INT             NOT NULL,
+    finished_at     DATETIME        NOT NULL    DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY(version, direction, step)
+);
+
+-- version counters for the catalog tables, checked by the program before re-reading a cached table
+CREATE TABLE catalog_version (
+    table_name      VARCHAR(64) NOT NULL,
+    version         BIGINT      NOT NULL    DEFAULT 0,
+    PRIMARY KEY(table_name)
+);
+
+INSERT INTO catalog_version(table_name)
+    VALUES('book'), ('store');
+
+/*
+    bump the catalog version whenever a catalog table changes
+*/
+CREATE TRIGGER book_insert_version AFTER INSERT ON book
+    FOR EACH ROW UPDATE catalog_version SET version = version + 1 WHERE table_name = 'book';
+
+CREATE TRIGGER book_update_version AFTER UPDATE ON book
+    FOR EACH ROW UPDATE catalog_version SET version = version + 1 WHERE table_name = 'book';
+
+CREATE TRIGGER book_delete_version AFTER DELETE ON book
+    FOR EACH ROW UPDATE catalog_version SET version = version + 1 WHERE table_name = 'book';
+
+CREATE TRIGGER store_insert_version AFTER INSERT ON store
+    FOR EACH ROW UPDATE catalog_version SET version = version + 1 WHERE table_name = 'store';
+
+CREATE TRIGGER store_update_version AFTER UPDATE ON store
+    FOR EACH ROW UPDATE catalog_version SET version = version + 1 WHERE table_name = 'store';
+
+CREATE TRIGGER store_delete_version AFTER DELETE ON store
+    FOR EACH ROW UPDATE catalog_version SET version = version + 1 WHERE table_name = 'store';
+
 /*
     insert store record 
 */
@@ -0,0 +1,372 @@
+import time
+from contextlib import contextmanager
+from whatabook_errors import IllegalArgumentError
+from whatabook_db import (
+    SQLConnection,
+    SQLConnectionPool,
+    SQLDriver,
+    SQLQuery,
+    SQLReplicaRouter,
+)
+from whatabook_stats import (
+    QueryStatistics,
+    Tracer,
+)
+
+"""
+    Title: whatabook_interface.py
+    Description: Runs the named queries and transactions against the database
+"""
+
+
+# Manage interfacing with the database
+# Reads (fetch, iterate) go to the read replicas when there are any, writes always go to the primary
+# A session that writes reads from the primary for STICKY_SECONDS so it sees its own writes,
+# sessions are any key the caller picks, Whatabook uses the user id
+# Named reads are answered from result_cache when one is given and writes drop the results they change
+# Every query is timed phase by phase into stats when one is given
+class SQLInterface:
+
+    # rows read from the server per round trip by iterate()
+    BATCH_SIZE = 500
+
+    def __init__(self, pool=None, router=None, result_cache=None, stats=None, batch_size=BATCH_SIZE):
+        self.pool = pool
+        self.router = router
+        self.result_cache = result_cache
+        self.stats = stats
+        self.batch_size = batch_size
+        # session -> time until which its reads go to the primary
+        self._sticky = {}
+
+    def connection(self, pool=None):
+        return SQLConnection(pool if pool is not None else self.pool)
+
+    def get_pool(self):
+        return self.pool if self.pool is not None else SQLConnectionPool.get_pool()
+
+    # an explicit pool is a single database, the replicas are only used with the shared pools
+    def get_router(self):
+        if self.router is not None:
+            return self.router
+        return SQLReplicaRouter.get_router() if self.pool is None else None
+
+    def pool_statistics(self):
+        return self.get_pool().statistics()
+
+    def replica_statistics(self):
+        router = self.get_router()
+        return router.statistics() if router is not None else None
+
+    # pins the session's reads to the primary after it writes
+    def stick(self, session=None):
+        router = self.get_router()
+        if router is None:
+            return
+        now = time.monotonic()
+        if len(self._sticky) > 1024:
+            self._sticky = {key: until for key, until in self._sticky.items() if until > now}
+        self._sticky[session] = now + router.sticky_seconds
+
+    def is_sticky(self, session=None):
+        now = time.monotonic()
+        return self._sticky.get(session, 0) > now or self._sticky.get(None, 0) > now
+
+    # the pool a read of the session checks out from
+    def read_pool(self, session=None):
+        router = self.get_router()
+        if router is None or self.is_sticky(session):
+            return self.get_pool()
+        return router
+
+    # named queries reuse the prepared statement of the pooled connection
+    # while plain sql strings are sent as they are
+    def cursor(self, database_connection, query, pool=None):
+        if isinstance(query, SQLQuery):
+            pool = pool if pool is not None else self.get_pool()
+            return pool.statement(database_connection, query)
+        return database_connection.cursor()
+
+    @staticmethod
+    def sql(query):
+        return query.sql if isinstance(query, SQLQuery) else query
+
+    # the result cache when the query's results can be cached
+    def cache_for(self, query):
+        cache = self.result_cache
+        if cache is not None and isinstance(query, SQLQuery) and cache.accepts(query):
+            return cache
+        return None
+
+    def record_error(self, query, error):
+        if self.stats is not None:
+            self.stats.record_error(self.stats.name_of(query), error)
+
+    # the connect, execute and fetch phases are traced as spans inside the fetch span
+    @staticmethod
+    def trace_phases(start, connected, executed, fetched):
+        tracer = Tracer.get_tracer()
+        if tracer is not None:
+            tracer.record_phases(
+                "sql",
+                (
+                    (QueryStatistics.CONNECT, start, connected),
+                    (QueryStatistics.EXECUTE, connected, executed),
+                    (QueryStatistics.FETCH, executed, fetched),
+                ),
+            )
+
+    def fetch(self, query, params=(), session=None):
+        with Tracer.trace("SQLInterface.fetch", "sql", query=QueryStatistics.name_of(query)) as span:
+            rows = self.fetch_rows(query, params, session)
+            span["rows"] = len(rows)
+            return rows
+
+    # reads that another copy of the data may answer, Whatabook sends them to its offline replica
+    def read_rows(self, query, params=(), session=None):
+        return self.fetch(query, params, session)
+
+    def fetch_rows(self, query, params, session):
+        stats = self.stats
+        cache = self.cache_for(query)
+        if cache is not None:
+            key = cache.key(query, params)
+            rows = cache.get(key)
+            if rows is not None:
+                if stats is not None:
+                    stats.record_cache_hit(query.name)
+                return list(rows)
+            generations = cache.generations(query.tables)
+
+        pool = self.read_pool(session)
+        start = time.perf_counter()
+        try:
+            with self.connection(pool) as database_connection:
+                connected = time.perf_counter()
+                sql_cursor = self.cursor(database_connection, query, pool)
+                sql_cursor.execute(self.sql(query), params)
+                executed = time.perf_counter()
+                rows = sql_cursor.fetchall()
+                fetched = time.perf_counter()
+        except Exception as e:
+            self.record_error(query, e)
+            raise
+
+        self.trace_phases(start, connected, executed, fetched)
+        if stats is not None:
+            stats.record(
+                stats.name_of(query),
+                {
+                    stats.CONNECT: connected - start,
+                    stats.EXECUTE: executed - connected,
+                    stats.FETCH: fetched - executed,
+                },
+                len(rows),
+                params,
+            )
+        if cache is not None:
+            cache.put(key, query.tables, rows, generations)
+        return rows
+
+    # yields rows as they arrive from the server instead of reading the whole table first
+    # the cursors are unbuffered so the server sends the rows as they are read,
+    # batch_size rows at a time, and memory stays the same however large the result is
+    # the fetch phase only counts the time spent reading rows, not the time the caller holds each row
+    # a generator can not hold a span open across its yields so its span is recorded once the rows are read,
+    # it is kept when the caller is inside a sampled span
+    def iterate(self, query, params=(), session=None, batch_size=None):
+        batch_size = batch_size if batch_size is not None else self.batch_size
+        if batch_size < 1:
+            raise IllegalArgumentError("Invalid batch size")
+        stats = self.stats
+        cache = self.cache_for(query)
+        if cache is not None:
+            key = cache.key(query, params)
+            rows = cache.get(key)
+            if rows is not None:
+                if stats is not None:
+                    stats.record_cache_hit(query.name)
+                yield from rows
+                return
+            generations = cache.generations(query.tables)
+        collected = [] if cache is not None else None
+
+        pool = self.read_pool(session)
+        sql_connection = self.connection(pool)
+        start = time.perf_counter()
+        fetching = 0.0
+        count = 0
+        try:
+            with sql_connection as database_connection:
+                connected = time.perf_counter()
+                sql_cursor = self.cursor(database_connection, query, pool)
+                sql_cursor.execute(self.sql(query), params)
+                executed = time.perf_counter()
+                exhausted = False
+                try:
+                    while True:
+                        fetch_start = time.perf_counter()
+                        rows = sql_cursor.fetchmany(batch_size)
+                        fetching += time.perf_counter() - fetch_start
+                        if not rows:
+                            break
+                        count += len(rows)
+                        if collected is not None:
+                            collected.extend(rows)
+                            if len(collected) > cache.MAX_ROWS:
+                                collected = None
+                        yield from rows
+                    exhausted = True
+                finally:
+                    # a partly read result would block the next query on this connection
+                    sql_connection.discard = not exhausted
+        except Exception as e:
+            self.record_error(query, e)
+            raise
+
+        tracer = Tracer.get_tracer()
+        if tracer is not None and tracer.sampled():
+            tracer.record(
+                "SQLInterface.iterate",
+                "sql",
+                start,
+                time.perf_counter(),
+                {"query": QueryStatistics.name_of(query), "rows": count, "fetch_ms": fetching * 1000},
+            )
+            tracer.record_phases(
+                "sql",
+                (
+                    (QueryStatistics.CONNECT, start, connected),
+                    (QueryStatistics.EXECUTE, connected, executed),
+                ),
+            )
+        if stats is not None:
+            stats.record(
+                stats.name_of(query),
+                {
+                    stats.CONNECT: connected - start,
+                    stats.EXECUTE: executed - connected,
+                    stats.FETCH: fetching,
+                },
+                count,
+                params,
+            )
+        if collected is not None:
+            cache.put(key, query.tables, collected, generations)
+
+    # runs every statement of the block on one connection to the primary in a single transaction
+    # the transaction is rolled back if the block raises
+    # with stats the checkout and the commit are timed under the name "transaction"
+    # and every statement under its own name
+    @contextmanager
+    def transaction(self, session=None):
+        with Tracer.trace("SQLInterface.transaction", "sql"):
+            start = time.perf_counter()
+            with self.connection() as database_connection:
+                connected = time.perf_counter()
+                SQLDriver.begin(database_connection)
+                transaction = SQLTransaction(self, database_connection)
+                try:
+                    yield transaction
+                except Exception:
+                    database_connection.rollback()
+                    raise
+                commit_start = time.perf_counter()
+                database_connection.commit()
+                committed = time.perf_counter()
+
+            tracer = Tracer.get_tracer()
+            if tracer is not None:
+                tracer.record_phases(
+                    "sql",
+                    (
+                        (QueryStatistics.CONNECT, start, connected),
+                        (QueryStatistics.COMMIT, commit_start, committed),
+                    ),
+                )
+
+        if self.stats is not None:
+            self.stats.record(
+                "transaction",
+                {
+                    self.stats.CONNECT: connected - start,
+                    self.stats.COMMIT: committed - commit_start,
+                },
+            )
+
+        if self.result_cache is not None and transaction.tables_written:
+            self.result_cache.invalidate(*transaction.tables_written)
+        self.stick(session)
+
+    def commit(self, query, data, session=None):
+        with self.transaction(session) as transaction:
+            transaction.execute(query, data)
+
+    def insert(self, query, data=(), session=None):
+        self.commit(query, data, session)
+
+
+# Statements run inside SQLInterface.transaction()
+class SQLTransaction:
+    def __init__(self, interface, database_connection):
+        self.interface = interface
+        self.database_connection = database_connection
+        # tables changed by the transaction, their cached results are dropped once it commits
+        self.tables_written = set()
+
+    # statements are traced as spans inside the transaction's span
+    @staticmethod
+    def trace(name, query, start, end, rows):
+        tracer = Tracer.get_tracer()
+        if tracer is not None and tracer.sampled():
+            tracer.record(
+                name, "sql", start, end, {"query": QueryStatistics.name_of(query), "rows": rows}
+            )
+
+    def fetch(self, query, params=()):
+        start = time.perf_counter()
+        try:
+            sql_cursor = self.interface.cursor(self.database_connection, query)
+            sql_cursor.execute(self.interface.sql(query), params)
+            executed = time.perf_counter()
+            rows = sql_cursor.fetchall()
+            fetched = time.perf_counter()
+        except Exception as e:
+            self.interface.record_error(query, e)
+            raise
+
+        self.trace("SQLTransaction.fetch", query, start, fetched, len(rows))
+        stats = self.interface.stats
+        if stats is not None:
+            stats.record(
+                stats.name_of(query),
+                {stats.EXECUTE: executed - start, stats.FETCH: fetched - executed},
+                len(rows),
+                params,
+            )
+        return rows
+
+    # row counts of writes are the rows the statement changed
+    def execute(self, query, params=()):
+        start = time.perf_counter()
+        try:
+            sql_cursor = self.interface.cursor(self.database_connection, query)
+            sql_cursor.execute(self.interface.sql(query), params)
+            executed = time.perf_counter()
+        except Exception as e:
+            self.interface.record_error(query, e)
+            raise
+
+        self.trace("SQLTransaction.execute", query, start, executed, sql_cursor.rowcount)
+        stats = self.interface.stats
+        if stats is not None:
+            stats.record(
+                stats.name_of(query),
+                {stats.EXECUTE: executed - start},
+                max(sql_cursor.rowcount, 0),
+                params,
+            )
+        table = query.writes if isinstance(query, SQLQuery) else SQLQuery.parse_write(query)
+        if table is not None:
+            self.tables_written.add(table)
+        return sql_cursor.rowcount
@@ -0,0 +1,213 @@
+import os
+import time
+from whatabook_errors import MigrationError
+from whatabook_db import SQLQueryRegistry
+from whatabook_interface import SQLInterface
+
+"""
+    Title: whatabook_migrate.py
+    Description: Applies the versioned schema changes in the migrations directory
+"""
+
+
+# A versioned schema change from the migrations directory
+# Every migration is a pair of files named <version>_<name>.up.sql and <version>_<name>.down.sql
+class SQLMigration:
+    def __init__(self, version, name, directory):
+        self.version = version
+        self.name = name
+        self.directory = directory
+
+    def path(self, direction):
+        return os.path.join(self.directory, f"{self.version:04d}_{self.name}.{direction}.sql")
+
+    # "-- batch <table>.<column> <size>" above a statement runs it once per range of size keys
+    # of that column, the statement takes the first and last key of the range as its parameters
+    BATCH = "-- batch "
+
+    # statements end with a semicolon at the end of a line, other comment lines are skipped
+    # returns (statement, batch) pairs, batch is (table, column, size) or None
+    def statements(self, direction):
+        with open(self.path(direction)) as migration_file:
+            lines = migration_file.read().splitlines()
+
+        statements = []
+        statement = []
+        batch = None
+        for line in lines:
+            if line.strip().startswith(self.BATCH):
+                batch = self.parse_batch(line, direction)
+                continue
+            if line.strip().startswith("--"):
+                continue
+            statement.append(line)
+            if line.rstrip().endswith(";"):
+                statements.append(("\n".join(statement).strip().rstrip(";"), batch))
+                statement = []
+                batch = None
+        if "".join(statement).strip():
+            statements.append(("\n".join(statement).strip(), batch))
+        return statements
+
+    def parse_batch(self, line, direction):
+        try:
+            key, size = line.strip()[len(self.BATCH):].split()
+            table, column = key.split(".")
+            return table, column, int(size)
+        except ValueError:
+            raise MigrationError(f"Invalid batch in {self.path(direction)}: {line.strip()}")
+
+
+# Applies and reverts migrations and records them in the schema_version table
+# Each statement is timed and reported as it finishes so long running steps on large tables can be followed
+# Index changes use ALGORITHM=INPLACE, LOCK=NONE so they fail instead of blocking writes on a loaded table
+# and row changes on large tables are split into key ranges with a batch comment, see SQLMigration
+class SQLMigrator(SQLInterface):
+
+    DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+    UP = "up"
+    DOWN = "down"
+
+    CREATE_VERSION_TABLE = """
+        CREATE TABLE schema_version (
+            version         INT             NOT NULL,
+            name            VARCHAR(200)    NOT NULL,
+            applied_at      DATETIME        NOT NULL    DEFAULT CURRENT_TIMESTAMP,
+            duration_ms     DOUBLE          NOT NULL    DEFAULT 0,
+            PRIMARY KEY(version)
+        )
+    """
+    # statements finished by a migration that has not been recorded yet,
+    # a migration that fails partway resumes after the last statement that finished
+    CREATE_STEP_TABLE = """
+        CREATE TABLE schema_migration_step (
+            version         INT             NOT NULL,
+            direction       VARCHAR(4)      NOT NULL,
+            step            INT             NOT NULL,
+            finished_at     DATETIME        NOT NULL    DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY(version, direction, step)
+        )
+    """
+
+    def __init__(self, directory=DIRECTORY, pool=None, report=print):
+        super().__init__(pool)
+        self.directory = directory
+        self.report = report
+
+    # the schema is read and changed on the primary only
+    def get_router(self):
+        return None
+
+    def migrations(self):
+        migrations = {}
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(f".{self.UP}.sql"):
+                continue
+            version, _, name = file_name[: -len(f".{self.UP}.sql")].partition("_")
+            try:
+                version = int(version)
+            except ValueError:
+                raise MigrationError(f"Invalid migration file name {file_name}")
+            if version in migrations:
+                raise MigrationError(f"Duplicate migration version {version}")
+            migrations[version] = SQLMigration(version, name, self.directory)
+        return [migrations[version] for version in sorted(migrations)]
+
+    def ensure_version_table(self):
+        query = SQLQueryRegistry.get("schema_version_table_exists")
+        ((exists,),) = self.fetch(query)
+        if not exists:
+            self.commit(self.CREATE_VERSION_TABLE, ())
+        query = SQLQueryRegistry.get("schema_step_table_exists")
+        ((exists,),) = self.fetch(query)
+        if not exists:
+            self.commit(self.CREATE_STEP_TABLE, ())
+
+    def applied_versions(self):
+        self.ensure_version_table()
+        query = SQLQueryRegistry.get("get_schema_versions")
+        return {version for (version,) in self.fetch(query)}
+
+    def status(self):
+        applied = self.applied_versions()
+        return [(migration, migration.version in applied) for migration in self.migrations()]
+
+    # applies every pending migration up to and including target, all of them when target is None
+    def upgrade(self, target=None):
+        applied = self.applied_versions()
+        timings = []
+        for migration in self.migrations():
+            if migration.version in applied:
+                continue
+            if target is not None and migration.version > target:
+                break
+            duration = self.run(migration, self.UP)
+            with self.transaction() as transaction:
+                transaction.execute(
+                    SQLQueryRegistry.get("add_schema_version"),
+                    (migration.version, migration.name, duration),
+                )
+                transaction.execute(SQLQueryRegistry.get("remove_schema_steps"), (migration.version,))
+            timings.append((migration, duration))
+        return timings
+
+    # reverts applied migrations newer than target, newest first
+    def downgrade(self, target):
+        applied = self.applied_versions()
+        timings = []
+        for migration in reversed(self.migrations()):
+            if migration.version <= target or migration.version not in applied:
+                continue
+            duration = self.run(migration, self.DOWN)
+            with self.transaction() as transaction:
+                transaction.execute(SQLQueryRegistry.get("remove_schema_version"), (migration.version,))
+                transaction.execute(SQLQueryRegistry.get("remove_schema_steps"), (migration.version,))
+            timings.append((migration, duration))
+        return timings
+
+    def finished_steps(self, migration, direction):
+        query = SQLQueryRegistry.get("get_schema_steps")
+        return {step for (step,) in self.fetch(query, (migration.version, direction))}
+
+    # runs the statements of one direction and returns the total time in milliseconds
+    # every statement is recorded as it finishes, the ones finished by an earlier run are skipped
+    def run(self, migration, direction):
+        self.report(f"-- {direction.upper()} {migration.version:04d} {migration.name} --")
+        total = 0.0
+        finished = self.finished_steps(migration, direction)
+        add_step = self.sql(SQLQueryRegistry.get("add_schema_step"))
+        with self.connection() as database_connection:
+            sql_cursor = database_connection.cursor()
+            for step, (statement, batch) in enumerate(migration.statements(direction)):
+                summary = " ".join(statement.split())
+                if step in finished:
+                    self.report(f"{'done':>10}     {summary[:70]}")
+                    continue
+                start = time.perf_counter()
+                if batch is None:
+                    sql_cursor.execute(statement)
+                    batches = ""
+                else:
+                    count = self.run_batched(database_connection, sql_cursor, statement, batch)
+                    batches = f" ({count} batches)"
+                sql_cursor.execute(add_step, (migration.version, direction, step))
+                database_connection.commit()
+                elapsed = (time.perf_counter() - start) * 1000
+                total += elapsed
+                self.report(f"{elapsed:10.1f} ms  {summary[:70]}{batches}")
+        self.report(f"{total:10.1f} ms  total\n")
+        return total
+
+    # commits after every range so each one only holds its locks for the rows it touches
+    def run_batched(self, database_connection, sql_cursor, statement, batch):
+        table, column, size = batch
+        sql_cursor.execute(f"SELECT MIN({column}), MAX({column}) FROM {table}")
+        first, last = sql_cursor.fetchone()
+        if first is None:
+            return 0
+        batches = 0
+        for low in range(first, last + 1, size):
+            sql_cursor.execute(statement, (low, low + size - 1))
+            database_connection.commit()
+            batches += 1
+        return batches
@@ -0,0 +1,57 @@
+/*
+    Title: whatabook_offline.sql
+    Description: Schema of the offline replica, the local SQLite copy of the WhatABook database.
+        The tables hold the same columns as the database so the program's queries run on them unchanged,
+        rows only ever come from the database so there are no foreign keys or sample data.
+        replica_table records how far every table is synced and pending_write queues the wishlist writes
+        made while the database could not be reached.
+*/
+
+CREATE TABLE store (
+    store_id    INTEGER         NOT NULL    PRIMARY KEY,
+    locale      VARCHAR(500)    NOT NULL
+);
+
+CREATE TABLE book (
+    book_id     INTEGER         NOT NULL    PRIMARY KEY,
+    book_name   VARCHAR(200)    NOT NULL,
+    author      VARCHAR(200)    NOT NULL,
+    details     VARCHAR(500)
+);
+
+CREATE TABLE user (
+    user_id         INTEGER     NOT NULL    PRIMARY KEY,
+    first_name      VARCHAR(75) NOT NULL,
+    last_name       VARCHAR(75) NOT NULL
+);
+
+CREATE TABLE wishlist (
+    wishlist_id     INTEGER     NOT NULL    PRIMARY KEY,
+    user_id         INTEGER     NOT NULL,
+    book_id         INTEGER     NOT NULL
+);
+
+CREATE UNIQUE INDEX ux_wishlist_user_book ON wishlist(user_id, book_id);
+CREATE INDEX ix_wishlist_book ON wishlist(book_id);
+CREATE INDEX ix_wishlist_user_wishlist ON wishlist(user_id, wishlist_id);
+
+-- catalog_version of the book and store tables when they were copied
+-- and the highest key copied of the user and wishlist tables, synced_at is seconds since the epoch
+CREATE TABLE replica_table (
+    table_name      VARCHAR(64) NOT NULL    PRIMARY KEY,
+    version         BIGINT,
+    last_key        BIGINT      NOT NULL    DEFAULT 0,
+    row_count       BIGINT      NOT NULL    DEFAULT 0,
+    synced_at       DOUBLE
+);
+
+INSERT INTO replica_table(table_name)
+    VALUES('book'), ('store'), ('user'), ('wishlist');
+
+-- wishlist writes waiting for the database, replayed in order on the next sync
+CREATE TABLE pending_write (
+    write_id        INTEGER     NOT NULL    PRIMARY KEY,
+    user_id         INTEGER     NOT NULL,
+    book_ids        TEXT        NOT NULL,
+    queued_at       DOUBLE      NOT NULL
+);
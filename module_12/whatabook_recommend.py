@@ -0,0 +1,243 @@
+import argparse
+import itertools
+import random
+import threading
+import time
+import numpy as np
+from scipy import sparse
+from whatabook import Whatabook
+from whatabook_config import SQLConfiguration
+from whatabook_db import SQLQueryRegistry
+
+"""
+    Title: whatabook_recommend.py
+    Description: "Customers who wishlisted this also wishlisted" recommendations.
+        The wishlist table is read once into a sparse user x book matrix and multiplied by its transpose
+        to count how often every pair of books is wishlisted by the same customer.
+        Pairs are ranked by cosine similarity, co-occurrences / sqrt(wishlists of book a * wishlists of book b),
+        and the top books for every book are kept in memory after the first lookup.
+        Books added to wishlists by this process are counted straight away and folded into the matrix
+        once enough of them have built up.
+        numpy and scipy are optional, whatabook.py only imports this module when recommendations are enabled.
+"""
+
+
+class RecommendationEngine:
+    def __init__(self, top_n=10, compact_threshold=10000):
+        self.top_n = top_n
+        self.compact_threshold = compact_threshold
+        self._lock = threading.Lock()
+        # book x book co-occurrence counts with an empty diagonal, indexed by book id
+        self._cooccurrence = sparse.csr_matrix((0, 0), dtype=np.float32)
+        # wishlists holding each book, indexed by book id
+        self._counts = np.zeros(0, dtype=np.float32)
+        # user_id -> book ids on the user's wishlist
+        self._wishlists = {}
+        # co-occurrences added since the last compact, book_id -> {other book_id: count}
+        self._pending = {}
+        self._pending_size = 0
+        # book_id -> ((book_id, score), ...) best first, cleared when the book's row changes
+        self._top = {}
+        self._stats = {"lookups": 0, "computed": 0, "added": 0, "compactions": 0}
+
+    @classmethod
+    def from_config(cls):
+        try:
+            recommend_config = SQLConfiguration.load_recommend_config()
+        except KeyError:
+            return cls()
+
+        return cls(
+            top_n=recommend_config.getint(SQLConfiguration.TOP_N, 10),
+            compact_threshold=recommend_config.getint(SQLConfiguration.COMPACT_THRESHOLD, 10000),
+        )
+
+    # the pairs are streamed straight into one array instead of a list of row tuples first
+    def load(self, interface):
+        rows = interface.iterate(SQLQueryRegistry.get("get_wishlist_pairs"))
+        pairs = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64).reshape(-1, 2)
+        self.build(pairs[:, 0], pairs[:, 1])
+        return self
+
+    # builds the matrix from parallel arrays of user ids and book ids
+    def build(self, user_ids, book_ids):
+        users, user_rows = np.unique(user_ids, return_inverse=True)
+        books = int(book_ids.max()) + 1 if len(book_ids) else 0
+
+        wishlists = sparse.csr_matrix(
+            (np.ones(len(book_ids), dtype=np.float32), (user_rows, book_ids)),
+            shape=(len(users), books),
+        )
+        # a book listed twice by one user still counts once
+        wishlists.sum_duplicates()
+        wishlists.data[:] = 1
+
+        cooccurrence = (wishlists.T @ wishlists).tocsr()
+        cooccurrence.setdiag(0)
+        cooccurrence.eliminate_zeros()
+
+        with self._lock:
+            self._cooccurrence = cooccurrence
+            self._counts = np.asarray(wishlists.sum(axis=0), dtype=np.float32).ravel()
+            self._wishlists = {
+                user_id: set(wishlists.indices[start:end].tolist())
+                for user_id, start, end in zip(
+                    users.tolist(), wishlists.indptr[:-1].tolist(), wishlists.indptr[1:].tolist()
+                )
+            }
+            self._pending = {}
+            self._pending_size = 0
+            self._top = {}
+
+    # counts a book added to a wishlist, the scores of the books on the wishlist change straight away
+    # other books holding book_id in their top lists pick up its new count after the next compact
+    def add(self, user_id, book_id):
+        with self._lock:
+            wishlist = self._wishlists.setdefault(user_id, set())
+            if book_id in wishlist:
+                return
+
+            for other in wishlist:
+                row = self._pending.setdefault(book_id, {})
+                row[other] = row.get(other, 0) + 1
+                row = self._pending.setdefault(other, {})
+                row[book_id] = row.get(book_id, 0) + 1
+                self._top.pop(other, None)
+            self._pending_size += len(wishlist)
+            wishlist.add(book_id)
+            self._top.pop(book_id, None)
+
+            if book_id >= len(self._counts):
+                grow = max(book_id + 1, 2 * len(self._counts)) - len(self._counts)
+                self._counts = np.concatenate((self._counts, np.zeros(grow, dtype=np.float32)))
+            self._counts[book_id] += 1
+            self._stats["added"] += 1
+
+            if self._pending_size >= self.compact_threshold:
+                self._compact()
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    # folds the pending co-occurrences into the matrix in one sparse addition
+    def _compact(self):
+        if not self._pending:
+            return
+
+        rows, columns, counts = [], [], []
+        for book_id, row in self._pending.items():
+            rows.extend([book_id] * len(row))
+            columns.extend(row)
+            counts.extend(row.values())
+
+        size = max(len(self._counts), self._cooccurrence.shape[0])
+        cooccurrence = self._cooccurrence.copy()
+        cooccurrence.resize((size, size))
+        delta = sparse.csr_matrix(
+            (np.array(counts, dtype=np.float32), (rows, columns)), shape=(size, size)
+        )
+        self._cooccurrence = (cooccurrence + delta).tocsr()
+        self._pending = {}
+        self._pending_size = 0
+        # every count may have changed so every cached top list is stale
+        self._top = {}
+        self._stats["compactions"] += 1
+
+    def _row(self, book_id):
+        cooccurrence = self._cooccurrence
+        if book_id < cooccurrence.shape[0]:
+            start, end = cooccurrence.indptr[book_id], cooccurrence.indptr[book_id + 1]
+            others = cooccurrence.indices[start:end]
+            counts = cooccurrence.data[start:end]
+        else:
+            others = np.zeros(0, dtype=np.int32)
+            counts = np.zeros(0, dtype=np.float32)
+
+        pending = self._pending.get(book_id)
+        if pending:
+            others = np.concatenate([others, np.fromiter(pending, dtype=np.int64)])
+            counts = np.concatenate(
+                [counts, np.fromiter(pending.values(), dtype=np.float32)]
+            )
+            others, positions = np.unique(others, return_inverse=True)
+            counts = np.bincount(positions, weights=counts)
+        return others, counts
+
+    def _compute_top(self, book_id):
+        others, counts = self._row(book_id)
+        if not len(others) or book_id >= len(self._counts):
+            return ()
+
+        scores = counts / np.sqrt(self._counts[book_id] * self._counts[others])
+        if len(scores) > self.top_n:
+            best = np.argpartition(-scores, self.top_n - 1)[: self.top_n]
+            others, scores = others[best], scores[best]
+        order = np.lexsort((others, -scores))
+        self._stats["computed"] += 1
+        return tuple(zip(others[order].tolist(), scores[order].tolist()))
+
+    # (book_id, score) pairs of the books most often wishlisted with book_id, best first
+    def recommend_for_book(self, book_id, limit=None):
+        with self._lock:
+            self._stats["lookups"] += 1
+            top = self._top.get(book_id)
+            if top is None:
+                top = self._top[book_id] = self._compute_top(book_id)
+        return list(top[:limit])
+
+    # sums the top lists of the books on the user's wishlist, leaving out the books already on it
+    def recommend_for_user(self, user_id, limit=None):
+        with self._lock:
+            wishlist = set(self._wishlists.get(user_id, ()))
+        scores = {}
+        for book_id in wishlist:
+            for other, score in self.recommend_for_book(book_id):
+                if other not in wishlist:
+                    scores[other] = scores.get(other, 0.0) + score
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[: limit if limit is not None else self.top_n]
+
+    # one past the highest book id counted so far
+    def size(self):
+        return len(self._counts)
+
+    def statistics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["books"] = int(np.count_nonzero(self._counts))
+            stats["users"] = len(self._wishlists)
+            stats["pairs"] = int(self._cooccurrence.nnz)
+            stats["pending"] = self._pending_size
+            stats["cached"] = len(self._top)
+        return stats
+
+
+# times the lookups once the engine is built, the first lookup of a book computes its top list
+def main():
+    parser = argparse.ArgumentParser(description="Whatabook wishlist recommendations")
+    parser.add_argument("--book", type=int, help="show the books wishlisted with this book")
+    parser.add_argument("--user", type=int, help="show recommendations for this user")
+    parser.add_argument("--lookups", type=int, default=10000, help="random book lookups to time")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    engine = RecommendationEngine.from_config().load(Whatabook())
+    print(f"built in {time.perf_counter() - start:.2f}s {engine.statistics()}")
+
+    if args.book is not None:
+        print(engine.recommend_for_book(args.book))
+    if args.user is not None:
+        print(engine.recommend_for_user(args.user))
+
+    book_ids = [random.randrange(max(1, engine.size())) for _ in range(args.lookups)]
+    for cached in (False, True):
+        start = time.perf_counter()
+        for book_id in book_ids:
+            engine.recommend_for_book(book_id)
+        elapsed = (time.perf_counter() - start) / max(1, len(book_ids)) * 1e6
+        print(f"{'cached' if cached else 'first'} lookups: {elapsed:.1f} us each")
+
+
+if __name__ == "__main__":
+    main()
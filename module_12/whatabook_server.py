@@ -0,0 +1,257 @@
+import argparse
+import json
+import re
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+from whatabook import (
+    IllegalArgumentError,
+    InvalidBookError,
+    InvalidUserError,
+    PoolClosedError,
+    PoolExhaustedError,
+    SQLConnectionPool,
+    SQLReplicaRouter,
+    TableNotFoundError,
+    Tracer,
+    Whatabook,
+)
+
+"""
+    Title: whatabook_server.py
+    Description: Serves the Whatabook operations as JSON over HTTP.
+        Requests are handled by a bounded pool of worker threads that share one Whatabook,
+        and with it the database connection pool and the in-process caches.
+        SIGINT and SIGTERM stop accepting connections, let the requests in flight finish
+        and close the database connections.
+
+    Endpoints:
+        GET  /health
+        GET  /stats
+        GET  /books?page_size=10&cursor=<next_cursor>
+        GET  /books/search?q=<terms>&page_size=10&cursor=<next_cursor>
+        GET  /locations
+        GET  /users/<user_id>/wishlist?page_size=10&cursor=<next_cursor>
+        GET  /users/<user_id>/books-to-add
+        GET  /users/<user_id>/recommendations
+        POST /users/<user_id>/wishlist  {"book_ids": [1, 4, 5]}
+"""
+
+
+# HTTP server that hands every accepted connection to a fixed number of worker threads
+class WhatabookHTTPServer(HTTPServer):
+    def __init__(self, address, whatabook, workers=16):
+        super().__init__(address, WhatabookRequestHandler)
+        self.whatabook = whatabook
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="whatabook-worker"
+        )
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    # waits for the requests in flight before returning
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+class WhatabookRequestHandler(BaseHTTPRequestHandler):
+
+    USER_PATH = re.compile(r"^/users/(?P<user_id>\d+)/(?P<resource>wishlist|books-to-add|recommendations)$")
+    # request bodies are small json objects, larger ones are refused before they are read
+    MAX_BODY_BYTES = 64 * 1024
+
+    def do_GET(self):
+        self.handle_route(self.get_route)
+
+    def do_POST(self):
+        self.handle_route(self.post_route)
+
+    # maps the errors raised by Whatabook onto status codes
+    # every request is the root span of its own trace when tracing is on
+    def handle_route(self, route):
+        try:
+            with Tracer.trace("http", method=self.command, path=self.path) as span:
+                status, body = route(urlparse(self.path))
+                span["status"] = status
+        except IllegalArgumentError as e:
+            status, body = 400, {"error": str(e)}
+        except InvalidBookError as e:
+            status, body = 400, {"error": str(e), "book_ids": e.book_ids}
+        except (InvalidUserError, TableNotFoundError) as e:
+            status, body = 404, {"error": str(e)}
+        except (PoolExhaustedError, PoolClosedError) as e:
+            status, body = 503, {"error": str(e)}
+        except Exception as e:
+            self.log_error("%s", e)
+            status, body = 500, {"error": "Internal server error"}
+        self.send_json(status, body)
+
+    def get_route(self, url):
+        whatabook = self.server.whatabook
+        query = parse_qs(url.query)
+
+        if url.path == "/health":
+            return 200, {
+                "status": "offline" if whatabook.is_offline() else "ok",
+                "pool": whatabook.pool_statistics(),
+                "replicas": whatabook.replica_statistics(),
+                "result_cache": (
+                    whatabook.result_cache.statistics()
+                    if whatabook.result_cache is not None
+                    else None
+                ),
+                "offline_replica": (
+                    whatabook.offline_replica.statistics()
+                    if whatabook.offline_replica is not None
+                    else None
+                ),
+            }
+
+        if url.path == "/stats":
+            if whatabook.stats is None:
+                return 404, {"error": "Query statistics are turned off"}
+            return 200, whatabook.stats.snapshot()
+
+        if url.path == "/books":
+            page = whatabook.get_books_page(*self.page_arguments(query))
+            return 200, self.page_body(page)
+
+        if url.path == "/books/search":
+            terms = query.get("q", [""])[0]
+            page = whatabook.search_books(terms, *self.page_arguments(query))
+            return 200, self.page_body(page)
+
+        if url.path == "/locations":
+            stores = whatabook.read_catalog("store", whatabook.load_locations)
+            return 200, {"items": [store.to_dict() for store in stores]}
+
+        match = self.USER_PATH.match(url.path)
+        if match is None:
+            return 404, {"error": "Not found"}
+
+        user_id = self.validated_user_id(match)
+        if match["resource"] == "wishlist":
+            page = whatabook.get_wishlist_page(user_id, *self.page_arguments(query))
+            return 200, self.page_body(page)
+
+        if match["resource"] == "recommendations":
+            books = whatabook.load_recommendations(user_id)
+            return 200, {"items": [book.to_dict() for book in books]}
+
+        books = whatabook.load_books_to_add(user_id)
+        return 200, {"items": [book.to_dict() for book in books]}
+
+    def post_route(self, url):
+        match = self.USER_PATH.match(url.path)
+        if match is None or match["resource"] != "wishlist":
+            return 404, {"error": "Not found"}
+
+        user_id = self.validated_user_id(match)
+        body = self.read_json()
+        book_ids = body.get("book_ids") if isinstance(body, dict) else None
+        # json true and false are bools, which are ints in python
+        if not isinstance(book_ids, list) or not all(
+            isinstance(book_id, int) and not isinstance(book_id, bool) for book_id in book_ids
+        ):
+            raise IllegalArgumentError("book_ids must be a list of book ids")
+
+        added = self.server.whatabook.add_books_to_wishlist(user_id, book_ids)
+        return 201, {"added": added}
+
+    def validated_user_id(self, match):
+        user_id = int(match["user_id"])
+        if not self.server.whatabook.validate_user_id(user_id):
+            raise InvalidUserError
+        return user_id
+
+    @staticmethod
+    def page_arguments(query):
+        try:
+            page_size = int(query.get("page_size", [Whatabook.PAGE_SIZE])[0])
+        except ValueError:
+            raise IllegalArgumentError("page_size must be a whole number")
+        cursor = query.get("cursor", [None])[0]
+        return page_size, cursor
+
+    @staticmethod
+    def page_body(page):
+        return {
+            "items": [item.to_dict() for item in page.items],
+            "next_cursor": page.next_cursor,
+            "previous_cursor": page.previous_cursor,
+        }
+
+    def read_json(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            raise IllegalArgumentError("Invalid Content-Length")
+        # rfile.read(-1) would block the worker until the client closes the connection
+        if length < 0 or length > self.MAX_BODY_BYTES:
+            # the body is left unread so the connection can not be used for another request
+            self.close_connection = True
+            raise IllegalArgumentError(
+                f"Content-Length must be between 0 and {self.MAX_BODY_BYTES} bytes"
+            )
+        try:
+            return json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            raise IllegalArgumentError("Invalid JSON body")
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def serve(host, port, workers):
+    server = WhatabookHTTPServer((host, port), Whatabook(), workers)
+
+    # shutdown() blocks until serve_forever() returns so it can not run on the serving thread
+    def stop(signal_number, frame):
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    print(f"Serving Whatabook on http://{host}:{port} with {workers} workers")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        SQLReplicaRouter.close_router()
+        SQLConnectionPool.close_pool()
+    print("Whatabook server stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Whatabook JSON service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=16,
+        help="requests handled at once, extra requests wait for a free worker",
+    )
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+/*
+    Title: whatabook_sqlite.sql
+    Description: WhatABook schema and sample data for the embedded SQLite backend.
+        The same tables, indexes, catalog version triggers and rows as whatabook_init.sql,
+        run by the program when it opens a new SQLite file.
+*/
+
+CREATE TABLE store (
+    store_id    INTEGER         NOT NULL    PRIMARY KEY,
+    locale      VARCHAR(500)    NOT NULL
+);
+
+CREATE TABLE book (
+    book_id     INTEGER         NOT NULL    PRIMARY KEY,
+    book_name   VARCHAR(200)    NOT NULL,
+    author      VARCHAR(200)    NOT NULL,
+    details     VARCHAR(500)
+);
+
+CREATE TABLE user (
+    user_id         INTEGER     NOT NULL    PRIMARY KEY,
+    first_name      VARCHAR(75) NOT NULL,
+    last_name       VARCHAR(75) NOT NULL
+);
+
+CREATE TABLE wishlist (
+    wishlist_id     INTEGER     NOT NULL    PRIMARY KEY,
+    user_id         INTEGER     NOT NULL    REFERENCES user(user_id),
+    book_id         INTEGER     NOT NULL    REFERENCES book(book_id)
+);
+
+-- covers the wishlist lookups and the available books anti-join for a user
+CREATE UNIQUE INDEX ux_wishlist_user_book ON wishlist(user_id, book_id);
+CREATE INDEX ix_wishlist_book ON wishlist(book_id);
+-- the wishlist pages of a user in wishlist_id order
+CREATE INDEX ix_wishlist_user_wishlist ON wishlist(user_id, wishlist_id);
+
+-- migrations applied to the schema, the MySQL migrations are already part of this schema
+CREATE TABLE schema_version (
+    version         INTEGER         NOT NULL    PRIMARY KEY,
+    name            VARCHAR(200)    NOT NULL,
+    applied_at      DATETIME        NOT NULL    DEFAULT CURRENT_TIMESTAMP,
+    duration_ms     DOUBLE          NOT NULL    DEFAULT 0
+);
+
+INSERT INTO schema_version(version, name)
+    VALUES
+        (1, 'wishlist_indexes'),
+        (2, 'wishlist_unique_user_book'),
+        (3, 'catalog_version'),
+        (4, 'book_fulltext'),
+        (5, 'wishlist_user_page');
+
+-- statements finished by a migration that failed partway, it resumes after them
+CREATE TABLE schema_migration_step (
+    version         INTEGER         NOT NULL,
+    direction       VARCHAR(4)      NOT NULL,
+    step            INTEGER         NOT NULL,
+    finished_at     DATETIME        NOT NULL    DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY(version, direction, step)
+);
+
+-- version counters for the catalog tables, checked by the program before re-reading a cached table
+CREATE TABLE catalog_version (
+    table_name      VARCHAR(64) NOT NULL    PRIMARY KEY,
+    version         BIGINT      NOT NULL    DEFAULT 0
+);
+
+INSERT INTO catalog_version(table_name)
+    VALUES('book'), ('store');
+
+/*
+    bump the catalog version whenever a catalog table changes
+*/
+CREATE TRIGGER book_insert_version AFTER INSERT ON book
+    BEGIN UPDATE catalog_version SET version = version + 1 WHERE table_name = 'book'; END;
+
+CREATE TRIGGER book_update_version AFTER UPDATE ON book
+    BEGIN UPDATE catalog_version SET version = version + 1 WHERE table_name = 'book'; END;
+
+CREATE TRIGGER book_delete_version AFTER DELETE ON book
+    BEGIN UPDATE catalog_version SET version = version + 1 WHERE table_name = 'book'; END;
+
+CREATE TRIGGER store_insert_version AFTER INSERT ON store
+    BEGIN UPDATE catalog_version SET version = version + 1 WHERE table_name = 'store'; END;
+
+CREATE TRIGGER store_update_version AFTER UPDATE ON store
+    BEGIN UPDATE catalog_version SET version = version + 1 WHERE table_name = 'store'; END;
+
+CREATE TRIGGER store_delete_version AFTER DELETE ON store
+    BEGIN UPDATE catalog_version SET version = version + 1 WHERE table_name = 'store'; END;
+
+/*
+    sample data
+*/
+INSERT INTO store(locale)
+    VALUES('1000 Galvin Rd S, Bellevue, NE 68005');
+
+INSERT INTO book(book_name, author, details)
+    VALUES
+        ('Homeland', 'R.A.Salvatore', 'The first part of the The Dark Elf Trilogy'),
+        ('Exile', 'R.A.Salvatore', 'The second part of The Dark Elf Trilogy'),
+        ('Sojourn', 'R.A.Salvatore', 'The third part of The Dark Elf Trilogy'),
+        ('The Fault in Our Stars', 'John Green', NULL),
+        ('The Hunger Games', 'Suzanne Collins', NULL),
+        ('Catching Fire', 'Suzanne Collins', NULL),
+        ('Mockingjay', 'Suzanne Collins', NULL),
+        ('Wizard''s First Rule', 'Terry Goodkind', NULL),
+        ('Stone of Tears', 'Terry Goodkind', NULL);
+
+INSERT INTO user(first_name, last_name)
+    VALUES
+        ('Rick', 'Sanchez'),
+        ('Morty', 'Smith'),
+        ('Summer', 'Smith');
+
+INSERT INTO wishlist(user_id, book_id)
+    VALUES
+        ((SELECT user_id FROM user WHERE first_name = 'Rick'), (SELECT book_id FROM book WHERE book_name = 'Sojourn')),
+        ((SELECT user_id FROM user WHERE first_name = 'Morty'), (SELECT book_id FROM book WHERE book_name = 'Stone of Tears')),
+        ((SELECT user_id FROM user WHERE first_name = 'Summer'), (SELECT book_id FROM book WHERE book_name = 'The Hunger Games'));
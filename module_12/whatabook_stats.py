@@ -0,0 +1,410 @@
+import atexit
+import os
+import bisect
+import functools
+import json
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from whatabook_config import SQLConfiguration
+from whatabook_db import SQLQuery
+
+"""
+    Title: whatabook_stats.py
+    Description: Query latency statistics and request tracing
+"""
+
+
+# Latency histogram with fixed buckets in milliseconds
+# Percentiles are read from the buckets so adding a timing never allocates,
+# a percentile is the upper bound of the bucket it falls in, or the slowest timing for the last bucket
+class LatencyHistogram:
+
+    BOUNDS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, elapsed_ms):
+        self.buckets[bisect.bisect_left(self.BOUNDS, elapsed_ms)] += 1
+        self.count += 1
+        self.total_ms += elapsed_ms
+        if elapsed_ms > self.max_ms:
+            self.max_ms = elapsed_ms
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def to_dict(self):
+        buckets = {f"le_{bound}": count for bound, count in zip(self.BOUNDS, self.buckets)}
+        buckets[f"gt_{self.BOUNDS[-1]}"] = self.buckets[-1]
+        return {
+            "count": self.count,
+            "mean_ms": self.total_ms / self.count if self.count else 0.0,
+            "p50_ms": self.percentile(0.50),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": self.max_ms,
+            "buckets": buckets,
+        }
+
+
+# Timings of every named query, split into the phases of a read
+# connect is the pool checkout, execute sends the statement, fetch reads the rows
+# and render formats them for a listing, transactions add a commit phase
+# Queries slower than slow_query_ms are kept with their parameters, the newest keep of them in memory
+# and all of them appended to slow_query_log as json lines when a file is given
+# Plain sql strings are counted together under the name "sql"
+class QueryStatistics:
+
+    CONNECT = "connect"
+    EXECUTE = "execute"
+    FETCH = "fetch"
+    RENDER = "render"
+    COMMIT = "commit"
+
+    def __init__(self, slow_query_ms=100, slow_query_log=None, keep=100):
+        self.slow_query_ms = slow_query_ms
+        self.slow_query_log = slow_query_log
+        # name -> {"calls", "rows", "errors", "cache_hits", "phases": {phase: LatencyHistogram}}
+        self._queries = {}
+        self._slow_queries = deque(maxlen=keep)
+        self._errors = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    @classmethod
+    def from_config(cls):
+        try:
+            stats_config = SQLConfiguration.load_stats_config()
+        except KeyError:
+            return None
+
+        if not stats_config.getboolean(SQLConfiguration.ENABLED, False):
+            return None
+
+        return cls(
+            slow_query_ms=stats_config.getfloat(SQLConfiguration.SLOW_QUERY_MS, 100),
+            slow_query_log=stats_config.get(SQLConfiguration.SLOW_QUERY_LOG) or None,
+            keep=stats_config.getint(SQLConfiguration.SLOW_QUERY_KEEP, 100),
+        )
+
+    @staticmethod
+    def name_of(query):
+        return query.name if isinstance(query, SQLQuery) else "sql"
+
+    # must be called while holding the lock
+    def _entry(self, name):
+        entry = self._queries.get(name)
+        if entry is None:
+            entry = self._queries[name] = {
+                "calls": 0,
+                "rows": 0,
+                "errors": 0,
+                "cache_hits": 0,
+                "phases": {},
+            }
+        return entry
+
+    # phases maps each phase to its duration in seconds
+    def record(self, name, phases, rows=0, params=()):
+        elapsed_ms = sum(phases.values()) * 1000
+        with self._lock:
+            entry = self._entry(name)
+            entry["calls"] += 1
+            entry["rows"] += rows
+            for phase, seconds in phases.items():
+                histogram = entry["phases"].get(phase)
+                if histogram is None:
+                    histogram = entry["phases"][phase] = LatencyHistogram()
+                histogram.add(seconds * 1000)
+
+        if elapsed_ms >= self.slow_query_ms:
+            self.record_slow_query(name, phases, elapsed_ms, rows, params)
+
+    # a phase timed on its own, such as rendering the rows of a listing, is not another call
+    def record_phase(self, name, phase, seconds):
+        with self._lock:
+            phases = self._entry(name)["phases"]
+            histogram = phases.get(phase)
+            if histogram is None:
+                histogram = phases[phase] = LatencyHistogram()
+            histogram.add(seconds * 1000)
+
+    def record_cache_hit(self, name):
+        with self._lock:
+            self._entry(name)["cache_hits"] += 1
+
+    def record_error(self, name, error):
+        error_name = type(error).__name__
+        with self._lock:
+            self._entry(name)["errors"] += 1
+            self._errors[error_name] = self._errors.get(error_name, 0) + 1
+
+    def record_slow_query(self, name, phases, elapsed_ms, rows, params):
+        slow_query = {
+            "time": time.time(),
+            "query": name,
+            "params": [self.loggable(value) for value in params],
+            "elapsed_ms": elapsed_ms,
+            "rows": rows,
+            "phases_ms": {phase: seconds * 1000 for phase, seconds in phases.items()},
+        }
+        with self._lock:
+            self._slow_queries.append(slow_query)
+            if self.slow_query_log is not None:
+                try:
+                    with open(self.slow_query_log, "a") as log_file:
+                        log_file.write(json.dumps(slow_query) + "\n")
+                except OSError:
+                    # the kiosk keeps running when the log can not be written
+                    self.slow_query_log = None
+
+    @staticmethod
+    def loggable(value):
+        return value if value is None or isinstance(value, (int, float, str)) else str(value)
+
+    def slow_queries(self):
+        with self._lock:
+            return list(self._slow_queries)
+
+    def reset(self):
+        with self._lock:
+            self._queries.clear()
+            self._slow_queries.clear()
+            self._errors.clear()
+            self.started = time.time()
+
+    # machine readable copy of every counter and histogram
+    def snapshot(self):
+        with self._lock:
+            return {
+                "started": self.started,
+                "taken": time.time(),
+                "slow_query_ms": self.slow_query_ms,
+                "queries": {
+                    name: {
+                        "calls": entry["calls"],
+                        "rows": entry["rows"],
+                        "errors": entry["errors"],
+                        "cache_hits": entry["cache_hits"],
+                        "phases": {
+                            phase: histogram.to_dict()
+                            for phase, histogram in entry["phases"].items()
+                        },
+                    }
+                    for name, entry in sorted(self._queries.items())
+                },
+                "errors": dict(self._errors),
+                "slow_queries": list(self._slow_queries),
+            }
+
+    def write_snapshot(self, path):
+        with open(path, "w") as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file, indent=2)
+
+    # one line per query and phase, slowest p95 first within each query
+    def report(self):
+        snapshot = self.snapshot()
+        lines = [
+            f"{'query':<28} {'phase':<8} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} "
+            f"{'max ms':>9} {'rows':>9} {'hits':>6} {'errors':>6}"
+        ]
+        for name, entry in snapshot["queries"].items():
+            phases = sorted(entry["phases"].items(), key=lambda item: -item[1]["p95_ms"])
+            for phase, histogram in phases:
+                lines.append(
+                    f"{name:<28} {phase:<8} {histogram['count']:>7} {histogram['p50_ms']:>9.2f} "
+                    f"{histogram['p95_ms']:>9.2f} {histogram['max_ms']:>9.2f} "
+                    f"{entry['rows']:>9} {entry['cache_hits']:>6} {entry['errors']:>6}"
+                )
+            if not phases:
+                lines.append(
+                    f"{name:<28} {'-':<8} {0:>7} {'':>9} {'':>9} {'':>9} "
+                    f"{entry['rows']:>9} {entry['cache_hits']:>6} {entry['errors']:>6}"
+                )
+        lines.append(f"\n{len(snapshot['slow_queries'])} slow queries over {self.slow_query_ms:g} ms")
+        for slow_query in snapshot["slow_queries"][-10:]:
+            lines.append(
+                f"{slow_query['elapsed_ms']:>9.2f} ms {slow_query['query']} {slow_query['params']}"
+            )
+        return "\n".join(lines) + "\n"
+
+
+# Opt-in tracing of menu actions, Whatabook methods and database calls as nested spans
+# Spans are written in the Chrome trace event format, open the file in chrome://tracing or ui.perfetto.dev,
+# nesting is shown from the span times so spans need no ids
+# The outermost span of a thread decides whether the whole trace is kept, SAMPLE_RATE of them are
+# The TRACE section of the configuration file or python whatabook.py --trace <file> turns it on
+# and the spans are written to the file when the program exits
+class Tracer:
+
+    _tracer = None
+    _tracer_lock = threading.Lock()
+
+    def __init__(self, path, sample_rate=1.0, max_events=100000):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_events = max_events
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self.dropped = 0
+        self._events = []
+        self._threads = set()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        try:
+            trace_config = SQLConfiguration.load_trace_config()
+        except KeyError:
+            return None
+
+        if not trace_config.getboolean(SQLConfiguration.ENABLED, False):
+            return None
+
+        return cls(
+            trace_config.get(SQLConfiguration.OUTPUT, "whatabook_trace.json"),
+            sample_rate=trace_config.getfloat(SQLConfiguration.SAMPLE_RATE, 1.0),
+            max_events=trace_config.getint(SQLConfiguration.MAX_EVENTS, 100000),
+        )
+
+    # the process-wide tracer, None when tracing is off
+    @classmethod
+    def get_tracer(cls):
+        tracer = cls._tracer
+        if tracer is None:
+            with cls._tracer_lock:
+                if cls._tracer is None:
+                    # False marks tracing as off so the configuration is only read once
+                    cls._tracer = cls.from_config() or False
+                tracer = cls._tracer
+        return tracer or None
+
+    @classmethod
+    def start(cls, path, sample_rate=1.0):
+        with cls._tracer_lock:
+            cls._tracer = cls(path, sample_rate)
+        return cls._tracer
+
+    @classmethod
+    def close_tracer(cls):
+        with cls._tracer_lock:
+            tracer, cls._tracer = cls._tracer, None
+        if tracer:
+            tracer.export()
+
+    # a span that does nothing when tracing is off, the attributes can be added to inside the block
+    @classmethod
+    def trace(cls, name, category="whatabook", **attributes):
+        tracer = cls.get_tracer()
+        if tracer is None:
+            return nullcontext(attributes)
+        return tracer.span(name, category, **attributes)
+
+    # decorator that runs every call of the function in a span named after it
+    # generators only get a span for creating them, their work shows up under the caller
+    @classmethod
+    def traced(cls, function):
+        name = function.__qualname__
+
+        @functools.wraps(function)
+        def traced_function(*args, **kwargs):
+            tracer = cls.get_tracer()
+            if tracer is None:
+                return function(*args, **kwargs)
+            with tracer.span(name):
+                return function(*args, **kwargs)
+
+        return traced_function
+
+    @contextmanager
+    def span(self, name, category="whatabook", **attributes):
+        local = self._local
+        depth = getattr(local, "depth", 0)
+        if depth == 0:
+            local.sampled = random.random() < self.sample_rate
+        local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            yield attributes
+        except Exception as e:
+            attributes["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            local.depth = depth
+            if local.sampled:
+                self.record(name, category, start, time.perf_counter(), attributes)
+
+    # whether spans recorded now by this thread are kept
+    def sampled(self):
+        local = self._local
+        return getattr(local, "depth", 0) > 0 and local.sampled
+
+    # adds a finished span, start and end are time.perf_counter() readings
+    def record(self, name, category, start, end, attributes=None):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (start - self.origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": self.pid,
+            "tid": thread.ident,
+            "args": attributes or {},
+        }
+        with self._lock:
+            if len(self._events) >= self.max_events:
+                self.dropped += 1
+                return
+            if thread.ident not in self._threads:
+                self._threads.add(thread.ident)
+                self._events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": self.pid,
+                        "tid": thread.ident,
+                        "args": {"name": thread.name},
+                    }
+                )
+            self._events.append(event)
+
+    # phases are (name, start, end) tuples recorded as spans under the current one
+    def record_phases(self, category, phases):
+        if self.sampled():
+            for name, start, end in phases:
+                self.record(name, category, start, end)
+
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def export(self, path=None):
+        path = path if path is not None else self.path
+        trace = {
+            "traceEvents": self.events(),
+            "displayTimeUnit": "ms",
+            "otherData": {"sample_rate": self.sample_rate, "dropped": self.dropped},
+        }
+        with open(path, "w") as trace_file:
+            json.dump(trace, trace_file)
+        return path
+
+
+atexit.register(Tracer.close_tracer)